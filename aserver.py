@@ -0,0 +1,337 @@
+"""
+Async serving mode.
+
+The read-heavy pages (search, book, author, profile, bookshelf and the
+challenge list) are served by a Quart app on an asyncio event loop with an
+asyncpg connection pool, so a process can hold thousands of open client
+connections while only DB_ASYNC_POOL_SIZE of them talk to the database at
+once. The independent queries of a page are started together and each runs
+on its own pooled connection. Every other request (POST handlers, the JSON
+endpoints, login, signup, ...) is handed to the Flask app in server.py,
+which runs on hypercorn's thread pool.
+
+The SQL and row shaping are shared with server.py (catalog.py, profiles.py,
+reviews.py, search.py, bookshelves.py, challenges.py), so both modes render
+the same pages from the same queries.
+
+To run (needs quart, hypercorn and asyncpg):
+    hypercorn aserver:asgi_app --bind 0.0.0.0:8111
+or
+    python aserver.py [HOST] [PORT]
+"""
+import asyncio
+from quart import Quart, request, render_template, abort, url_for, g
+from quart.signals import before_render_template, template_rendered
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from werkzeug.exceptions import HTTPException
+
+import server
+from db import DATABASEURI, make_async_engine
+from queries import instrument
+import dbmetrics
+import latency
+from search import SEARCH_SQL, book_search_query, book_results, search_params, result_from_row
+from catalog import (BOOK_SQL, TRACKING_SQL, AUTHOR_SQL, AUTHOR_BOOKS_SQL, IS_FAVORITE_SQL,
+                     book_cache, book_from_row, tracking_from_row, author_from_row, book_cards)
+from profiles import SECTIONS, HEADER_SQL, header_from_row, section_query, section_page
+from reviews import REVIEW_SORTS, DEFAULT_SORT, reviews_query, reviews_page
+from bookshelves import PROFILE_SHELVES_SQL, BOOKSHELF_SQL, SHELF_BOOKS_SQL, shelf_summaries, shelf_from_row
+from challenges import CHALLENGES_SQL, USER_PARTICIPATION_SQL, challenges_from_rows, participation_by_challenge
+from likes import like_buffer
+from bookstats import STATS_SQL, stats_from_row
+import readingstats
+from recommend import SIMILAR_BOOKS_SQL, RECOMMENDED_BOOKS_SQL, SHOWN
+
+# GET requests for these endpoints are served here; everything else goes to server.app
+ASYNC_ENDPOINTS = {"search", "book", "author", "profile", "view_bookshelf", "challenges", "static"}
+
+app = Quart(__name__, template_folder=server.tmpl_dir)
+before_render_template.connect(latency.before_render_async, app)
+template_rendered.connect(latency.rendered_async, app)
+
+# created per process once serving starts (the event loop must exist first)
+aengine = None
+
+
+@app.before_serving
+async def startup():
+    global aengine
+    aengine = make_async_engine(DATABASEURI)
+    instrument(aengine.sync_engine)
+    dbmetrics.instrument(aengine.sync_engine)
+    server.init_worker()
+
+@app.after_serving
+async def shutdown():
+    await aengine.dispose()
+
+@app.before_request
+async def before_request():
+    # the page's concurrent queries run in copies of this context and add to the same request
+    route = request.endpoint or "unmatched"
+    g.latency = latency.start_request(route)
+    g.db_metrics = dbmetrics.start_request(route)
+
+@app.teardown_request
+async def teardown_request(exception):
+    token = getattr(g, "db_metrics", None)
+    if token is not None:
+        dbmetrics.finish_request(token)
+    token = getattr(g, "latency", None)
+    if token is not None:
+        latency.finish_request(token)
+
+
+async def fetchall(stmt, params=None):
+    """Run stmt on a connection of its own and return all rows."""
+    async with aengine.connect() as conn:
+        result = await conn.execute(stmt, params or {})
+        return result.fetchall()
+
+async def fetchone(stmt, params=None):
+    async with aengine.connect() as conn:
+        result = await conn.execute(stmt, params or {})
+        return result.fetchone()
+
+async def nothing():
+    return None
+
+async def gather(*queries):
+    """Run queries concurrently; a failed query comes back as its exception."""
+    return await asyncio.gather(*queries, return_exceptions=True)
+
+def ok(result, what, default=None):
+    """Return result, or log it and return default if the query failed."""
+    if isinstance(result, Exception):
+        print(what, "db error:", result)
+        return default
+    return result
+
+def raise_if_failed(result, what):
+    if isinstance(result, Exception):
+        print(what, "db error:", result)
+        abort(500)
+    return result
+
+def viewer_id():
+    try:
+        return int(request.cookies.get('profile_id'))
+    except (TypeError, ValueError):
+        return None
+
+
+@app.route('/search')
+async def search():
+    q = (request.args.get('q') or "").strip()
+    mode = request.args.get('mode', 'title')
+
+    results = []
+    next_cursor = None
+
+    if not q:
+        return await render_template("index.html", results=[], query=q, mode=mode)
+
+    if mode == "title":
+        query = book_search_query(q, after=request.args.get('after'))
+        if query is not None:
+            results, next_cursor = book_results(await fetchall(*query))
+
+    elif mode in SEARCH_SQL:
+        avatar_url = url_for('static', filename='img/default-avatar.png')
+        rows = await fetchall(SEARCH_SQL[mode], search_params(q))
+        results = [result_from_row(mode, row, avatar_url) for row in rows]
+
+    return await render_template("index.html", results=results, query=q, mode=mode, next_cursor=next_cursor)
+
+@app.route('/book/<int:book_id>')
+async def book(book_id):
+    sort = request.args.get('sort', DEFAULT_SORT)
+    if sort not in REVIEW_SORTS:
+        sort = DEFAULT_SORT
+    viewer = viewer_id()
+
+    # the catalog part comes from the same per-worker cache the Flask routes use
+    cached = book_cache.get(book_id)
+    book_row, review_rows, stats_row, similar_rows, tracking_row = await gather(
+        fetchone(BOOK_SQL, {"book_id": book_id}) if cached is None else nothing(),
+        fetchall(*reviews_query(book_id, sort)),
+        fetchone(STATS_SQL, {"book_id": book_id}),
+        fetchall(SIMILAR_BOOKS_SQL, {"book_id": book_id, "limit": SHOWN}),
+        fetchone(TRACKING_SQL, {"pid": viewer, "bid": book_id}) if viewer else nothing(),
+    )
+
+    if cached is None:
+        book_row = raise_if_failed(book_row, "book")
+        if book_row is None:
+            abort(404)
+        cached = book_from_row(book_row)
+        book_cache.set(book_id, cached)
+    book = dict(cached)
+
+    reviews, next_reviews = reviews_page(ok(review_rows, "book reviews", []), sort)
+    for r in reviews:
+        r["likes_count"] += like_buffer.pending(book_id, r["profile_id"])
+
+    stats = stats_from_row(ok(stats_row, "book stats"))
+    similar = book_cards(ok(similar_rows, "similar books", []))
+
+    tracking_row = ok(tracking_row, "tracking lookup")
+    tracking = tracking_from_row(tracking_row) if tracking_row else None
+
+    return await render_template("book_page.html", book=book, reviews=reviews, tracking=tracking,
+                                 genres=book["genres"], stats=stats, similar=similar, review_sort=sort,
+                                 review_sorts=list(REVIEW_SORTS), next_reviews=next_reviews)
+
+@app.route('/author/<int:author_id>')
+async def author(author_id):
+    current_user_id = viewer_id()
+
+    row, book_rows, favorite = await gather(
+        fetchone(AUTHOR_SQL, {"aid": author_id}),
+        fetchall(AUTHOR_BOOKS_SQL, {"aid": author_id}),
+        fetchone(IS_FAVORITE_SQL, {"pid": current_user_id, "aid": author_id}) if current_user_id else nothing(),
+    )
+
+    row = raise_if_failed(row, "author")
+    if row is None:
+        abort(404)
+
+    return await render_template(
+        "author_page.html",
+        author=author_from_row(row),
+        books=book_cards(ok(book_rows, "author books", [])),
+        current_user_id=current_user_id,
+        is_favorite=raise_if_failed(favorite, "favorite lookup") is not None
+    )
+
+@app.route('/profile/<int:profile_id>')
+async def profile(profile_id):
+    current_user_id = viewer_id()
+    is_owner = current_user_id == profile_id
+
+    # header, reading stats, the first page of every section and the bookshelves, all at once
+    header_row, stats_row, recommended_rows, shelf_rows, *section_rows = await gather(
+        fetchone(HEADER_SQL, {"pid": profile_id, "viewer": current_user_id}),
+        fetchone(readingstats.STATS_SQL, {"pid": profile_id}),
+        fetchall(RECOMMENDED_BOOKS_SQL, {"pid": profile_id, "limit": SHOWN}) if is_owner else nothing(),
+        fetchall(PROFILE_SHELVES_SQL[is_owner], {"pid": profile_id}),
+        *[fetchall(*section_query(name, profile_id)) for name in SECTIONS]
+    )
+
+    header_row = raise_if_failed(header_row, "profile")
+    if header_row is None:
+        abort(404)
+    profile, counts, is_following = header_from_row(header_row)
+
+    sections = {}
+    for name, rows in zip(SECTIONS, section_rows):
+        items, next_cursor = section_page(raise_if_failed(rows, "profile section"))
+        sections[name] = {"items": items, "next": next_cursor}
+
+    bookshelves = shelf_summaries(ok(shelf_rows, "bookshelves", []))
+    reading_stats = readingstats.stats_from_row(ok(stats_row, "reading stats"))
+    recommended = book_cards(ok(recommended_rows, "recommendations") or [])
+
+    return await render_template(
+        'profile.html',
+        profile=profile,
+        counts=counts,
+        sections=sections,
+        reading_stats=reading_stats,
+        recommended=recommended,
+        is_following=is_following,
+        current_user_id=current_user_id,
+        bookshelves=bookshelves,
+        is_owner=is_owner,
+        has_view_bookshelf=True
+    )
+
+@app.route('/bookshelf/<int:bookshelf_id>')
+async def view_bookshelf(bookshelf_id):
+    # the books are fetched alongside the shelf and dropped if the viewer may not see them
+    row, book_rows = await gather(
+        fetchone(BOOKSHELF_SQL, {"bsid": bookshelf_id}),
+        fetchall(SHELF_BOOKS_SQL, {"bsid": bookshelf_id}),
+    )
+
+    row = raise_if_failed(row, "bookshelf")
+    if row is None:
+        abort(404)
+    shelf = shelf_from_row(row)
+
+    is_owner = viewer_id() == shelf["profile_id"]
+    if not shelf["is_public"] and not is_owner:
+        abort(403)
+
+    books = book_cards(ok(book_rows, "books in bookshelf", []))
+    return await render_template("view_bookshelf.html", shelf=shelf, books=books, is_owner=is_owner)
+
+@app.route('/challenges')
+async def challenges():
+    current_user_id = viewer_id()
+
+    challenge_rows, participation_rows = await gather(
+        fetchall(CHALLENGES_SQL),
+        fetchall(USER_PARTICIPATION_SQL, {"pid": current_user_id}) if current_user_id else nothing(),
+    )
+
+    challenges = challenges_from_rows(ok(challenge_rows, "challenges list", []))
+    user_participation = participation_by_challenge(ok(participation_rows, "participation lookup") or [])
+
+    return await render_template("challenges.html", challenges=challenges, user_participation=user_participation,
+                                 current_user_id=current_user_id)
+
+
+async def served_by_flask(**kwargs):
+    # never reached: asgi_app sends these requests to server.app
+    abort(404)
+
+# Register the remaining Flask rules so url_for() in the templates can build them
+for rule in server.app.url_map.iter_rules():
+    if rule.endpoint not in app.view_functions:
+        app.add_url_rule(rule.rule, endpoint=rule.endpoint, view_func=served_by_flask,
+                         methods=rule.methods - {"HEAD", "OPTIONS"})
+
+flask_app = AsyncioWSGIMiddleware(server.app)
+flask_urls = server.app.url_map.bind("")
+
+
+def served_here(scope):
+    if scope["type"] != "http":
+        # lifespan events start and stop the async pool
+        return True
+    if scope["method"] not in ("GET", "HEAD"):
+        return False
+    try:
+        endpoint, _ = flask_urls.match(scope["path"], method="GET")
+    except HTTPException:
+        return False
+    return endpoint in ASYNC_ENDPOINTS
+
+async def asgi_app(scope, receive, send):
+    if served_here(scope):
+        await app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import click
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    @click.command()
+    @click.argument('HOST', default='0.0.0.0')
+    @click.argument('PORT', default=8111, type=int)
+    def run(host, port):
+        """
+        Serve the async pages and the Flask app from one event loop:
+
+                python aserver.py [HOST] [PORT]
+        """
+        config = Config()
+        config.bind = ["%s:%d" % (host, port)]
+        print("running async server on %s:%d" % (host, port))
+        asyncio.run(serve(asgi_app, config))
+
+    run()
@@ -0,0 +1,48 @@
+"""
+Bookshelf reads shared by the profile and bookshelf pages.
+"""
+from queries import query
+from records import RowMapper
+
+# a profile's shelves: all of them for the owner, public ones for everyone else
+PROFILE_SHELVES_SQL = {
+    True: query("bookshelves.profile_shelves_all", """
+        SELECT bookshelf_id, shelf_name, description, is_public, created_at
+        FROM bookshelf
+        WHERE profile_id = :pid
+        ORDER BY created_at DESC
+    """),
+    False: query("bookshelves.profile_shelves_public", """
+        SELECT bookshelf_id, shelf_name, description, is_public, created_at
+        FROM bookshelf
+        WHERE profile_id = :pid AND is_public = TRUE
+        ORDER BY created_at DESC
+    """),
+}
+
+BOOKSHELF_SQL = query("bookshelves.bookshelf", """
+    SELECT bs.bookshelf_id, bs.profile_id, bs.shelf_name, bs.description,
+           bs.is_public, bs.created_at, p.username AS owner_username
+    FROM bookshelf bs
+    LEFT JOIN profile p ON bs.profile_id = p.profile_id
+    WHERE bs.bookshelf_id = :bsid
+""")
+
+# most recently added first
+SHELF_BOOKS_SQL = query("bookshelves.shelf_books", """
+    SELECT b.book_id AS id, b.title AS title, b.publication_year AS published_year, b.image_url
+    FROM contains_book cb
+    JOIN book b ON cb.book_id = b.book_id
+    WHERE cb.bookshelf_id = :bsid
+    ORDER BY cb.added_at DESC
+""")
+
+
+SHELF_SUMMARY = RowMapper("ShelfSummary", [
+    ("id", "bookshelf_id"), ("name", "shelf_name"), "description", "is_public", "created_at"])
+shelf_summaries = SHELF_SUMMARY.all
+
+SHELF = RowMapper("Shelf", [
+    ("id", "bookshelf_id"), "profile_id", ("name", "shelf_name"), "description", "is_public", "created_at",
+    "owner_username"])
+shelf_from_row = SHELF.one
@@ -0,0 +1,203 @@
+"""
+Per-book aggregates: review count, rating count / sum / average, a rating
+histogram and tracker counts by status, kept in the book_stats table
+(schema.py migration 8).
+
+The write paths apply deltas inside their own transaction: post_review and
+delete_review call record_review() with the review as it was and as it is
+now, and track_book / untrack_book do the same with record_tracking().
+post_review and track_book take lock_row() before reading the old row.
+Reads are a primary key lookup (load_stats) or a join in search.
+
+Repairs, or a backfill after loading reviews or tracking rows in bulk:
+
+    python bookstats.py rebuild              # every book
+    python bookstats.py rebuild --book-id 42
+"""
+from decimal import Decimal
+from sqlalchemy import text
+from queries import query
+
+# statuses offered by book_page.html, with the column counting each
+STATUS_COLUMNS = {
+    "planning": "planning_count",
+    "reading": "reading_count",
+    "on-hold": "on_hold_count",
+    "finished": "finished_count",
+}
+
+# ratings run 0.0 - 5.0; bucket n holds ratings in [n, n+1), with 5.0 in bucket 5
+RATING_BUCKETS = 6
+BUCKET_COLUMNS = ["ratings_%d" % n for n in range(RATING_BUCKETS)]
+
+STAT_COLUMNS = (["review_count", "rating_count", "rating_sum"] + BUCKET_COLUMNS
+                + ["tracker_count"] + list(STATUS_COLUMNS.values()))
+
+DELTA_SQL = query("bookstats.delta", """
+    INSERT INTO book_stats (book_id, %s)
+    VALUES (:book_id, %s)
+    ON CONFLICT (book_id) DO UPDATE SET %s
+""" % (
+    ", ".join(STAT_COLUMNS),
+    ", ".join(":" + c for c in STAT_COLUMNS),
+    ", ".join("%s = book_stats.%s + EXCLUDED.%s" % (c, c, c) for c in STAT_COLUMNS),
+))
+
+STATS_SQL = query("bookstats.stats", """
+    SELECT %s, rating_sum / NULLIF(rating_count, 0) AS avg_rating
+    FROM book_stats
+    WHERE book_id = :book_id
+""" % ", ".join(STAT_COLUMNS))
+
+# A first review or tracking row does not exist yet, so FOR UPDATE below locks
+# nothing and two concurrent first posts (a double submit) would both see "no
+# row" and count it twice. Write paths take this transaction-scoped lock on
+# (profile, book) first, which serialises them until the first one commits.
+ROW_LOCK_SQL = query("bookstats.row_lock",
+                     "SELECT pg_advisory_xact_lock(CAST(:pid AS integer), CAST(:bid AS integer))")
+
+# the row a write path is about to change, locked until its transaction ends
+REVIEW_RATING_SQL = query("bookstats.review_rating", "SELECT rating FROM reviews WHERE profile_id = :pid AND book_id = :bid FOR UPDATE")
+TRACKING_ROW_SQL = query("bookstats.tracking_row", """
+    SELECT status, current_page, finish_date FROM is_tracking
+    WHERE profile_id = :pid AND book_id = :bid
+    FOR UPDATE
+""")
+
+_REBUILD_SELECT = """
+    SELECT b.book_id,
+           COALESCE(r.review_count, 0), COALESCE(r.rating_count, 0), COALESCE(r.rating_sum, 0),
+           %s,
+           COALESCE(t.tracker_count, 0),
+           %s
+    FROM book b
+    LEFT JOIN (
+        SELECT book_id, COUNT(*) AS review_count, COUNT(rating) AS rating_count, SUM(rating) AS rating_sum,
+               %s
+        FROM reviews GROUP BY book_id
+    ) r ON r.book_id = b.book_id
+    LEFT JOIN (
+        SELECT book_id, COUNT(*) AS tracker_count,
+               %s
+        FROM is_tracking GROUP BY book_id
+    ) t ON t.book_id = b.book_id
+    WHERE (r.book_id IS NOT NULL OR t.book_id IS NOT NULL) %%s
+""" % (
+    ", ".join("COALESCE(r.%s, 0)" % c for c in BUCKET_COLUMNS),
+    ", ".join("COALESCE(t.%s, 0)" % c for c in STATUS_COLUMNS.values()),
+    ", ".join("COUNT(rating) FILTER (WHERE LEAST(FLOOR(rating), %d) = %d) AS %s" % (RATING_BUCKETS - 1, n, c)
+              for n, c in enumerate(BUCKET_COLUMNS)),
+    ", ".join("COUNT(*) FILTER (WHERE status = '%s') AS %s" % (s, c) for s, c in STATUS_COLUMNS.items()),
+)
+
+REBUILD_ALL_SQL = [
+    query("bookstats.rebuild_all_delete", "DELETE FROM book_stats"),
+    query("bookstats.rebuild_all_insert", "INSERT INTO book_stats (book_id, %s) %s" % (", ".join(STAT_COLUMNS), _REBUILD_SELECT % "")),
+]
+
+REBUILD_BOOK_SQL = [
+    query("bookstats.rebuild_book_delete", "DELETE FROM book_stats WHERE book_id = :book_id"),
+    query("bookstats.rebuild_book_insert", "INSERT INTO book_stats (book_id, %s) %s"
+          % (", ".join(STAT_COLUMNS), _REBUILD_SELECT % "AND b.book_id = :book_id")),
+]
+
+
+def _bucket(rating):
+    return BUCKET_COLUMNS[min(int(rating), RATING_BUCKETS - 1)]
+
+
+def _review_part(delta, rating, sign):
+    delta["review_count"] += sign
+    if rating is not None:
+        delta["rating_count"] += sign
+        delta["rating_sum"] += sign * Decimal(str(rating))
+        delta[_bucket(rating)] += sign
+
+
+def _tracking_part(delta, status, sign):
+    delta["tracker_count"] += sign
+    if status in STATUS_COLUMNS:
+        delta[STATUS_COLUMNS[status]] += sign
+
+
+def apply_delta(conn, book_id, delta):
+    if any(delta.values()):
+        conn.execute(DELTA_SQL, dict(delta, book_id=book_id))
+
+
+def lock_row(conn, profile_id, book_id):
+    """Serialise writes to one user's review / tracking row of a book; call before reading the old row."""
+    conn.execute(ROW_LOCK_SQL, {"pid": profile_id, "bid": book_id})
+
+
+def record_review(conn, book_id, old, new):
+    """
+    Apply the change from review row old to review row new (either may be
+    None for "no review"; rows only need a rating attribute).
+    """
+    delta = dict.fromkeys(STAT_COLUMNS, 0)
+    if old is not None:
+        _review_part(delta, old.rating, -1)
+    if new is not None:
+        _review_part(delta, new.rating, +1)
+    apply_delta(conn, book_id, delta)
+
+
+def record_tracking(conn, book_id, old, new):
+    """Same as record_review() for is_tracking rows (which need a status attribute)."""
+    delta = dict.fromkeys(STAT_COLUMNS, 0)
+    if old is not None:
+        _tracking_part(delta, old.status, -1)
+    if new is not None:
+        _tracking_part(delta, new.status, +1)
+    apply_delta(conn, book_id, delta)
+
+
+def stats_from_row(row):
+    """Shape a STATS_SQL row (or None for a book nobody has reviewed or tracked) for the templates."""
+    if row is None:
+        return {
+            "review_count": 0, "rating_count": 0, "avg_rating": None, "tracker_count": 0,
+            "histogram": [(n, 0) for n in range(RATING_BUCKETS)],
+            "trackers": [(s, 0) for s in STATUS_COLUMNS],
+        }
+    return {
+        "review_count": row.review_count,
+        "rating_count": row.rating_count,
+        "avg_rating": round(float(row.avg_rating), 2) if row.avg_rating is not None else None,
+        "tracker_count": row.tracker_count,
+        "histogram": [(n, getattr(row, c)) for n, c in enumerate(BUCKET_COLUMNS)],
+        "trackers": [(s, getattr(row, c)) for s, c in STATUS_COLUMNS.items()],
+    }
+
+
+def load_stats(conn, book_id):
+    return stats_from_row(conn.execute(STATS_SQL, {"book_id": book_id}).fetchone())
+
+
+def rebuild(conn, book_id=None):
+    """Recompute book_stats from reviews and is_tracking, for one book or all of them."""
+    statements = REBUILD_ALL_SQL if book_id is None else REBUILD_BOOK_SQL
+    for stmt in statements:
+        conn.execute(stmt, {"book_id": book_id})
+
+
+if __name__ == "__main__":
+    import click
+    from db import DATABASEURI, make_engine
+
+    @click.group()
+    def cli():
+        """Maintenance for the book_stats table."""
+
+    @cli.command('rebuild')
+    @click.option('--book-id', type=int, default=None)
+    def rebuild_cmd(book_id):
+        """Recompute book_stats from scratch."""
+        with make_engine(DATABASEURI).connect() as conn:
+            with conn.begin():
+                rebuild(conn, book_id)
+                count = conn.execute(text("SELECT COUNT(*) FROM book_stats")).scalar()
+        print("book_stats rebuilt: %d rows" % count)
+
+    cli()
@@ -0,0 +1,115 @@
+"""
+Catalog reads shared by the book routes.
+
+The catalog part of a book page (the book row, its authors and its genres)
+is fetched in one query using JSON aggregation and held in a per-worker
+TTL/LRU cache keyed by book_id. The app itself never writes books,
+authors or genres (only importer.py does, from its own process), so
+nothing invalidates entries: a changed book, author name or genre list
+shows up within BOOK_CACHE_TTL seconds, or at once after a HUP of the
+master. Code that needs the current row (readingstats.py deltas, say)
+reads it in its own transaction instead of through get_book().
+"""
+import json
+import os
+from queries import query
+from cache import TTLCache
+from records import RowMapper
+
+BOOK_CACHE_SIZE = int(os.environ.get("BOOK_CACHE_SIZE", 10000))
+BOOK_CACHE_TTL = int(os.environ.get("BOOK_CACHE_TTL", 300))
+
+book_cache = TTLCache(maxsize=BOOK_CACHE_SIZE, ttl=BOOK_CACHE_TTL)
+
+BOOK_SQL = query("catalog.book", '''
+    SELECT
+        b.book_id, b.title, b.publication_year, b.image_url, b.summary, b.page_count, b.lang,
+        COALESCE((
+            SELECT json_agg(json_build_object('id', a.author_id, 'name', a.name))
+            FROM written_by wb
+            JOIN author a ON a.author_id = wb.author_id
+            WHERE wb.book_id = b.book_id
+        ), '[]'::json) AS authors,
+        COALESCE((
+            SELECT json_agg(g.genre_name ORDER BY g.genre_name)
+            FROM categorized_as ca
+            JOIN genre g ON ca.genre_id = g.genre_id
+            WHERE ca.book_id = b.book_id
+        ), '[]'::json) AS genres
+    FROM book b
+    WHERE b.book_id = :book_id
+''')
+
+
+def _json_list(value):
+    # psycopg2 decodes json columns; asyncpg hands them back as text
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or []
+
+
+def book_from_row(row):
+    return {
+        "id": row.book_id,
+        "title": row.title,
+        "published_year": row.publication_year,
+        "image_url": (row.image_url or "").strip().strip("'\""),
+        "summary": row.summary,
+        "page_count": row.page_count,
+        "language": row.lang,
+        "authors": _json_list(row.authors),
+        "genres": _json_list(row.genres),
+    }
+
+
+def load_book(conn, book_id):
+    """Fetch book + authors + genres in a single round trip. Returns None if there is no such book."""
+    row = conn.execute(BOOK_SQL, {"book_id": book_id}).fetchone()
+    if row is None:
+        return None
+    return book_from_row(row)
+
+
+def get_book(conn, book_id):
+    """
+    Read-through cached load_book(). Returns a fresh top-level dict each
+    call, so routes may add keys without touching the cached copy.
+    """
+    book = book_cache.get_or_load(book_id, lambda: load_book(conn, book_id))
+    return dict(book) if book is not None else None
+
+
+TRACKING_SQL = query("catalog.tracking", '''
+    SELECT profile_id, status, current_page, start_date, finish_date
+    FROM is_tracking
+    WHERE profile_id = :pid AND book_id = :bid
+''')
+
+
+TRACKING = RowMapper("Tracking", ["profile_id", "status", "current_page", "start_date", "finish_date"])
+tracking_from_row = TRACKING.one
+
+
+AUTHOR_SQL = query("catalog.author", "SELECT author_id, name, birthday, nationality FROM author WHERE author_id = :aid")
+
+AUTHOR_BOOKS_SQL = query("catalog.author_books", '''
+    SELECT b.book_id AS id,
+           b.title AS title,
+           b.publication_year AS published_year,
+           b.image_url AS image_url
+    FROM book b
+    JOIN written_by wb ON b.book_id = wb.book_id
+    WHERE wb.author_id = :aid
+    ORDER BY b.publication_year DESC NULLS LAST
+''')
+
+IS_FAVORITE_SQL = query("catalog.is_favorite", "SELECT 1 FROM has_favorite WHERE profile_id=:pid AND author_id=:aid")
+
+
+AUTHOR = RowMapper("Author", ["author_id", "name", "birthday", "nationality"])
+author_from_row = AUTHOR.one
+
+# a book as shown in author / bookshelf / recommendation card lists
+BOOK_CARD = RowMapper("BookCard", ["id", "title", "published_year", "image_url"])
+book_card_from_row = BOOK_CARD.one
+book_cards = BOOK_CARD.all
@@ -0,0 +1,197 @@
+"""
+Challenge reads shared by the challenge list and challenge pages, and
+challenge progress derived from reading activity.
+
+A participation's progress is what the user has finished inside the
+challenge window (starts_at .. ends_at, by is_tracking.finish_date; open
+ends are unbounded), restricted to challenge.genre_id when one is set:
+one per book, or the book's page_count for "pages" challenges.
+
+track_book / untrack_book call record_challenge_progress() with the
+tracking row as it was and as it is now; every active or completed
+participation of the user moves in one UPDATE, which also flips status
+between active and completed. join_challenge recomputes the new
+participation from history. Backfills and repairs:
+
+    python challenges.py recompute                    # every participation
+    python challenges.py recompute --challenge-id 7
+"""
+from queries import query
+from records import RowMapper
+
+_CHALLENGE_SQL = """
+    SELECT c.challenge_id, c.name, c.description, c.starts_at, c.ends_at,
+           c.goal_type, c.goal_value, c.genre_id, g.genre_name
+    FROM challenge c
+    LEFT JOIN genre g ON c.genre_id = g.genre_id
+    %s
+"""
+
+CHALLENGES_SQL = query("challenges.challenges", _CHALLENGE_SQL % "ORDER BY c.starts_at DESC")
+CHALLENGE_SQL = query("challenges.challenge", _CHALLENGE_SQL % "WHERE c.challenge_id = :cid")
+
+USER_PARTICIPATION_SQL = query("challenges.user_participation", """
+    SELECT challenge_id, current_progress, status
+    FROM participates_in
+    WHERE profile_id = :pid
+""")
+
+PARTICIPATION_DETAIL_SQL = query("challenges.participation_detail", """
+    SELECT profile_id, current_progress, joined_at, status
+    FROM participates_in
+    WHERE profile_id = :pid AND challenge_id = :cid
+""")
+
+
+CHALLENGE = RowMapper("Challenge", [
+    ("id", "challenge_id"), "name", "description", "starts_at", "ends_at", "goal_type", "goal_value",
+    "genre_id", "genre_name"])
+challenge_from_row = CHALLENGE.one
+challenges_from_rows = CHALLENGE.all
+
+PARTICIPATION = RowMapper("Participation", ["current_progress", "status"])
+PARTICIPATION_DETAIL = RowMapper("ParticipationDetail", ["profile_id", "current_progress", "joined_at", "status"])
+
+
+def participation_by_challenge(rows):
+    """challenge_id -> {current_progress, status} for one user's participates_in rows."""
+    rows = rows if isinstance(rows, list) else list(rows)
+    return dict(zip((r.challenge_id for r in rows), PARTICIPATION.all(rows)))
+
+
+# goal types measured in pages; every other goal type counts books
+PAGE_GOAL_TYPES = ("pages",)
+
+# dropped participations keep the progress they had when the user left
+COUNTED_STATUSES = ("active", "completed")
+
+_AMOUNT = "CASE WHEN c.goal_type IN (%s) THEN COALESCE(b.page_count, 0) ELSE 1 END" % (
+    ", ".join("'%s'" % t for t in PAGE_GOAL_TYPES))
+
+_COUNTED = "p.status IN (%s)" % ", ".join("'%s'" % s for s in COUNTED_STATUSES)
+
+# a finish on date d counts toward challenge c
+_IN_WINDOW = """
+    (c.starts_at IS NULL OR %(d)s >= c.starts_at)
+    AND (c.ends_at IS NULL OR %(d)s <= c.ends_at)
+    AND (c.genre_id IS NULL OR EXISTS (
+        SELECT 1 FROM categorized_as ca WHERE ca.book_id = %(book)s AND ca.genre_id = c.genre_id))
+"""
+
+# new progress and status, from the progress expression np
+_SET_PROGRESS = """
+    current_progress = %(np)s,
+    status = CASE WHEN %(np)s >= COALESCE(c.goal_value, 0) THEN 'completed' ELSE 'active' END
+"""
+
+# One tracking change, applied to all of the user's challenges at once:
+# the old row's finish (if any) comes off and the new one goes on.
+PROGRESS_DELTA_SQL = query("challenges.progress_delta", """
+    WITH finishes (finished_on, sign) AS (
+        SELECT CAST(:old_on AS date), -1 WHERE :old_finished
+        UNION ALL
+        SELECT CAST(:new_on AS date), 1 WHERE :new_finished
+    ),
+    deltas AS (
+        SELECT p.challenge_id, SUM(f.sign * %s) AS delta
+        FROM participates_in p
+        JOIN challenge c ON c.challenge_id = p.challenge_id
+        JOIN book b ON b.book_id = :bid
+        CROSS JOIN finishes f
+        WHERE p.profile_id = :pid AND %s AND %s
+        GROUP BY p.challenge_id
+    )
+    UPDATE participates_in p SET %s
+    FROM deltas d, challenge c
+    WHERE p.profile_id = :pid AND p.challenge_id = d.challenge_id AND d.delta <> 0
+      AND c.challenge_id = p.challenge_id
+    RETURNING p.challenge_id, p.current_progress, p.status
+""" % (_AMOUNT, _COUNTED, _IN_WINDOW % {"d": "f.finished_on", "book": "b.book_id"},
+       _SET_PROGRESS % {"np": "GREATEST(COALESCE(p.current_progress, 0) + d.delta, 0)"}))
+
+# Full recompute from is_tracking, for every counted participation or a subset
+_RECOMPUTE_SQL = """
+    WITH progress AS (
+        SELECT p.profile_id, p.challenge_id, COALESCE(SUM(%s) FILTER (WHERE it.book_id IS NOT NULL), 0) AS total
+        FROM participates_in p
+        JOIN challenge c ON c.challenge_id = p.challenge_id
+        LEFT JOIN is_tracking it ON it.profile_id = p.profile_id AND it.status = 'finished' AND %s
+        LEFT JOIN book b ON b.book_id = it.book_id
+        WHERE %s %%s
+        GROUP BY p.profile_id, p.challenge_id
+    )
+    UPDATE participates_in p SET %s
+    FROM progress, challenge c
+    WHERE p.profile_id = progress.profile_id AND p.challenge_id = progress.challenge_id
+      AND c.challenge_id = p.challenge_id
+""" % (_AMOUNT, _IN_WINDOW % {"d": "it.finish_date", "book": "it.book_id"}, _COUNTED,
+       _SET_PROGRESS % {"np": "progress.total"})
+
+RECOMPUTE_ALL_SQL = query("challenges.recompute_all", _RECOMPUTE_SQL % "")
+RECOMPUTE_CHALLENGE_SQL = query("challenges.recompute_challenge", _RECOMPUTE_SQL % "AND p.challenge_id = :cid")
+RECOMPUTE_PARTICIPATION_SQL = query("challenges.recompute_participation", _RECOMPUTE_SQL % "AND p.challenge_id = :cid AND p.profile_id = :pid")
+
+
+# a manual correction from the challenge page: an absolute value or a delta
+MANUAL_PROGRESS_SQL = query("challenges.manual_progress", """
+    UPDATE participates_in p SET %s
+    FROM challenge c
+    WHERE p.profile_id = :pid AND p.challenge_id = :cid AND c.challenge_id = p.challenge_id
+""" % (_SET_PROGRESS % {"np": "GREATEST(COALESCE(CAST(:absolute AS integer), "
+                              "COALESCE(p.current_progress, 0) + COALESCE(CAST(:delta AS integer), 0)), 0)"}))
+
+
+def _finish(row):
+    """(finished?, finish_date) of an is_tracking row or None."""
+    if row is None or row.status != "finished":
+        return False, None
+    return True, row.finish_date
+
+
+def record_challenge_progress(conn, profile_id, book_id, old, new):
+    """
+    Apply the change from tracking row old to new (either may be None; rows
+    need status and finish_date) to the user's challenges. Returns the ids
+    of the challenges whose progress changed.
+    """
+    old_finished, old_on = _finish(old)
+    new_finished, new_on = _finish(new)
+    if not old_finished and not new_finished:
+        return []
+    rows = conn.execute(PROGRESS_DELTA_SQL, {
+        "pid": profile_id, "bid": book_id,
+        "old_finished": old_finished, "old_on": old_on,
+        "new_finished": new_finished, "new_on": new_on,
+    }).fetchall()
+    return [r.challenge_id for r in rows]
+
+
+def recompute_progress(conn, challenge_id=None, profile_id=None):
+    """Recompute progress and status from is_tracking; returns the number of participations updated."""
+    if challenge_id is None:
+        result = conn.execute(RECOMPUTE_ALL_SQL)
+    elif profile_id is None:
+        result = conn.execute(RECOMPUTE_CHALLENGE_SQL, {"cid": challenge_id})
+    else:
+        result = conn.execute(RECOMPUTE_PARTICIPATION_SQL, {"cid": challenge_id, "pid": profile_id})
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    import click
+    from db import DATABASEURI, make_engine
+
+    @click.group()
+    def cli():
+        """Maintenance for challenge progress."""
+
+    @cli.command('recompute')
+    @click.option('--challenge-id', type=int, default=None)
+    def recompute_cmd(challenge_id):
+        """Recompute participates_in progress from reading activity."""
+        with make_engine(DATABASEURI).connect() as conn:
+            with conn.begin():
+                count = recompute_progress(conn, challenge_id)
+        print("challenge progress recomputed: %d participations" % count)
+
+    cli()
@@ -0,0 +1,451 @@
+"""
+Synthetic dataset for benchmarks: fills a local, migrated Postgres with
+realistic, skewed data through COPY.
+
+    python datagen.py generate                     # the full size below
+    python datagen.py generate --scale 0.01        # 1% of every table
+    python datagen.py generate --reviews 5000000 --seed 7
+    DATABASE_URL=postgresql://localhost/bench python datagen.py generate --truncate
+
+At --scale 1: 1M books, 200k authors, 500k profiles, 20M reviews, 5M
+follows, 750k shelves holding 6M books, 5M tracked books, 1M favorite
+authors and 40 challenges with 250k participations.
+
+The skew is what the app's indexes and caches see on a real site:
+
+  * books are drawn with Zipfian popularity (exponent BOOK_ZIPF) over a
+    random permutation of the ids, so reviews, shelf entries and tracking
+    pile up on a few thousand books whose ids say nothing about it;
+  * authors, genres, favorite authors and challenges are Zipfian too;
+  * how much a profile does (reviews, follows, shelves, ...) is
+    log-normal: most readers have a handful of rows, a few have thousands;
+  * followed accounts are Zipfian, so the top ones have far more than
+    feed.FANOUT_MAX_FOLLOWERS followers; finish() records those in
+    feed_pull_actors, so their events take the pull side of the feed.
+
+Rows are generated with numpy a block of owners at a time, so memory
+depends on BLOCK_ROWS rather than on the table sizes. Primary keys are
+de-duplicated inside a block, and blocks partition the owners, so no two
+blocks collide.
+
+After loading, everything the app maintains itself is derived in bulk:
+search vectors (with importer.py's trigger bypass), book_stats,
+reading_stats, challenge progress and the id block sequences, then
+ANALYZE. The home feed starts empty (the app records events as people
+act; only the pulled accounts are derived), review likes_count is generated without review_likes rows, and the
+recommendation tables are left to `python recommend.py build`.
+
+The database must be fully migrated and empty; --truncate empties every
+table of the app first.
+"""
+import datetime
+import numpy as np
+from sqlalchemy import text
+from db import DATABASEURI, make_engine
+from importer import copy_text
+from recommend import Timer
+
+SIZES = {
+    "books": 1000000,
+    "authors": 200000,
+    "profiles": 500000,
+    "reviews": 20000000,
+    "follows": 5000000,
+    "shelves": 750000,
+    "shelf_books": 6000000,
+    "tracking": 5000000,
+    "favorites": 1000000,
+    "challenges": 40,
+    "participations": 250000,
+}
+
+BLOCK_ROWS = 1000000
+
+BOOK_ZIPF = 1.0
+AUTHOR_ZIPF = 1.1
+PROFILE_ZIPF = 1.1
+# log-normal sigma of rows per owner
+ACTIVITY_SIGMA = 1.5
+
+# share of books with a second author, of reviews with text, of public shelves
+CO_AUTHORED = 0.15
+REVIEW_TEXT = 0.25
+PUBLIC_SHELVES = 0.8
+
+GENRES = [
+    "Fiction", "Fantasy", "Science Fiction", "Mystery", "Thriller", "Romance", "Historical Fiction",
+    "Horror", "Young Adult", "Children", "Classics", "Poetry", "Biography", "Memoir", "History",
+    "Science", "Philosophy", "Psychology", "Self Help", "Business", "Travel", "Cooking", "Art",
+    "Graphic Novels", "Dystopian", "Adventure", "Humor", "Religion", "Politics", "Nature",
+]
+
+ADJECTIVES = [
+    "Silent", "Hidden", "Last", "Broken", "Golden", "Lost", "Secret", "Dark", "Burning", "Quiet",
+    "Wild", "Distant", "Crimson", "Forgotten", "Endless", "Glass", "Hollow", "Iron", "Winter", "Bright",
+    "Shattered", "Painted", "Wandering", "Sleeping", "Northern", "Midnight", "Restless", "Little",
+]
+NOUNS = [
+    "River", "Garden", "Kingdom", "House", "City", "Sea", "Mountain", "Road", "Forest", "Island",
+    "Daughter", "Thief", "Queen", "Hunter", "Library", "Storm", "Shadow", "Fire", "Star", "Orchard",
+    "Machine", "Letter", "Promise", "Harbor", "Crown", "Witness", "Song", "Map", "Bridge", "Clock",
+]
+PLACES = [
+    "the North", "Avalon", "the Deep", "Tomorrow", "the Lost Coast", "Ashes", "Paris", "the Moon",
+    "Summer", "Bones", "the Empire", "Eden", "Salt", "Smoke", "the Valley",
+]
+FIRST_NAMES = [
+    "Anna", "James", "Maria", "John", "Elena", "David", "Sofia", "Michael", "Olivia", "Daniel",
+    "Emma", "Lucas", "Chloe", "Henry", "Grace", "Samuel", "Nora", "Leo", "Alice", "Victor",
+    "Hannah", "Oscar", "Iris", "Felix", "Clara", "Hugo", "Rosa", "Jonas", "Mei", "Ravi",
+]
+LAST_NAMES = [
+    "Smith", "Garcia", "Muller", "Rossi", "Kim", "Nguyen", "Okafor", "Silva", "Novak", "Dubois",
+    "Tanaka", "Ivanova", "Hughes", "Larsen", "Kowalski", "Haddad", "Moreau", "Costa", "Fischer", "Singh",
+    "Bauer", "Lindqvist", "Ferreira", "Murphy", "Chen", "Petrov", "Adeyemi", "Castillo", "Berg", "Wright",
+]
+NATIONALITIES = ["American", "British", "Canadian", "French", "German", "Italian", "Japanese", "Nigerian",
+                 "Brazilian", "Indian", "Korean", "Spanish", "Swedish", "Polish", "Irish"]
+LANGUAGES = ["en", "en", "en", "en", "en", "en", "es", "fr", "de", "it", "ja", "pt"]
+SUMMARY_PHRASES = [
+    "A sweeping story of love and loss.", "Nothing is what it seems.", "A family secret comes to light.",
+    "An unlikely friendship changes everything.", "The war reaches a quiet village.",
+    "A detective races against time.", "Set in a world where magic is forbidden.",
+    "A young woman leaves home for the city.", "Two rivals must work together.",
+    "An expedition into the unknown.", "A meditation on memory and time.", "The truth about a disappearance.",
+]
+REVIEW_PHRASES = [
+    "Loved it.", "Could not put it down.", "Slow start but worth it.", "Not for me.", "Beautifully written.",
+    "The ending surprised me.", "A bit too long.", "Great characters.", "Reread it twice.",
+    "Overhyped.", "Perfect for a rainy weekend.", "The second half drags.", "Will read everything by this author.",
+]
+SHELF_NAMES = ["Favourites", "To read", "Summer reads", "Book club", "Classics", "Comfort reads",
+               "Owned", "Borrowed", "Did not finish", "Reread", "Gift ideas", "Best of the year"]
+TRACKING_STATUSES = ["finished", "reading", "planning", "on-hold"]
+TRACKING_WEIGHTS = [0.5, 0.2, 0.25, 0.05]
+
+# every table of the app, for --truncate
+APP_TABLES = [
+    "review_likes", "reviews", "contains_book", "bookshelf", "is_tracking", "has_favorite", "follows",
+    "participates_in", "challenge_leaderboard_counts", "challenge_leaderboard_values",
+    "challenge_leaderboard_totals", "challenge", "written_by", "categorized_as",
+    "book_stats", "reading_stats", "book_similar", "user_recommendation", "timeline", "activity",
+    "feed_pull_actors", "book", "author", "genre", "profile",
+]
+
+
+class Zipf(object):
+    """Draws ids 1..n with Zipfian popularity over a random permutation of the ids."""
+
+    def __init__(self, rng, n, s):
+        self.rng = rng
+        self.n = n
+        weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** s
+        self.cdf = np.cumsum(weights)
+        self.cdf /= self.cdf[-1]
+        self.ids = rng.permutation(n) + 1
+
+    def draw(self, size):
+        ranks = np.searchsorted(self.cdf, self.rng.random(size), side="right")
+        return self.ids[np.minimum(ranks, self.n - 1)]
+
+
+def activity(rng, owners, total, cap=None):
+    """Log-normal rows per owner (owners 1..n), summing to about total."""
+    weights = rng.lognormal(0.0, ACTIVITY_SIGMA, owners)
+    counts = np.floor(weights / weights.sum() * total + rng.random(owners)).astype(np.int64)
+    if cap:
+        np.minimum(counts, cap, out=counts)
+    return counts
+
+
+def owner_pairs(counts, targets, block=BLOCK_ROWS):
+    """
+    Yield (owner_ids, target_ids) arrays of distinct pairs, a block of owners
+    at a time: owner i (1-based) gets counts[i - 1] targets drawn from targets.
+    """
+    ends = np.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        base = ends[first - 1] if first else 0
+        last = max(int(np.searchsorted(ends, base + block, side="right")), first + 1)
+        owners = np.repeat(np.arange(first + 1, last + 1), counts[first:last])
+        keys = np.unique(owners * (targets.n + 1) + targets.draw(len(owners)))
+        yield keys // (targets.n + 1), keys % (targets.n + 1)
+        first = last
+
+
+def strs(values):
+    return values.astype(str).tolist()
+
+
+def pick(rng, words, size):
+    return np.asarray(words)[rng.integers(0, len(words), size)]
+
+
+def timestamps(rng, size, days):
+    """Times within the last days, in a format COPY accepts."""
+    now = np.datetime64(datetime.datetime.now().replace(microsecond=0), "s")
+    return strs(now - rng.integers(0, days * 86400, size).astype("timedelta64[s]"))
+
+
+def dates(rng, size, days):
+    return strs((np.datetime64(datetime.date.today(), "D") - rng.integers(0, days, size).astype("timedelta64[D]")))
+
+
+def copy(conn, table, columns, rows):
+    """COPY equal-length lists of strings ("\\N" is NULL) into table."""
+    copy_text(conn, table, columns, "".join("\t".join(row) + "\n" for row in zip(*rows)))
+
+
+def with_nulls(rng, values, share_null):
+    out = list(values)
+    for i in np.flatnonzero(rng.random(len(out)) < share_null).tolist():
+        out[i] = "\\N"
+    return out
+
+
+def check_target(conn, truncate):
+    from schema import MIGRATIONS, applied_versions
+    pending = set(v for v, _, _ in MIGRATIONS) - applied_versions(conn)
+    if pending:
+        raise SystemExit("schema is missing migrations %s; run `python schema.py migrate` first" % sorted(pending))
+    if truncate:
+        conn.execute(text("TRUNCATE %s CASCADE" % ", ".join(APP_TABLES)))
+    elif conn.execute(text("SELECT EXISTS (SELECT 1 FROM book) OR EXISTS (SELECT 1 FROM profile)")).scalar():
+        raise SystemExit("the database already has books or profiles; use --truncate to replace them")
+
+
+def generate_catalog(conn, rng, sizes):
+    n_books, n_authors, n_genres = sizes["books"], sizes["authors"], len(GENRES)
+    copy(conn, "genre", ("genre_id", "genre_name"), [strs(np.arange(1, n_genres + 1)), GENRES])
+
+    copy(conn, "author", ("author_id", "name", "birthday", "nationality"), [
+        strs(np.arange(1, n_authors + 1)),
+        strs(np.char.add(np.char.add(pick(rng, FIRST_NAMES, n_authors), " "), pick(rng, LAST_NAMES, n_authors))),
+        dates(rng, n_authors, 100 * 365),
+        with_nulls(rng, pick(rng, NATIONALITIES, n_authors).tolist(), 0.2),
+    ])
+
+    # the search vector triggers skip this transaction; finish() computes them once per book
+    conn.execute(text("SET LOCAL bookshelf.bulk_load = 'on'"))
+    authors = Zipf(rng, n_authors, AUTHOR_ZIPF)
+    genres = Zipf(rng, n_genres, 1.0)
+    this_year = datetime.date.today().year
+    for start in range(1, n_books + 1, BLOCK_ROWS):
+        ids = np.arange(start, min(start + BLOCK_ROWS, n_books + 1))
+        n = len(ids)
+        titles = np.char.add(np.char.add(np.char.add("The ", pick(rng, ADJECTIVES, n)), " "), pick(rng, NOUNS, n))
+        # a suffix array rather than assigning into titles, whose fixed width would cut the suffix off
+        places = np.where(rng.random(n) < 0.3, np.char.add(" of ", pick(rng, PLACES, n)), "")
+        titles = np.char.add(titles, places)
+        summaries = np.char.add(np.char.add(pick(rng, SUMMARY_PHRASES, n), " "), pick(rng, SUMMARY_PHRASES, n))
+        years = np.clip(this_year - rng.exponential(25, n).astype(np.int64), 1800, this_year)
+        pages = np.clip(rng.normal(320, 120, n).astype(np.int64), 40, 1500)
+        copy(conn, "book", ("book_id", "title", "publication_year", "image_url", "summary", "page_count", "lang"), [
+            strs(ids), titles.tolist(), strs(years), ["\\N"] * n, summaries.tolist(), strs(pages),
+            pick(rng, LANGUAGES, n).tolist(),
+        ])
+
+        per_book = 1 + (rng.random(n) < CO_AUTHORED)
+        keys = np.unique(np.repeat(ids, per_book) * (n_authors + 1) + authors.draw(int(per_book.sum())))
+        copy(conn, "written_by", ("book_id", "author_id"), [strs(keys // (n_authors + 1)), strs(keys % (n_authors + 1))])
+
+        per_book = rng.integers(1, 4, n)
+        keys = np.unique(np.repeat(ids, per_book) * (n_genres + 1) + genres.draw(int(per_book.sum())))
+        copy(conn, "categorized_as", ("book_id", "genre_id"), [strs(keys // (n_genres + 1)), strs(keys % (n_genres + 1))])
+
+
+def generate_profiles(conn, rng, sizes):
+    n = sizes["profiles"]
+    ids = np.arange(1, n + 1)
+    copy(conn, "profile", ("profile_id", "username", "joined_at"), [
+        strs(ids), strs(np.char.add("reader", ids.astype(str))), timestamps(rng, n, 6 * 365),
+    ])
+
+
+def generate_reviews(conn, rng, sizes, books):
+    counts = activity(rng, sizes["profiles"], sizes["reviews"], cap=max(sizes["books"] // 50, 1))
+    ratings = np.array(["1.0", "2.0", "3.0", "3.5", "4.0", "4.5", "5.0", "\\N"])
+    weights = [0.03, 0.06, 0.15, 0.1, 0.3, 0.11, 0.2, 0.05]
+    rows = 0
+    for pids, bids in owner_pairs(counts, books):
+        n = len(pids)
+        texts = pick(rng, REVIEW_PHRASES, n).tolist()
+        likes = np.minimum(rng.zipf(2.0, n) - 1, 10000)
+        copy(conn, "reviews", ("profile_id", "book_id", "rating", "review_text", "reviewed_at", "likes_count"), [
+            strs(pids), strs(bids), ratings[rng.choice(len(ratings), n, p=weights)].tolist(),
+            with_nulls(rng, texts, 1 - REVIEW_TEXT), timestamps(rng, n, 3 * 365), strs(likes),
+        ])
+        rows += n
+    return rows
+
+
+def generate_social(conn, rng, sizes, books):
+    n_profiles = sizes["profiles"]
+    follows = 0
+    for followers, followed in owner_pairs(activity(rng, n_profiles, sizes["follows"], cap=n_profiles // 2),
+                                           Zipf(rng, n_profiles, PROFILE_ZIPF)):
+        keep = followers != followed
+        copy(conn, "follows", ("follower_id", "following_id"), [strs(followers[keep]), strs(followed[keep])])
+        follows += int(keep.sum())
+
+    favorites = 0
+    for pids, aids in owner_pairs(activity(rng, n_profiles, sizes["favorites"], cap=200),
+                                  Zipf(rng, sizes["authors"], AUTHOR_ZIPF)):
+        copy(conn, "has_favorite", ("profile_id", "author_id"), [strs(pids), strs(aids)])
+        favorites += len(pids)
+
+    tracking = 0
+    for pids, bids in owner_pairs(activity(rng, n_profiles, sizes["tracking"], cap=max(sizes["books"] // 50, 1)),
+                                  books):
+        n = len(pids)
+        status = np.asarray(TRACKING_STATUSES)[rng.choice(len(TRACKING_STATUSES), n, p=TRACKING_WEIGHTS)]
+        started = np.datetime64(datetime.date.today(), "D") - rng.integers(30, 3 * 365, n).astype("timedelta64[D]")
+        finished = started + rng.integers(3, 60, n).astype("timedelta64[D]")
+        finished_list = strs(finished)
+        for i in np.flatnonzero(status != "finished").tolist():
+            finished_list[i] = "\\N"
+        copy(conn, "is_tracking", ("profile_id", "book_id", "status", "current_page", "start_date", "finish_date"), [
+            strs(pids), strs(bids), status.tolist(), strs(rng.integers(0, 400, n)), strs(started), finished_list,
+        ])
+        tracking += n
+    return follows, favorites, tracking
+
+
+def generate_shelves(conn, rng, sizes, books):
+    counts = activity(rng, sizes["profiles"], sizes["shelves"], cap=50)
+    owners = np.repeat(np.arange(1, len(counts) + 1), counts)
+    n = len(owners)
+    ids = np.arange(1, n + 1)
+    copy(conn, "bookshelf", ("bookshelf_id", "profile_id", "shelf_name", "description", "is_public", "created_at"), [
+        strs(ids), strs(owners), pick(rng, SHELF_NAMES, n).tolist(), ["\\N"] * n,
+        np.where(rng.random(n) < PUBLIC_SHELVES, "t", "f").tolist(), timestamps(rng, n, 3 * 365),
+    ])
+    entries = 0
+    for shelf_ids, bids in owner_pairs(activity(rng, n, sizes["shelf_books"], cap=2000), books):
+        copy(conn, "contains_book", ("bookshelf_id", "book_id", "added_at"), [
+            strs(shelf_ids), strs(bids), timestamps(rng, len(shelf_ids), 3 * 365),
+        ])
+        entries += len(shelf_ids)
+    return n, entries
+
+
+def generate_challenges(conn, rng, sizes):
+    n = max(sizes["challenges"], 1)
+    year = datetime.date.today().year
+    goal_pages = rng.random(n) < 0.3
+    genre = rng.integers(1, len(GENRES) + 1, n)
+    copy(conn, "challenge", ("challenge_id", "name", "description", "starts_at", "ends_at", "goal_type",
+                             "goal_value", "genre_id"), [
+        strs(np.arange(1, n + 1)),
+        ["%s challenge %d" % (GENRES[g - 1] if i % 3 == 0 else "Reading", i + 1) for i, g in enumerate(genre.tolist())],
+        ["Generated challenge"] * n,
+        ["%d-01-01" % year] * n,
+        ["%d-12-31" % year] * n,
+        np.where(goal_pages, "pages", "books").tolist(),
+        strs(np.where(goal_pages, rng.integers(2000, 20000, n), rng.integers(5, 100, n))),
+        ["%d" % g if i % 3 == 0 else "\\N" for i, g in enumerate(genre.tolist())],
+    ])
+    rows = 0
+    for pids, cids in owner_pairs(activity(rng, sizes["profiles"], sizes["participations"], cap=n),
+                                  Zipf(rng, n, 1.0)):
+        copy(conn, "participates_in", ("profile_id", "challenge_id", "current_progress", "status"), [
+            strs(pids), strs(cids), ["0"] * len(pids), ["active"] * len(pids),
+        ])
+        rows += len(pids)
+    return rows
+
+
+FINISH_SQL = [
+    "UPDATE book SET search_vector = book_search_vector(book_id, title, summary)",
+    "SELECT setval('profile_id_block_seq', (SELECT COALESCE(MAX(profile_id), 0) + 1 FROM profile), false)",
+    "SELECT setval('bookshelf_id_block_seq', (SELECT COALESCE(MAX(bookshelf_id), 0) + 1 FROM bookshelf), false)",
+]
+
+# accounts past the fan-out limit, as feed.record_event() would have marked them
+PULL_ACTORS_SQL = """
+    INSERT INTO feed_pull_actors (profile_id)
+    SELECT following_id FROM follows GROUP BY following_id HAVING COUNT(*) > :limit
+"""
+
+
+def finish(conn):
+    """Derive what the app maintains incrementally."""
+    import bookstats
+    import challenges
+    import feed
+    import readingstats
+    for stmt in FINISH_SQL:
+        conn.execute(text(stmt))
+    conn.execute(text(PULL_ACTORS_SQL), {"limit": feed.FANOUT_MAX_FOLLOWERS})
+    bookstats.rebuild(conn)
+    readingstats.recompute(conn)
+    challenges.recompute_progress(conn)
+
+
+def generate(engine, sizes, seed=0, truncate=False):
+    rng = np.random.default_rng(seed)
+    timer = Timer()
+    with engine.connect() as conn:
+        with conn.begin():
+            check_target(conn, truncate)
+        with conn.begin():
+            generate_catalog(conn, rng, sizes)
+        timer.phase("catalog")
+        with conn.begin():
+            generate_profiles(conn, rng, sizes)
+        timer.phase("profiles")
+        books = Zipf(rng, sizes["books"], BOOK_ZIPF)
+        with conn.begin():
+            reviews = generate_reviews(conn, rng, sizes, books)
+        timer.phase("reviews")
+        with conn.begin():
+            follows, favorites, tracking = generate_social(conn, rng, sizes, books)
+        timer.phase("social")
+        with conn.begin():
+            shelves, entries = generate_shelves(conn, rng, sizes, books)
+        timer.phase("shelves")
+        with conn.begin():
+            participations = generate_challenges(conn, rng, sizes)
+        timer.phase("challenges")
+        with conn.begin():
+            finish(conn)
+        timer.phase("derived tables")
+        # ANALYZE cannot run inside the transaction block the connection would open
+        conn.commit()
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("ANALYZE"))
+        timer.phase("analyze")
+    print("%d books, %d authors, %d profiles, %d reviews, %d follows, %d favorites, %d tracked, "
+          "%d shelves holding %d books, %d participations in %.1fs"
+          % (sizes["books"], sizes["authors"], sizes["profiles"], reviews, follows, favorites, tracking,
+             shelves, entries, participations, timer.total()))
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.group()
+    def cli():
+        """Synthetic benchmark data."""
+
+    @cli.command('generate')
+    @click.option('--scale', type=float, default=1.0, show_default=True, help='multiplies every default size')
+    @click.option('--seed', type=int, default=0, show_default=True)
+    @click.option('--truncate', is_flag=True, help='empty every table of the app first')
+    @click.option('--books', type=int)
+    @click.option('--authors', type=int)
+    @click.option('--profiles', type=int)
+    @click.option('--reviews', type=int)
+    @click.option('--follows', type=int)
+    @click.option('--shelves', type=int)
+    @click.option('--shelf-books', type=int)
+    @click.option('--tracking', type=int)
+    @click.option('--favorites', type=int)
+    @click.option('--challenges', type=int)
+    @click.option('--participations', type=int)
+    def generate_cmd(scale, seed, truncate, **given):
+        """Fill the database (DATABASEURI / DATABASE_URL) with generated data."""
+        sizes = dict((k, given[k] if given[k] is not None else max(int(v * scale), 1)) for k, v in SIZES.items())
+        generate(make_engine(DATABASEURI), sizes, seed, truncate)
+
+    cli()
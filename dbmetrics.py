@@ -0,0 +1,172 @@
+"""
+Per-request database instrumentation.
+
+instrument(engine) hooks the engine's cursor events. Between
+start_request() and finish_request() (server.py and aserver.py call them
+around every request) each statement run in the request's context is
+counted and timed, so that per route we get
+
+    app_db_queries_per_request     histogram of statements per request
+    app_db_seconds_per_request     histogram of database time per request
+    app_db_slow_queries_total      statements slower than SLOW_QUERY_MS
+    app_db_repeated_queries_total  requests that ran one statement shape
+                                   N_PLUS_ONE_THRESHOLD or more times (N+1)
+
+served with the named query totals (queries.py) at /metrics in the
+Prometheus text format. The request is tracked in a context variable, so
+the async pages' concurrent queries and Flask's worker threads each add
+to their own request; background threads (like flushes, the suggest load)
+only reach the slow-query log.
+
+Slow statements and the first N+1 seen per route and shape in a worker are
+written as one JSON object per line to SLOW_QUERY_LOG (stderr if unset),
+with the statement as written and its bound parameters.
+
+    SLOW_QUERY_MS          threshold of the slow-query log (default 100)
+    SLOW_QUERY_LOG         file the log is appended to (default stderr)
+    N_PLUS_ONE_THRESHOLD   repeats of one statement that flag a request (default 5)
+"""
+import contextvars
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from sqlalchemy import event
+from metrics import Counter, Histogram
+from queries import registry as query_registry
+
+
+def _env_number(name, default, kind):
+    try:
+        return kind(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+SLOW_QUERY_MS = _env_number("SLOW_QUERY_MS", 100, float)
+SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG")
+N_PLUS_ONE_THRESHOLD = _env_number("N_PLUS_ONE_THRESHOLD", 5, int)
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+DB_QUERIES = Histogram("app_db_queries_per_request", "Statements run per request.", ("route",),
+                       QUERY_COUNT_BUCKETS)
+DB_SECONDS = Histogram("app_db_seconds_per_request", "Database time per request, in seconds.", ("route",))
+SLOW_QUERIES = Counter("app_db_slow_queries_total", "Statements slower than SLOW_QUERY_MS.", ("route", "query"))
+REPEATED_QUERIES = Counter("app_db_repeated_queries_total",
+                           "Requests that ran one statement N_PLUS_ONE_THRESHOLD or more times.", ("route", "query"))
+
+
+class RequestQueries(object):
+    """What one request ran: statement count, database time and runs per statement shape."""
+
+    def __init__(self, route):
+        self.route = route
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = {}
+
+
+_current = contextvars.ContextVar("request_queries", default=None)
+
+_log_lock = threading.Lock()
+_log_file = None
+# (route, shape) pairs already reported as N+1 by this worker
+_reported = set()
+
+
+def _log(entry):
+    global _log_file
+    line = json.dumps(entry, default=str, sort_keys=True)
+    with _log_lock:
+        if _log_file is None:
+            _log_file = open(SLOW_QUERY_LOG, "a", buffering=1) if SLOW_QUERY_LOG else sys.stderr
+        _log_file.write(line + "\n")
+        _log_file.flush()
+
+
+def _shape(context):
+    # registered statements by name; anything else by its compiled text, whose parameters are placeholders
+    name = context.execution_options.get("query_name")
+    return name or " ".join(context.statement.split())[:200]
+
+
+def start_request(route):
+    """Track the statements of the request about to run; returns the token for finish_request()."""
+    return _current.set(RequestQueries(route))
+
+
+def finish_request(token):
+    """Stop tracking and record the request's totals. Returns its RequestQueries."""
+    stats = _current.get()
+    _current.reset(token)
+    if stats is None:
+        return None
+    DB_QUERIES.observe(stats.count, route=stats.route)
+    DB_SECONDS.observe(stats.seconds, route=stats.route)
+    for shape, runs in stats.shapes.items():
+        if runs < N_PLUS_ONE_THRESHOLD:
+            continue
+        REPEATED_QUERIES.inc(route=stats.route, query=shape)
+        if (stats.route, shape) not in _reported:
+            _reported.add((stats.route, shape))
+            _log({"event": "n_plus_one", "ts": datetime.datetime.now().isoformat(), "route": stats.route,
+                  "query": shape, "runs": runs, "statements": stats.count})
+    return stats
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.request_query_started = time.perf_counter()
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "request_query_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    current = _current.get()
+    if current is not None:
+        current.count += 1
+        current.seconds += elapsed
+        shape = _shape(context)
+        current.shapes[shape] = current.shapes.get(shape, 0) + 1
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        shape = _shape(context)
+        route = current.route if current is not None else None
+        SLOW_QUERIES.inc(route=route or "", query=shape)
+        _log({
+            "event": "slow_query",
+            "ts": datetime.datetime.now().isoformat(),
+            "route": route,
+            "query": context.execution_options.get("query_name"),
+            "ms": round(elapsed * 1000, 3),
+            "rows": cursor.rowcount,
+            "statement": " ".join(context.statement.split()),
+            "params": "%d parameter sets" % len(parameters) if executemany else parameters,
+        })
+
+
+def instrument(engine):
+    """Attach the per-request hooks to engine; idempotent."""
+    if not event.contains(engine, "before_cursor_execute", _before):
+        event.listen(engine, "before_cursor_execute", _before)
+        event.listen(engine, "after_cursor_execute", _after)
+
+
+def query_lines():
+    """The named query totals of queries.py, as Prometheus counters."""
+    stats = query_registry.snapshot()["queries"]
+    lines = []
+    for metric, key, help in (("app_query_calls_total", "calls", "Executions per named query."),
+                              ("app_query_errors_total", "errors", "Failed executions per named query."),
+                              ("app_query_rows_total", "rows", "Rows returned or affected per named query."),
+                              ("app_query_seconds_total", "total_ms", "Execution time per named query, in seconds.")):
+        lines.append("# HELP %s %s" % (metric, help))
+        lines.append("# TYPE %s counter" % metric)
+        for s in stats:
+            value = s[key] / 1000.0 if key == "total_ms" else s[key]
+            lines.append('%s{query="%s"} %s' % (metric, s["name"], value))
+    return lines
@@ -0,0 +1,167 @@
+"""
+Streaming export of a user's library (reviews, tracked books, bookshelves
+and shelf contents) as NDJSON or CSV.
+
+    python export.py PROFILE_ID                          # NDJSON, every section, to stdout
+    python export.py PROFILE_ID -o library.ndjson
+    python export.py PROFILE_ID --format csv --section reviews -o reviews.csv
+
+Rows are read through a server-side cursor (yield_per) and written out in
+~64KB chunks, so memory stays flat however large the library is. All
+sections are read in one REPEATABLE READ transaction and therefore come
+from the same snapshot. The web endpoint streams on a connection of its own
+(an unpooled engine in server.py), so a slow download never holds one of
+the request pool's connections.
+"""
+import csv
+import io
+import json
+from queries import query
+
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# section -> (columns, statement); each is ordered by its primary key
+EXPORT_SECTIONS = {
+    "reviews": (
+        ("book_id", "title", "rating", "review_text", "reviewed_at", "likes_count"),
+        query("export.reviews", """
+            SELECT r.book_id, b.title, r.rating, r.review_text, r.reviewed_at, r.likes_count
+            FROM reviews r
+            JOIN book b ON r.book_id = b.book_id
+            WHERE r.profile_id = :pid
+            ORDER BY r.book_id
+        """),
+    ),
+    "tracked_books": (
+        ("book_id", "title", "status", "current_page", "start_date", "finish_date"),
+        query("export.tracked_books", """
+            SELECT it.book_id, b.title, it.status, it.current_page, it.start_date, it.finish_date
+            FROM is_tracking it
+            JOIN book b ON it.book_id = b.book_id
+            WHERE it.profile_id = :pid
+            ORDER BY it.book_id
+        """),
+    ),
+    "bookshelves": (
+        ("bookshelf_id", "shelf_name", "description", "is_public", "created_at"),
+        query("export.bookshelves", """
+            SELECT bookshelf_id, shelf_name, description, is_public, created_at
+            FROM bookshelf
+            WHERE profile_id = :pid
+            ORDER BY bookshelf_id
+        """),
+    ),
+    "shelf_contents": (
+        ("bookshelf_id", "shelf_name", "book_id", "title", "added_at"),
+        query("export.shelf_contents", """
+            SELECT bs.bookshelf_id, bs.shelf_name, cb.book_id, b.title, cb.added_at
+            FROM bookshelf bs
+            JOIN contains_book cb ON cb.bookshelf_id = bs.bookshelf_id
+            JOIN book b ON cb.book_id = b.book_id
+            WHERE bs.profile_id = :pid
+            ORDER BY bs.bookshelf_id, cb.book_id
+        """),
+    ),
+}
+
+
+def _json_value(value):
+    # dates, timestamps and Decimal ratings
+    return str(value)
+
+
+def export_rows(conn, profile_id, section):
+    """Yield the rows of one section as tuples, streamed from a server-side cursor."""
+    columns, stmt = EXPORT_SECTIONS[section]
+    result = conn.execution_options(yield_per=EXPORT_CHUNK_ROWS).execute(stmt, {"pid": profile_id})
+    try:
+        for row in result:
+            yield tuple(row)
+    finally:
+        result.close()
+
+
+def ndjson_chunks(conn, profile_id, sections):
+    buf = io.StringIO()
+    for section in sections:
+        columns = EXPORT_SECTIONS[section][0]
+        for row in export_rows(conn, profile_id, section):
+            record = dict(zip(columns, row))
+            record["type"] = section
+            buf.write(json.dumps(record, default=_json_value))
+            buf.write("\n")
+            if buf.tell() >= EXPORT_CHUNK_BYTES:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def csv_chunks(conn, profile_id, section):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_SECTIONS[section][0])
+    for row in export_rows(conn, profile_id, section):
+        writer.writerow(row)
+        if buf.tell() >= EXPORT_CHUNK_BYTES:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def stream_export(engine, profile_id, fmt="ndjson", sections=None):
+    """
+    Generator of text chunks for a whole export. The connection is opened on
+    the first chunk and closed as soon as the last one is produced, or when
+    the consumer stops early (e.g. the client disconnects).
+    CSV takes exactly one section; NDJSON tags each line with its section.
+    """
+    sections = list(sections or EXPORT_SECTIONS)
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="REPEATABLE READ")
+        with conn.begin():
+            if fmt == "csv":
+                chunks = csv_chunks(conn, profile_id, sections[0])
+            else:
+                chunks = ndjson_chunks(conn, profile_id, sections)
+            for chunk in chunks:
+                yield chunk
+
+
+if __name__ == "__main__":
+    import sys
+    import click
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import NullPool
+    from db import DATABASEURI
+
+    @click.command()
+    @click.argument('PROFILE_ID', type=int)
+    @click.option('--format', 'fmt', type=click.Choice(sorted(EXPORT_FORMATS)), default='ndjson')
+    @click.option('--section', type=click.Choice(sorted(EXPORT_SECTIONS)), default=None,
+                  help='only this section (required for csv)')
+    @click.option('-o', '--output', default='-', help='file to write, - for stdout')
+    def run(profile_id, fmt, section, output):
+        """Export one user's library."""
+        if fmt == "csv" and section is None:
+            raise click.UsageError("--format csv needs --section")
+        engine = create_engine(DATABASEURI, poolclass=NullPool)
+        sections = [section] if section else None
+        out = sys.stdout if output == "-" else open(output, "w", encoding="utf-8", newline="")
+        try:
+            for chunk in stream_export(engine, profile_id, fmt, sections):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    run()
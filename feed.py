@@ -0,0 +1,188 @@
+"""
+Home feed: reviews, reading status changes and public shelf additions of
+the people a user follows, newest first.
+
+Events are stored once in activity (schema.py migration 13). Delivery is a
+hybrid fan-out:
+
+  * push: when an account with at most FANOUT_MAX_FOLLOWERS followers acts,
+    the event id is written into each follower's timeline row set in the
+    same transaction as the write itself;
+  * pull: accounts above the limit are recorded in feed_pull_actors and
+    their events are not copied anywhere. Followers merge them in at read
+    time.
+
+A feed page is then one query: the reader's own timeline plus the latest
+events of the pulled accounts they follow, keyset-paginated on event_id.
+The pull side walks feed_pull_actors (only accounts past the limit, so a
+small table) and probes the follows primary key (follower_id,
+following_id) once per pulled account. Its cost depends on the page size
+and the number of pulled accounts, never on how many accounts the reader
+follows.
+"""
+import json
+import os
+from queries import query
+
+FEED_PAGE_SIZE = 30
+
+# above this many followers an account's events are pulled instead of pushed
+FANOUT_MAX_FOLLOWERS = int(os.environ.get("FEED_FANOUT_MAX_FOLLOWERS", "5000"))
+
+# events of a newly followed (push) account copied into the follower's timeline
+FOLLOW_BACKFILL = 50
+
+INSERT_EVENT_SQL = query("feed.insert_event", """
+    INSERT INTO activity (actor_id, kind, book_id, detail)
+    VALUES (:actor, :kind, :bid, CAST(:detail AS jsonb))
+    RETURNING event_id
+""")
+
+# counts at most FANOUT_MAX_FOLLOWERS + 1 followers, so a huge account costs no more than a small one
+FOLLOWER_COUNT_SQL = query("feed.follower_count", """
+    SELECT COUNT(*) FROM (
+        SELECT 1 FROM follows WHERE following_id = :actor LIMIT :cap
+    ) f
+""")
+
+IS_PULLED_SQL = query("feed.is_pulled", "SELECT 1 FROM feed_pull_actors WHERE profile_id = :actor")
+MARK_PULLED_SQL = query("feed.mark_pulled", "INSERT INTO feed_pull_actors (profile_id) VALUES (:actor) ON CONFLICT DO NOTHING")
+
+FANOUT_SQL = query("feed.fanout", """
+    INSERT INTO timeline (profile_id, event_id)
+    SELECT follower_id, :eid FROM follows WHERE following_id = :actor
+    ON CONFLICT DO NOTHING
+""")
+
+BACKFILL_SQL = query("feed.backfill", """
+    INSERT INTO timeline (profile_id, event_id)
+    SELECT :follower, event_id FROM activity
+    WHERE actor_id = :actor
+    ORDER BY event_id DESC
+    LIMIT :limit
+    ON CONFLICT DO NOTHING
+""")
+
+UNFOLLOW_SQL = query("feed.unfollow", """
+    DELETE FROM timeline t
+    USING activity a
+    WHERE t.profile_id = :follower AND a.event_id = t.event_id AND a.actor_id = :actor
+""")
+
+RETRACT_REVIEW_SQL = query("feed.retract_review", "DELETE FROM activity WHERE actor_id = :actor AND kind = 'review' AND book_id = :bid")
+
+_FEED_SQL = '''
+    WITH ids AS (
+        (SELECT t.event_id
+         FROM timeline t
+         WHERE t.profile_id = :pid {after_t}
+         ORDER BY t.event_id DESC
+         LIMIT :limit)
+        UNION
+        (SELECT e.event_id
+         FROM feed_pull_actors p
+         -- OFFSET 0 keeps the planner from turning this probe into a join over all of the reader's follows
+         CROSS JOIN LATERAL (
+             SELECT 1 FROM follows f
+             WHERE f.follower_id = :pid AND f.following_id = p.profile_id
+             OFFSET 0
+         ) f
+         CROSS JOIN LATERAL (
+             SELECT a.event_id FROM activity a
+             WHERE a.actor_id = p.profile_id {after_a}
+             ORDER BY a.event_id DESC
+             LIMIT :limit
+         ) e)
+        ORDER BY event_id DESC
+        LIMIT :limit
+    )
+    SELECT a.event_id, a.actor_id, pr.username, a.kind, a.book_id, b.title, a.detail, a.created_at
+    FROM ids
+    JOIN activity a ON a.event_id = ids.event_id
+    JOIN profile pr ON pr.profile_id = a.actor_id
+    LEFT JOIN book b ON b.book_id = a.book_id
+    ORDER BY a.event_id DESC
+'''
+
+FEED_SQL = {
+    False: query("feed.page_first", _FEED_SQL.format(after_t="", after_a="")),
+    True: query("feed.page_next", _FEED_SQL.format(after_t="AND t.event_id < :after", after_a="AND a.event_id < :after")),
+}
+
+
+def record_event(conn, actor_id, kind, book_id, detail=None):
+    """
+    Store one event and deliver it to the actor's followers' timelines, or
+    mark the actor as pulled if they have too many followers. Runs in the
+    caller's transaction.
+    """
+    event_id = conn.execute(INSERT_EVENT_SQL, {
+        "actor": actor_id, "kind": kind, "bid": book_id, "detail": json.dumps(detail or {}),
+    }).scalar()
+    if conn.execute(IS_PULLED_SQL, {"actor": actor_id}).fetchone() is not None:
+        return event_id
+    followers = conn.execute(FOLLOWER_COUNT_SQL, {"actor": actor_id, "cap": FANOUT_MAX_FOLLOWERS + 1}).scalar()
+    if followers > FANOUT_MAX_FOLLOWERS:
+        conn.execute(MARK_PULLED_SQL, {"actor": actor_id})
+    elif followers:
+        conn.execute(FANOUT_SQL, {"eid": event_id, "actor": actor_id})
+    return event_id
+
+
+def record_review_event(conn, actor_id, book_id, old, new):
+    """A review posted for the first time becomes an event (edits do not)."""
+    if old is None and new is not None:
+        record_event(conn, actor_id, "review", book_id, {"rating": str(new.rating) if new.rating is not None else None})
+
+
+def retract_review_event(conn, actor_id, book_id):
+    conn.execute(RETRACT_REVIEW_SQL, {"actor": actor_id, "bid": book_id})
+
+
+def record_tracking_event(conn, actor_id, book_id, old, new):
+    """A change of reading status becomes an event (page updates do not)."""
+    if new is not None and (old is None or old.status != new.status):
+        record_event(conn, actor_id, "track", book_id, {"status": new.status})
+
+
+def record_follow(conn, follower_id, actor_id):
+    """Copy a newly followed push account's recent events into the follower's timeline."""
+    if conn.execute(IS_PULLED_SQL, {"actor": actor_id}).fetchone() is None:
+        conn.execute(BACKFILL_SQL, {"follower": follower_id, "actor": actor_id, "limit": FOLLOW_BACKFILL})
+
+
+def record_unfollow(conn, follower_id, actor_id):
+    conn.execute(UNFOLLOW_SQL, {"follower": follower_id, "actor": actor_id})
+
+
+def _detail(value):
+    # psycopg2 decodes jsonb columns; other drivers may hand back text
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or {}
+
+
+def event_from_row(row):
+    return {
+        "id": row.event_id,
+        "actor_id": row.actor_id,
+        "username": row.username,
+        "kind": row.kind,
+        "book_id": row.book_id,
+        "title": row.title,
+        "detail": _detail(row.detail),
+        "created_at": row.created_at,
+    }
+
+
+def load_feed(conn, profile_id, after=None, page_size=FEED_PAGE_SIZE):
+    """Return (events, next_cursor) for one page of a user's feed."""
+    try:
+        after = int(after) if after else None
+    except (TypeError, ValueError):
+        after = None
+    params = {"pid": profile_id, "limit": page_size + 1, "after": after}
+    rows = conn.execute(FEED_SQL[after is not None], params).fetchall()
+    events = [event_from_row(r) for r in rows[:page_size]]
+    next_cursor = str(events[-1]["id"]) if len(rows) > page_size else None
+    return events, next_cursor
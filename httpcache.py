@@ -0,0 +1,100 @@
+"""
+Per-worker response cache for anonymous page views.
+
+Pages rendered for a visitor without a profile_id cookie do not depend on
+who is asking, so the rendered body is kept (keyed by endpoint, URL
+arguments and query string) and served again with an ETag and
+Last-Modified. A matching If-None-Match / If-Modified-Since gets a 304
+without running the view at all. POST handlers call invalidate() for the
+pages they change; RESPONSE_CACHE_TTL bounds staleness for everything
+else (including changes made through other workers).
+"""
+import hashlib
+import os
+import threading
+import time
+from functools import wraps
+from flask import request, Response
+from cache import TTLCache
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 2000))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 60))
+
+
+class ResponseCache(object):
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.not_modified = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key():
+        return (
+            request.endpoint,
+            tuple(sorted((request.view_args or {}).items())),
+            tuple(sorted(request.args.items(multi=True))),
+        )
+
+    def _saved(self, nbytes, not_modified=False):
+        with self._lock:
+            self.bytes_saved += nbytes
+            if not_modified:
+                self.not_modified += 1
+
+    def _respond(self, entry, hit):
+        body, mimetype, etag, last_modified = entry
+        resp = Response(body, mimetype=mimetype)
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.vary.add("Cookie")
+        resp = resp.make_conditional(request)
+        if resp.status_code == 304:
+            # neither rendered nor sent
+            self._saved(len(body), not_modified=True)
+        elif hit:
+            # sent, but not rendered
+            self._saved(len(body))
+        return resp
+
+    def cached(self, view):
+        """Decorator for GET views whose anonymous output can be shared."""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or request.cookies.get("profile_id"):
+                return view(*args, **kwargs)
+
+            key = self.key()
+            entry = self._entries.get(key)
+            if entry is not None:
+                return self._respond(entry, hit=True)
+
+            resp = view(*args, **kwargs)
+            if not isinstance(resp, Response):
+                resp = Response(resp)
+            if resp.status_code != 200 or resp.direct_passthrough:
+                return resp
+            body = resp.get_data()
+            entry = (body, resp.mimetype, hashlib.sha1(body).hexdigest(), int(time.time()))
+            self._entries.set(key, entry)
+            return self._respond(entry, hit=False)
+        return wrapper
+
+    def invalidate(self, endpoint, **view_args):
+        """Drop every cached page of endpoint whose URL arguments include view_args."""
+        wanted = set(view_args.items())
+        self._entries.invalidate_where(
+            lambda key: key[0] == endpoint and wanted.issubset(key[1])
+        )
+
+    def stats(self):
+        stats = self._entries.stats()
+        with self._lock:
+            stats["not_modified"] = self.not_modified
+            stats["bytes_saved"] = self.bytes_saved
+        return stats
+
+
+response_cache = ResponseCache()
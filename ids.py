@@ -0,0 +1,48 @@
+"""
+Block (hi-lo) id allocation for tables whose primary key is a plain integer.
+
+Each table has a Postgres sequence that steps by ID_BLOCK_SIZE (schema.py
+migration 6). A worker takes one nextval() -- the start of a block -- and
+hands out the ids in that block from memory, so inserts never read the
+table's MAX(id) and two workers can never pick the same id. Ids left in a
+block when a process exits are simply skipped.
+"""
+import os
+import threading
+from queries import query
+
+# must match INCREMENT BY of the sequences created in schema.py
+ID_BLOCK_SIZE = 100
+
+NEXTVAL_SQL = query("ids.nextval", "SELECT nextval(CAST(:seq AS regclass))")
+
+
+class BlockIdAllocator(object):
+
+    def __init__(self, sequence, block_size=ID_BLOCK_SIZE):
+        self.sequence = sequence
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+        self._pid = os.getpid()
+        self.blocks_fetched = 0
+
+    def next_id(self, conn):
+        """Return an unused id, fetching a new block through conn when the current one runs out."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked child must not reuse the parent's block
+                self._next = self._end = 0
+                self._pid = os.getpid()
+            if self._next >= self._end:
+                start = conn.execute(NEXTVAL_SQL, {"seq": self.sequence}).scalar()
+                self._next, self._end = start, start + self.block_size
+                self.blocks_fetched += 1
+            new_id = self._next
+            self._next += 1
+            return new_id
+
+
+profile_ids = BlockIdAllocator("profile_id_block_seq")
+bookshelf_ids = BlockIdAllocator("bookshelf_id_block_seq")
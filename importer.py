@@ -0,0 +1,442 @@
+"""
+Bulk catalog importer for book, author, genre, written_by and categorized_as.
+
+    python importer.py authors goodreads_book_authors.json
+    python importer.py books goodreads_books.json.gz
+    python importer.py books books.csv --batch-size 50000
+
+Input is read one record at a time (CSV, or JSON lines, optionally .gz),
+so memory depends on --batch-size, not on the size of the dump. Each batch
+is COPYed into temporary staging tables and merged with a handful of
+set-based statements in one transaction:
+
+  * author and genre names are resolved to ids in bulk; unknown names get
+    new ids after the current maximum
+  * books are upserted on book_id, rewriting only rows that changed; a
+    field missing from the dump keeps its current value
+  * a book's author / genre links are replaced by the ones in the dump
+  * search vectors are computed once per book, after the links are in,
+    instead of by the per-row triggers (schema.py migration 7)
+
+Book records are matched loosely so Goodreads-style dumps load as they are:
+
+    book_id           book_id, goodreads_book_id, id
+    title             title, original_title
+    publication_year  publication_year, original_publication_year, year
+    image_url         image_url
+    summary           description, summary
+    page_count        num_pages, page_count
+    lang              language_code, lang
+    authors           list of names, list of {"author_id": ..} / {"name": ..}, or "A, B"
+    genres            list of names, {name: count}, or "a|b" / "a, b"
+
+Running web workers keep their own suggestion index and book cache; send
+the master a HUP after a large import so they start from the new catalog.
+"""
+import csv
+import gzip
+import io
+import json
+import time
+from sqlalchemy import text
+from db import DATABASEURI, make_engine
+
+IMPORT_BATCH_SIZE = 100000
+
+# schema.py migration that makes the search vector triggers skippable
+REQUIRED_MIGRATION = 7
+
+STAGING_TABLES = [
+    """
+    CREATE TEMP TABLE IF NOT EXISTS stage_book (
+        book_id integer, title text, publication_year integer, image_url text,
+        summary text, page_count integer, lang text
+    ) ON COMMIT DELETE ROWS
+    """,
+    "CREATE TEMP TABLE IF NOT EXISTS stage_book_author (book_id integer, author_id integer, author_name text) ON COMMIT DELETE ROWS",
+    "CREATE TEMP TABLE IF NOT EXISTS stage_book_genre (book_id integer, genre_id integer, genre_name text) ON COMMIT DELETE ROWS",
+    "CREATE TEMP TABLE IF NOT EXISTS stage_author (author_id integer, name text) ON COMMIT DELETE ROWS",
+]
+
+MERGE_AUTHORS_SQL = [
+    """
+    INSERT INTO author (author_id, name)
+    SELECT DISTINCT ON (author_id) author_id, name
+    FROM stage_author
+    WHERE author_id IS NOT NULL AND name IS NOT NULL
+    ORDER BY author_id
+    ON CONFLICT (author_id) DO UPDATE SET name = EXCLUDED.name
+    WHERE author.name IS DISTINCT FROM EXCLUDED.name
+    """,
+]
+
+# authors and genres given only by name get the lowest existing id for that
+# name, or a new one; the lock keeps two importers from handing out the same id
+RESOLVE_NAMES_SQL = [
+    "LOCK TABLE author IN SHARE ROW EXCLUSIVE MODE",
+    """
+    INSERT INTO author (author_id, name)
+    SELECT (SELECT COALESCE(MAX(author_id), 0) FROM author) + row_number() OVER (ORDER BY n.name), n.name
+    FROM (SELECT DISTINCT author_name AS name FROM stage_book_author WHERE author_id IS NULL) n
+    WHERE NOT EXISTS (SELECT 1 FROM author a WHERE a.name = n.name)
+    """,
+    """
+    UPDATE stage_book_author s
+    SET author_id = (SELECT MIN(a.author_id) FROM author a WHERE a.name = s.author_name)
+    WHERE s.author_id IS NULL
+    """,
+    "LOCK TABLE genre IN SHARE ROW EXCLUSIVE MODE",
+    """
+    INSERT INTO genre (genre_id, genre_name)
+    SELECT (SELECT COALESCE(MAX(genre_id), 0) FROM genre) + row_number() OVER (ORDER BY n.name), n.name
+    FROM (SELECT DISTINCT genre_name AS name FROM stage_book_genre) n
+    WHERE NOT EXISTS (SELECT 1 FROM genre g WHERE g.genre_name = n.name)
+    """,
+    """
+    UPDATE stage_book_genre s
+    SET genre_id = (SELECT MIN(g.genre_id) FROM genre g WHERE g.genre_name = s.genre_name)
+    """,
+]
+
+MERGE_BOOKS_SQL = [
+    """
+    INSERT INTO book (book_id, title, publication_year, image_url, summary, page_count, lang)
+    SELECT DISTINCT ON (book_id) book_id, title, publication_year, image_url, summary, page_count, lang
+    FROM stage_book
+    ORDER BY book_id
+    ON CONFLICT (book_id) DO UPDATE SET
+        title = EXCLUDED.title,
+        publication_year = COALESCE(EXCLUDED.publication_year, book.publication_year),
+        image_url = COALESCE(EXCLUDED.image_url, book.image_url),
+        summary = COALESCE(EXCLUDED.summary, book.summary),
+        page_count = COALESCE(EXCLUDED.page_count, book.page_count),
+        lang = COALESCE(EXCLUDED.lang, book.lang)
+    WHERE (book.title, book.publication_year, book.image_url, book.summary, book.page_count, book.lang)
+          IS DISTINCT FROM
+          (EXCLUDED.title, COALESCE(EXCLUDED.publication_year, book.publication_year),
+           COALESCE(EXCLUDED.image_url, book.image_url), COALESCE(EXCLUDED.summary, book.summary),
+           COALESCE(EXCLUDED.page_count, book.page_count), COALESCE(EXCLUDED.lang, book.lang))
+    """,
+    # links of books that came with an author / genre list are replaced by that list
+    """
+    DELETE FROM written_by wb
+    WHERE wb.book_id IN (SELECT book_id FROM stage_book_author)
+      AND NOT EXISTS (SELECT 1 FROM stage_book_author s
+                      WHERE s.book_id = wb.book_id AND s.author_id = wb.author_id)
+    """,
+    """
+    INSERT INTO written_by (book_id, author_id)
+    SELECT DISTINCT s.book_id, s.author_id
+    FROM stage_book_author s
+    JOIN author a ON a.author_id = s.author_id
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    DELETE FROM categorized_as ca
+    WHERE ca.book_id IN (SELECT book_id FROM stage_book_genre)
+      AND NOT EXISTS (SELECT 1 FROM stage_book_genre s
+                      WHERE s.book_id = ca.book_id AND s.genre_id = ca.genre_id)
+    """,
+    """
+    INSERT INTO categorized_as (book_id, genre_id)
+    SELECT DISTINCT book_id, genre_id FROM stage_book_genre
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    UPDATE book b SET search_vector = book_search_vector(b.book_id, b.title, b.summary)
+    WHERE b.book_id IN (SELECT book_id FROM stage_book)
+    """,
+]
+
+
+#
+# Reading dumps
+#
+
+def open_dump(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def read_records(path):
+    """Yield one dict per record of a CSV or JSON-lines file, streaming."""
+    name = path[:-3] if path.endswith(".gz") else path
+    with open_dump(path) as f:
+        if name.endswith(".csv"):
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def _first(record, *keys):
+    for key in keys:
+        value = record.get(key)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def _int(value):
+    if value in (None, ""):
+        return None
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _str(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _names(value, separators=(",",)):
+    if isinstance(value, str):
+        for sep in separators:
+            if sep in value:
+                return [v.strip() for v in value.split(sep) if v.strip()]
+        return [value.strip()] if value.strip() else []
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def book_rows(record):
+    """
+    Split one book record into (book, [(book_id, author_id, author_name)], [(book_id, None, genre_name)]).
+    Returns None if the record has no usable book_id or title.
+    """
+    book_id = _int(_first(record, "book_id", "goodreads_book_id", "id"))
+    title = _str(_first(record, "title", "original_title"))
+    if book_id is None or title is None:
+        return None
+
+    book = (
+        book_id,
+        title,
+        _int(_first(record, "publication_year", "original_publication_year", "year")),
+        _str(record.get("image_url")),
+        _str(_first(record, "description", "summary")),
+        _int(_first(record, "num_pages", "page_count")),
+        _str(_first(record, "language_code", "lang")),
+    )
+
+    authors = []
+    value = record.get("authors")
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        for a in value:
+            authors.append((book_id, _int(a.get("author_id")), _str(a.get("name"))))
+    elif value:
+        authors = [(book_id, None, name) for name in _names(value)]
+    authors = [a for a in authors if a[1] is not None or a[2] is not None]
+
+    genres = record.get("genres")
+    if isinstance(genres, dict):
+        genres = list(genres)
+    genres = [(book_id, None, name) for name in _names(genres or [], ("|", ","))]
+
+    return book, authors, genres
+
+
+def author_row(record):
+    author_id = _int(_first(record, "author_id", "id"))
+    name = _str(record.get("name"))
+    if author_id is None or name is None:
+        return None
+    return author_id, name
+
+
+#
+# COPY
+#
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\x00", "").replace("\\", "\\\\")
+            .replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def copy_lines(rows):
+    for row in rows:
+        yield "\t".join(_copy_value(v) for v in row) + "\n"
+
+
+class _LineReader(io.TextIOBase):
+    """File-like view of an iterator of lines, for psycopg2's copy_expert."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buf = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buf = self._buf, ""
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def copy_rows(conn, table, columns, rows):
+    """COPY rows (tuples) into table through the connection's DBAPI driver."""
+    if not rows:
+        return
+    sql = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+    cur = conn.connection.cursor()
+    try:
+        if hasattr(cur, "copy"):
+            # psycopg 3
+            with cur.copy(sql) as copy:
+                for line in copy_lines(rows):
+                    copy.write(line)
+        else:
+            cur.copy_expert(sql, _LineReader(copy_lines(rows)))
+    finally:
+        cur.close()
+
+
+def copy_text(conn, table, columns, data):
+    """COPY a string already in COPY text format into table; for generated data that needs no escaping."""
+    sql = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+    cur = conn.connection.cursor()
+    try:
+        if hasattr(cur, "copy"):
+            with cur.copy(sql) as copy:
+                copy.write(data)
+        else:
+            cur.copy_expert(sql, io.StringIO(data))
+    finally:
+        cur.close()
+
+
+#
+# Loading
+#
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Progress(object):
+
+    def __init__(self, what):
+        self.what = what
+        self.rows = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    def add(self, rows, skipped=0):
+        self.rows += rows
+        self.skipped += skipped
+        print("%s: %d rows, %.0f rows/s" % (self.what, self.rows, self.rate()))
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def done(self):
+        elapsed = time.perf_counter() - self.started
+        print("%s: loaded %d rows in %.1fs (%.0f rows/s), skipped %d unusable records"
+              % (self.what, self.rows, elapsed, self.rate(), self.skipped))
+
+
+def check_schema(conn):
+    version = conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+    if version < REQUIRED_MIGRATION:
+        raise SystemExit("schema is at version %d; run `python schema.py migrate` first" % version)
+
+
+def prepare(conn):
+    check_schema(conn)
+    for stmt in STAGING_TABLES:
+        conn.execute(text(stmt))
+    conn.commit()
+
+
+def import_authors(engine, path, batch_size=IMPORT_BATCH_SIZE):
+    progress = Progress("authors")
+    with engine.connect() as conn:
+        prepare(conn)
+        for batch in batches(read_records(path), batch_size):
+            rows = [r for r in map(author_row, batch) if r is not None]
+            with conn.begin():
+                copy_rows(conn, "stage_author", ("author_id", "name"), rows)
+                for stmt in MERGE_AUTHORS_SQL:
+                    conn.execute(text(stmt))
+            progress.add(len(rows), len(batch) - len(rows))
+    progress.done()
+    return progress.rows
+
+
+def import_books(engine, path, batch_size=IMPORT_BATCH_SIZE):
+    progress = Progress("books")
+    with engine.connect() as conn:
+        prepare(conn)
+        for batch in batches(read_records(path), batch_size):
+            books, links, genres = [], [], []
+            for record in batch:
+                split = book_rows(record)
+                if split is not None:
+                    books.append(split[0])
+                    links.extend(split[1])
+                    genres.extend(split[2])
+            with conn.begin():
+                # the search vector triggers skip this transaction; the last
+                # statement of MERGE_BOOKS_SQL recomputes the vectors instead
+                conn.execute(text("SET LOCAL bookshelf.bulk_load = 'on'"))
+                copy_rows(conn, "stage_book", ("book_id", "title", "publication_year", "image_url",
+                                               "summary", "page_count", "lang"), books)
+                copy_rows(conn, "stage_book_author", ("book_id", "author_id", "author_name"), links)
+                copy_rows(conn, "stage_book_genre", ("book_id", "genre_id", "genre_name"), genres)
+                for stmt in RESOLVE_NAMES_SQL + MERGE_BOOKS_SQL:
+                    conn.execute(text(stmt))
+            progress.add(len(books), len(batch) - len(books))
+    progress.done()
+    return progress.rows
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.group()
+    def cli():
+        """Bulk-load catalog dumps into the bookshelf database."""
+
+    @cli.command('authors')
+    @click.argument('PATH')
+    @click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+    def authors_cmd(path, batch_size):
+        """Load authors (author_id, name) from a CSV / JSON-lines dump."""
+        import_authors(make_engine(DATABASEURI), path, batch_size)
+
+    @cli.command('books')
+    @click.argument('PATH')
+    @click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+    def books_cmd(path, batch_size):
+        """Load books with their author and genre links from a CSV / JSON-lines dump."""
+        import_books(make_engine(DATABASEURI), path, batch_size)
+
+    cli()
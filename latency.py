@@ -0,0 +1,78 @@
+"""
+Per-route request latency, split into template rendering and everything else.
+
+start_request() / finish_request() bracket a request (server.py and
+aserver.py call them from their request hooks); the framework's
+before_render_template / template_rendered signals time every
+render_template() in between. Per route:
+
+    app_request_seconds            wall time, first request hook to teardown
+    app_request_render_seconds     time spent rendering templates
+    app_request_handler_seconds    the rest: view code, queries, caches
+
+served at /metrics with the database histograms of dbmetrics.py. A route
+whose handler time is small next to its render time (profile.html,
+book_page.html) is one to fix in Jinja, not in SQL.
+
+The request is tracked in a context variable, as in dbmetrics.py.
+"""
+import contextvars
+import time
+from metrics import Histogram
+
+REQUEST_SECONDS = Histogram("app_request_seconds", "Request wall time, in seconds.", ("route",))
+RENDER_SECONDS = Histogram("app_request_render_seconds", "Template rendering time per request, in seconds.",
+                           ("route",))
+HANDLER_SECONDS = Histogram("app_request_handler_seconds",
+                            "Request time outside template rendering, in seconds.", ("route",))
+
+
+class RequestTiming(object):
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.render = 0.0
+        self.render_started = None
+
+
+_current = contextvars.ContextVar("request_timing", default=None)
+
+
+def start_request(route):
+    """Start timing the request about to run; returns the token for finish_request()."""
+    return _current.set(RequestTiming(route))
+
+
+def finish_request(token):
+    timing = _current.get()
+    _current.reset(token)
+    if timing is None:
+        return None
+    total = time.perf_counter() - timing.started
+    REQUEST_SECONDS.observe(total, route=timing.route)
+    RENDER_SECONDS.observe(timing.render, route=timing.route)
+    HANDLER_SECONDS.observe(max(total - timing.render, 0.0), route=timing.route)
+    return timing
+
+
+def before_render(sender, **extra):
+    timing = _current.get()
+    if timing is not None:
+        timing.render_started = time.perf_counter()
+
+
+def rendered(sender, **extra):
+    timing = _current.get()
+    if timing is not None and timing.render_started is not None:
+        timing.render += time.perf_counter() - timing.render_started
+        timing.render_started = None
+
+
+# Quart runs synchronous signal receivers on a worker thread; these run on the event loop
+async def before_render_async(sender, **extra):
+    before_render(sender, **extra)
+
+
+async def rendered_async(sender, **extra):
+    rendered(sender, **extra)
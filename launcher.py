@@ -0,0 +1,122 @@
+"""
+Production launcher: a gunicorn pre-fork master with one worker per core.
+
+Every worker imports server.py after the fork, so each has its own engine
+and pool and never shares a database socket with another process. Workers
+are recycled after WEB_MAX_REQUESTS requests or once their resident memory
+passes WEB_MAX_MEMORY_MB, finishing the request in hand before exiting.
+
+    python launcher.py [HOST] [PORT]       # or: python server.py --workers N
+    gunicorn -c launcher.py server:app     # same settings through the gunicorn CLI
+
+Zero-downtime reload: `kill -HUP <master pid>` starts workers on freshly
+imported code and retires the old ones once their current requests finish.
+
+Settings (environment):
+
+    WEB_BIND                address to listen on (default 0.0.0.0:8111)
+    WEB_CONCURRENCY         number of workers (default: CPU count)
+    WEB_THREADS             threads per worker (default 1)
+    WEB_MAX_REQUESTS        recycle a worker after this many requests (default 10000, 0 = never)
+    WEB_MAX_MEMORY_MB       recycle a worker above this RSS (default 512, 0 = never)
+    WEB_GRACEFUL_TIMEOUT    seconds a retiring worker gets to finish (default 30)
+    WEB_TIMEOUT             seconds before a stuck worker is killed (default 60)
+"""
+import os
+
+from db import _env_int
+
+#
+# gunicorn settings: this module doubles as a gunicorn config file, which
+# reads these module-level names and ignores the rest.
+#
+bind = os.environ.get("WEB_BIND", "0.0.0.0:8111")
+workers = _env_int("WEB_CONCURRENCY", os.cpu_count() or 1)
+worker_class = "gthread" if _env_int("WEB_THREADS", 1) > 1 else "sync"
+threads = _env_int("WEB_THREADS", 1)
+max_requests = _env_int("WEB_MAX_REQUESTS", 10000)
+# spread recycles out so the workers do not all restart at once
+max_requests_jitter = max_requests // 10
+graceful_timeout = _env_int("WEB_GRACEFUL_TIMEOUT", 30)
+timeout = _env_int("WEB_TIMEOUT", 60)
+# import the app in each worker, after the fork (also lets HUP pick up new code)
+preload_app = False
+
+MAX_MEMORY_MB = _env_int("WEB_MAX_MEMORY_MB", 512)
+
+
+def rss_mb():
+    """Resident set size of this process in MB (Linux /proc, else peak RSS)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def post_fork(server, worker):
+    # if the app was preloaded in the master anyway (--preload), drop any
+    # pooled connections inherited from it without closing the parent's sockets
+    import sys
+    app_module = sys.modules.get("server")
+    if app_module is not None and hasattr(app_module, "engine"):
+        app_module.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    import server as app_module
+    app_module.init_worker()
+
+
+def post_request(worker, req, environ, resp):
+    if MAX_MEMORY_MB and rss_mb() > MAX_MEMORY_MB:
+        worker.log.info("worker %s over %d MB, recycling", worker.pid, MAX_MEMORY_MB)
+        # gunicorn finishes this request, then the worker exits and is replaced
+        worker.alive = False
+
+
+def worker_exit(server, worker):
+    from likes import like_buffer
+    like_buffer.stop()
+
+
+def serve(host="0.0.0.0", port=8111, worker_count=None):
+    """Run the gunicorn master in this process with the settings above."""
+    from gunicorn.app.base import BaseApplication
+
+    settings = dict(
+        (name, value) for name, value in globals().items()
+        if not name.startswith("_") and name.islower()
+    )
+    settings["bind"] = "%s:%d" % (host, port)
+    if worker_count:
+        settings["workers"] = worker_count
+
+    class Launcher(BaseApplication):
+
+        def load_config(self):
+            for name, value in settings.items():
+                if name in self.cfg.settings and value is not None:
+                    self.cfg.set(name, value)
+
+        def load(self):
+            from server import app
+            return app
+
+    Launcher().run()
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.command()
+    @click.option('--workers', type=int, default=None, help='defaults to WEB_CONCURRENCY or the CPU count')
+    @click.argument('HOST', default='0.0.0.0')
+    @click.argument('PORT', default=8111, type=int)
+    def run(workers, host, port):
+        print("running on %s:%d" % (host, port))
+        serve(host, port, workers)
+
+    run()
@@ -0,0 +1,130 @@
+"""
+Challenge leaderboards: participants ordered by current_progress with dense
+ranks (equal progress, equal rank; the next distinct value is the next rank).
+
+Pages are keyset-paginated on (current_progress, profile_id) over a partial
+index of the counted participations (schema.py migration 12), so page N
+costs the same as page 1. Nothing here scans a challenge's participants;
+three tables kept current by a trigger on participates_in answer the rest:
+
+  * challenge_leaderboard_counts: participants per (challenge, progress),
+    split over up to 16 rows (slot = profile_id % 16, migration 14) so that
+    concurrent joins, which all land on progress 0, do not queue on one row
+    lock. Only the trigger reads it.
+  * challenge_leaderboard_values: one row per distinct counted progress
+    value (migration 16). A rank is 1 + an index-only count of the values
+    above it, so it costs O(distinct progress values above the participant):
+    bounded by the challenge's goal (a 20000-page goal has at most 20001
+    values), not by how many people take part.
+  * challenge_leaderboard_totals: participants per (challenge, slot), so the
+    participant count sums at most 16 rows.
+
+The first page costs one rank lookup; later pages carry the rank in the
+cursor and number their rows without any.
+"""
+from queries import query
+
+LEADERBOARD_PAGE_SIZE = 50
+
+_COUNTED = "p.status IN ('active', 'completed')"
+
+_PAGE_SQL = '''
+    SELECT p.profile_id, pr.username, p.current_progress, p.status
+    FROM participates_in p
+    JOIN profile pr ON pr.profile_id = p.profile_id
+    WHERE p.challenge_id = :cid AND %s %s
+    ORDER BY p.current_progress DESC, p.profile_id DESC
+    LIMIT :limit
+'''
+
+FIRST_PAGE_SQL = query("leaderboard.first_page", _PAGE_SQL % (_COUNTED, ""))
+NEXT_PAGE_SQL = query("leaderboard.next_page", _PAGE_SQL % (_COUNTED, "AND (p.current_progress, p.profile_id) < (:after_progress, :after_pid)"))
+
+# dense rank of a progress value: 1 + the distinct values above it
+RANK_SQL = query("leaderboard.rank", """
+    SELECT COUNT(*) + 1 AS rank
+    FROM challenge_leaderboard_values
+    WHERE challenge_id = :cid AND progress > :progress
+""")
+
+# a participant's own standing, without reading anyone else's row
+STANDING_SQL = query("leaderboard.standing", """
+    SELECT p.current_progress, p.status,
+           (SELECT COUNT(*) + 1 FROM challenge_leaderboard_values lv
+            WHERE lv.challenge_id = p.challenge_id AND lv.progress > p.current_progress) AS rank,
+           (SELECT COALESCE(SUM(participants), 0) FROM challenge_leaderboard_totals lt
+            WHERE lt.challenge_id = p.challenge_id) AS participants
+    FROM participates_in p
+    WHERE p.challenge_id = :cid AND p.profile_id = :pid AND %s
+""" % _COUNTED)
+
+PARTICIPANT_COUNT_SQL = query("leaderboard.participant_count", """
+    SELECT COALESCE(SUM(participants), 0) FROM challenge_leaderboard_totals WHERE challenge_id = :cid
+""")
+
+
+def encode_cursor(progress, profile_id, rank):
+    # the rank rides along so the next page can continue numbering without a lookup
+    return "%d~%d~%d" % (progress, profile_id, rank)
+
+
+def decode_cursor(cursor):
+    """Return (progress, profile_id, rank) or None for a missing / malformed cursor."""
+    if not cursor:
+        return None
+    try:
+        progress, pid, rank = cursor.split("~")
+        return int(progress), int(pid), int(rank)
+    except (ValueError, TypeError):
+        return None
+
+
+def leaderboard_page(conn, challenge_id, after=None, page_size=LEADERBOARD_PAGE_SIZE):
+    """Return (entries, next_cursor) for one page of a challenge's leaderboard."""
+    params = {"cid": challenge_id, "limit": page_size + 1}
+    position = decode_cursor(after)
+    if position is None:
+        rows = conn.execute(FIRST_PAGE_SQL, params).fetchall()
+        previous, rank = None, None
+    else:
+        params["after_progress"], params["after_pid"], rank = position
+        rows = conn.execute(NEXT_PAGE_SQL, params).fetchall()
+        previous = params["after_progress"]
+
+    entries = []
+    for row in rows[:page_size]:
+        if previous is None:
+            rank = conn.execute(RANK_SQL, {"cid": challenge_id, "progress": row.current_progress}).scalar()
+        elif row.current_progress != previous:
+            rank += 1
+        previous = row.current_progress
+        entries.append({
+            "rank": rank,
+            "id": row.profile_id,
+            "username": row.username,
+            "current_progress": row.current_progress,
+            "status": row.status,
+        })
+
+    next_cursor = None
+    if len(rows) > page_size:
+        last = entries[-1]
+        next_cursor = encode_cursor(last["current_progress"], last["id"], last["rank"])
+    return entries, next_cursor
+
+
+def participant_standing(conn, challenge_id, profile_id):
+    """{rank, participants, current_progress, status} for one participant, or None if not on the board."""
+    row = conn.execute(STANDING_SQL, {"cid": challenge_id, "pid": profile_id}).fetchone()
+    if row is None:
+        return None
+    return {
+        "rank": row.rank,
+        "participants": row.participants,
+        "current_progress": row.current_progress,
+        "status": row.status,
+    }
+
+
+def participant_count(conn, challenge_id):
+    return conn.execute(PARTICIPANT_COUNT_SQL, {"cid": challenge_id}).scalar()
@@ -0,0 +1,134 @@
+"""
+Write-behind aggregation of review likes.
+
+Who liked what is recorded synchronously in review_likes, whose primary
+key lets each user like a review only once. The reviews.likes_count
+counter is not touched per click: accepted likes add a delta to an
+in-memory buffer, and a background thread flushes all buffered deltas in
+one multi-row UPDATE every LIKE_FLUSH_INTERVAL seconds (and once more at
+interpreter exit). A crash loses at most one interval of counter deltas;
+the like rows themselves are already committed.
+"""
+import atexit
+import os
+import threading
+from queries import query
+
+LIKE_FLUSH_INTERVAL = float(os.environ.get("LIKE_FLUSH_INTERVAL", 2.0))
+
+RECORD_LIKE_SQL = query("likes.record_like", """
+    INSERT INTO review_likes (profile_id, book_id, liker_id)
+    SELECT r.profile_id, r.book_id, :liker
+    FROM reviews r
+    WHERE r.profile_id = :pid AND r.book_id = :bid
+    ON CONFLICT DO NOTHING
+""")
+
+FLUSH_SQL = query("likes.flush", """
+    UPDATE reviews r
+    SET likes_count = COALESCE(r.likes_count, 0) + d.delta
+    FROM unnest(CAST(:book_ids AS integer[]), CAST(:profile_ids AS integer[]), CAST(:deltas AS integer[]))
+         AS d(book_id, profile_id, delta)
+    WHERE r.book_id = d.book_id AND r.profile_id = d.profile_id
+""")
+
+
+class LikeAggregator(object):
+    """Buffers likes_count deltas per (book_id, profile_id) and flushes them in batches."""
+
+    def __init__(self, interval=LIKE_FLUSH_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._engine = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._atexit_registered = False
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def record(self, conn, liker_id, book_id, profile_id):
+        """
+        Insert the like row for liker_id on the review (profile_id, book_id).
+        Returns True if this is a new like. The caller commits and only then
+        calls add(), so a failed commit never reaches the counter.
+        """
+        res = conn.execute(RECORD_LIKE_SQL, {"liker": liker_id, "pid": profile_id, "bid": book_id})
+        return res.rowcount == 1
+
+    def add(self, book_id, profile_id, delta):
+        key = (book_id, profile_id)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + delta
+
+    def pending(self, book_id, profile_id):
+        """Delta not yet written to reviews.likes_count by this worker."""
+        with self._lock:
+            return self._pending.get((book_id, profile_id), 0)
+
+    def flush(self):
+        """Write all buffered deltas in one statement; on failure they are put back for the next flush."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch or self._engine is None:
+            if batch:
+                self._merge(batch)
+            return 0
+        keys = list(batch)
+        params = {
+            "book_ids": [k[0] for k in keys],
+            "profile_ids": [k[1] for k in keys],
+            "deltas": [batch[k] for k in keys],
+        }
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(FLUSH_SQL, params)
+        except Exception as e:
+            print("like flush error:", e)
+            self._merge(batch)
+            return 0
+        self.flushes += 1
+        self.flushed_rows += len(keys)
+        return len(keys)
+
+    def _merge(self, batch):
+        with self._lock:
+            for key, delta in batch.items():
+                self._pending[key] = self._pending.get(key, 0) + delta
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def start(self, engine):
+        """Start the background flusher for this process (idempotent)."""
+        self._engine = engine
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="like-flusher", daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+
+    def stop(self):
+        """Stop the flusher and write whatever is still buffered."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending_reviews": pending,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "interval": self.interval,
+        }
+
+
+like_buffer = LikeAggregator()
@@ -0,0 +1,336 @@
+"""
+Per-route load benchmark against a running server.
+
+    python server.py --workers 4 &
+    python loadbench.py run -c 16 --duration 20 --out before.json
+    python loadbench.py run --routes book,profile,search_title --anonymous
+    python loadbench.py compare before.json after.json
+
+Each route is driven on its own: --concurrency client threads, each with
+one keep-alive connection, send requests back to back for --warmup
+seconds (not counted) and then --duration seconds. Per route the JSON
+report has requests, errors (status 400 and up or no response), the
+status counts, throughput and latency mean / p50 / p95 / p99 / max in
+milliseconds over the successful requests. Redirects are not followed
+and count as successes: every POST route answers with one.
+
+Ids and search terms are sampled from the database the server uses
+(DATABASEURI / DATABASE_URL), best run on the data of datagen.py. Half of
+the book ids come from the HOT_BOOKS most reviewed books, so caches see
+the same skew as in production. Pages are requested as a random signed-in
+profile unless --anonymous is given; POST routes always are.
+
+The POST routes write (reviews, tracking, likes, shelf entries, follows
+and unfollows): run them against a benchmark database only, or leave them
+out with --routes.
+"""
+import datetime
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from sqlalchemy import text
+from db import DATABASEURI, make_engine
+
+SAMPLE_SIZE = 5000
+HOT_BOOKS = 1000
+HOT_SHARE = 0.5
+REQUEST_TIMEOUT = 30
+
+
+def _sample(conn, table, columns, where="TRUE", n=SAMPLE_SIZE):
+    """About n random rows of table; TABLESAMPLE keeps this cheap on 20M reviews."""
+    estimate = conn.execute(text("SELECT GREATEST(reltuples, 1) FROM pg_class WHERE oid = CAST(:t AS regclass)"),
+                            {"t": table}).scalar()
+    pct = min(100.0, 400.0 * n / estimate)
+    rows = conn.execute(text("SELECT %s FROM %s TABLESAMPLE SYSTEM (:pct) WHERE %s LIMIT :n"
+                             % (columns, table, where)), {"pct": pct, "n": n}).fetchall()
+    if len(rows) < n // 10:
+        # stale statistics or a small table
+        rows = conn.execute(text("SELECT %s FROM %s WHERE %s ORDER BY random() LIMIT :n"
+                                 % (columns, table, where)), {"n": n}).fetchall()
+    return [tuple(r) for r in rows]
+
+
+def load_pools(engine):
+    """Ids and search terms the routes draw from."""
+    with engine.connect() as conn:
+        pools = {
+            "books": [r[0] for r in _sample(conn, "book", "book_id")],
+            "hot_books": [r[0] for r in conn.execute(text(
+                "SELECT book_id FROM book_stats ORDER BY review_count DESC LIMIT :n"), {"n": HOT_BOOKS})],
+            "profiles": [r[0] for r in _sample(conn, "profile", "profile_id")],
+            "shelves": _sample(conn, "bookshelf", "bookshelf_id, profile_id", "is_public"),
+            "reviews": _sample(conn, "reviews", "book_id, profile_id"),
+            "title_words": sorted(set(w for r in _sample(conn, "book", "title", n=500)
+                                      for w in r[0].split() if len(w) > 3)),
+            "author_words": sorted(set(r[0].split()[0] for r in _sample(conn, "author", "name", n=500) if r[0])),
+            "usernames": [r[0] for r in _sample(conn, "profile", "username", n=500)],
+            "shelf_words": sorted(set(r[0].split()[0] for r in _sample(conn, "bookshelf", "shelf_name", n=500))),
+        }
+    empty = [name for name, values in pools.items() if not values]
+    if empty:
+        raise SystemExit("nothing to benchmark with: no %s in the database (see datagen.py)" % ", ".join(empty))
+    return pools
+
+
+def _book(rnd, pools):
+    if rnd.random() < HOT_SHARE:
+        return rnd.choice(pools["hot_books"])
+    return rnd.choice(pools["books"])
+
+
+def _search(mode, words):
+    def build(rnd, pools):
+        q = rnd.choice(pools[words])
+        if words == "usernames":
+            q = q[:max(3, len(q) - 2)]
+        return "GET", "/search?" + urllib.parse.urlencode({"q": q, "mode": mode}), None, None
+    return build
+
+
+def _book_page(rnd, pools):
+    return "GET", "/book/%d" % _book(rnd, pools), None, None
+
+
+def _profile_page(rnd, pools):
+    return "GET", "/profile/%d" % rnd.choice(pools["profiles"]), None, None
+
+
+def _bookshelf_page(rnd, pools):
+    return "GET", "/bookshelf/%d" % rnd.choice(pools["shelves"])[0], None, None
+
+
+def _post_review(rnd, pools):
+    form = {"rating": rnd.choice(["2", "3", "3.5", "4", "4.5", "5"]), "review_text": "Benchmark review."}
+    return "POST", "/book/%d/review" % _book(rnd, pools), form, rnd.choice(pools["profiles"])
+
+
+def _post_track(rnd, pools):
+    form = {"status": rnd.choice(["planning", "reading", "on-hold"]), "current_page": str(rnd.randint(0, 300))}
+    return "POST", "/book/%d/track" % _book(rnd, pools), form, rnd.choice(pools["profiles"])
+
+
+def _post_like(rnd, pools):
+    book_id, reviewer_id = rnd.choice(pools["reviews"])
+    return "POST", "/book/%d/review/%d/like" % (book_id, reviewer_id), {}, rnd.choice(pools["profiles"])
+
+
+def _post_shelf_add(rnd, pools):
+    shelf_id, owner = rnd.choice(pools["shelves"])
+    return "POST", "/bookshelf/%d/add" % shelf_id, {"book_id": str(_book(rnd, pools))}, owner
+
+
+def _post_follow(rnd, pools):
+    # follows and unfollows alternate at random so the follows table stays about the same size
+    form = {"action": rnd.choice(["follow", "unfollow"])}
+    return "POST", "/profile/%d" % rnd.choice(pools["profiles"]), form, rnd.choice(pools["profiles"])
+
+
+# route name -> builder of (method, path, form or None, profile id to sign in as or None)
+ROUTES = {
+    "search_title": _search("title", "title_words"),
+    "search_author": _search("author", "author_words"),
+    "search_profile": _search("profile", "usernames"),
+    "search_bookshelf": _search("bookshelf", "shelf_words"),
+    "book": _book_page,
+    "profile": _profile_page,
+    "bookshelf": _bookshelf_page,
+    "post_review": _post_review,
+    "post_track": _post_track,
+    "post_like": _post_like,
+    "post_shelf_add": _post_shelf_add,
+    "post_follow": _post_follow,
+}
+
+
+class RouteResult(object):
+    """What the client threads of one route saw in the measured window."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+
+    def add(self, latencies, errors, statuses):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.errors += errors
+            for status, n in statuses.items():
+                self.statuses[status] = self.statuses.get(status, 0) + n
+
+
+def _client(url, build, pools, anonymous, rnd, measure_from, until, result):
+    parts = urllib.parse.urlsplit(url)
+    conn_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    conn = conn_class(parts.hostname, parts.port, timeout=REQUEST_TIMEOUT)
+    latencies, errors, statuses = [], 0, {}
+    while True:
+        started = time.perf_counter()
+        if started >= until:
+            break
+        method, path, form, profile_id = build(rnd, pools)
+        if parts.path.rstrip("/"):
+            path = parts.path.rstrip("/") + path
+        headers = {}
+        if profile_id is None and not anonymous:
+            profile_id = rnd.choice(pools["profiles"])
+        if profile_id is not None and (form is not None or not anonymous):
+            headers["Cookie"] = "profile_id=%d" % profile_id
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (http.client.HTTPException, OSError):
+            # the next request() reconnects
+            conn.close()
+            status = None
+        elapsed = time.perf_counter() - started
+        if started < measure_from:
+            continue
+        key = str(status) if status is not None else "no response"
+        statuses[key] = statuses.get(key, 0) + 1
+        if status is None or status >= 400:
+            errors += 1
+        else:
+            latencies.append(elapsed)
+    conn.close()
+    result.add(latencies, errors, statuses)
+
+
+def _percentile(ordered, q):
+    # nearest rank
+    return ordered[min(len(ordered) - 1, max(int(q * len(ordered) + 0.5) - 1, 0))]
+
+
+def summarize(result, duration):
+    ordered = sorted(result.latencies)
+    summary = {
+        "requests": len(ordered) + result.errors,
+        "errors": result.errors,
+        "statuses": dict(sorted(result.statuses.items())),
+        "throughput_rps": round(len(ordered) / duration, 2),
+    }
+    if ordered:
+        summary["latency_ms"] = {
+            "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+            "p50": round(_percentile(ordered, 0.50) * 1000, 3),
+            "p95": round(_percentile(ordered, 0.95) * 1000, 3),
+            "p99": round(_percentile(ordered, 0.99) * 1000, 3),
+            "max": round(ordered[-1] * 1000, 3),
+        }
+    return summary
+
+
+def bench_route(url, name, pools, concurrency, duration, warmup, anonymous, seed):
+    result = RouteResult()
+    measure_from = time.perf_counter() + warmup
+    until = measure_from + duration
+    threads = [threading.Thread(target=_client, name="%s-%d" % (name, i),
+                                args=(url, ROUTES[name], pools, anonymous, random.Random("%s-%s-%d" % (seed, name, i)),
+                                      measure_from, until, result))
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(result, duration)
+
+
+def run(url, routes, concurrency, duration, warmup, anonymous=False, seed=0):
+    """Benchmark each route in turn; returns the JSON-ready report."""
+    pools = load_pools(make_engine(DATABASEURI))
+    report = {
+        "run": {
+            "url": url,
+            "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "concurrency": concurrency,
+            "duration_s": duration,
+            "warmup_s": warmup,
+            "anonymous": anonymous,
+            "seed": seed,
+        },
+        "routes": {},
+    }
+    for name in routes:
+        summary = bench_route(url, name, pools, concurrency, duration, warmup, anonymous, seed)
+        report["routes"][name] = summary
+        latency = summary.get("latency_ms", {})
+        print("%-18s %8.1f req/s   p50 %8s ms   p99 %8s ms   %d errors"
+              % (name, summary["throughput_rps"], latency.get("p50", "-"), latency.get("p99", "-"), summary["errors"]),
+              file=sys.stderr)
+    return report
+
+
+def _change(a, b):
+    if a is None or b is None:
+        return "%10s" % "-"
+    if not a:
+        return "%10s" % "n/a"
+    return "%+9.1f%%" % ((b - a) * 100.0 / a)
+
+
+def compare(before, after):
+    """Lines of the per-route change from report before to report after."""
+    lines = ["%-18s %12s %10s %10s %10s %10s" % ("route", "req/s", "change", "p50", "p95", "p99")]
+    for name, b in after["routes"].items():
+        a = before["routes"].get(name)
+        if a is None:
+            continue
+        la, lb = a.get("latency_ms", {}), b.get("latency_ms", {})
+        lines.append("%-18s %12s %s %s %s %s" % (
+            name, "%.1f" % b["throughput_rps"], _change(a["throughput_rps"], b["throughput_rps"]),
+            _change(la.get("p50"), lb.get("p50")), _change(la.get("p95"), lb.get("p95")),
+            _change(la.get("p99"), lb.get("p99"))))
+    return lines
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.group()
+    def cli():
+        """Per-route load benchmark."""
+
+    @cli.command('run')
+    @click.option('--url', default='http://127.0.0.1:8111', show_default=True)
+    @click.option('-c', '--concurrency', type=int, default=8, show_default=True)
+    @click.option('--duration', type=float, default=10, show_default=True, help='measured seconds per route')
+    @click.option('--warmup', type=float, default=2, show_default=True, help='unmeasured seconds per route')
+    @click.option('--routes', default=",".join(ROUTES), show_default=True, help='comma separated')
+    @click.option('--anonymous', is_flag=True, help='request pages without signing in')
+    @click.option('--seed', type=int, default=0, show_default=True)
+    @click.option('--out', type=click.Path(dir_okay=False), help='write the JSON report here (default stdout)')
+    def run_cmd(url, concurrency, duration, warmup, routes, anonymous, seed, out):
+        """Benchmark the server at URL, one route at a time."""
+        names = [r.strip() for r in routes.split(",") if r.strip()]
+        unknown = [r for r in names if r not in ROUTES]
+        if unknown:
+            raise click.BadParameter("unknown routes %s; known: %s" % (", ".join(unknown), ", ".join(ROUTES)),
+                                     param_hint="--routes")
+        report = run(url, names, concurrency, duration, warmup, anonymous, seed)
+        if out:
+            with open(out, "w") as f:
+                json.dump(report, f, indent=2)
+                f.write("\n")
+        else:
+            print(json.dumps(report, indent=2))
+
+    @cli.command('compare')
+    @click.argument('BEFORE', type=click.File())
+    @click.argument('AFTER', type=click.File())
+    def compare_cmd(before, after):
+        """Per-route throughput and latency change from BEFORE to AFTER."""
+        for line in compare(json.load(before), json.load(after)):
+            print(line)
+
+    cli()
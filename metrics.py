@@ -0,0 +1,113 @@
+"""
+Counters and histograms rendered in the Prometheus text exposition format.
+
+Metrics are per worker process, like the caches: scrape each worker (or
+run a single worker per scrape target) and let Prometheus sum them.
+
+    REQUESTS = Counter("app_requests_total", "Requests served.", ("route",))
+    REQUESTS.inc(route="book")
+
+    LATENCY = Histogram("app_request_seconds", "Request wall time.", ("route",), TIME_BUCKETS)
+    LATENCY.observe(0.042, route="book")
+
+    render()   # every metric declared so far, as text/plain; version=0.0.4
+
+No client library is needed; only the subset of the format the app uses
+(counters and histograms with string labels) is written.
+"""
+import bisect
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        for key, value in values:
+            lines.append("%s%s %s" % (self.name, _labels(self.labels, key), _number(value)))
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            series = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append("%s_bucket%s %d" % (self.name, _labels(self.labels, key, ("le", _number(bound))), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _labels(self.labels, key), _number(total)))
+            lines.append("%s_count%s %d" % (self.name, _labels(self.labels, key), count))
+        return lines
+
+
+def render(extra=()):
+    """Every declared metric, plus any extra lines, in the text format."""
+    lines = []
+    for metric in list(_metrics):
+        lines.extend(metric.render())
+    lines.extend(extra)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,114 @@
+"""
+Profile page queries.
+
+The profile header (profile row, section counts and the viewer's follow
+status) comes back in one query. Each list section is keyset-paginated on
+the id it links to, which is the second column of an index whose first
+column is the profile id, so every page is a bounded index range scan no
+matter how active the user is.
+"""
+from queries import query
+from records import RowMapper
+
+SECTION_PAGE_SIZE = 20
+
+HEADER_SQL = query("profiles.header", """
+    SELECT p.profile_id, p.username, p.joined_at,
+           (SELECT COUNT(*) FROM follows WHERE following_id = p.profile_id) AS followers,
+           (SELECT COUNT(*) FROM follows WHERE follower_id = p.profile_id) AS following,
+           (SELECT COUNT(*) FROM has_favorite WHERE profile_id = p.profile_id) AS favorite_authors,
+           (SELECT COUNT(*) FROM is_tracking WHERE profile_id = p.profile_id) AS tracked_books,
+           (SELECT COUNT(*) FROM reviews WHERE profile_id = p.profile_id) AS reviews,
+           EXISTS (
+               SELECT 1 FROM follows
+               WHERE follower_id = :viewer AND following_id = p.profile_id
+           ) AS is_following
+    FROM profile p
+    WHERE p.profile_id = :pid
+""")
+
+SECTIONS = {
+    "followers": query("profiles.followers", """
+        SELECT p.profile_id AS id, p.username
+        FROM follows f
+        JOIN profile p ON f.follower_id = p.profile_id
+        WHERE f.following_id = :pid AND f.follower_id > :after
+        ORDER BY f.follower_id
+        LIMIT :limit
+    """),
+    "following": query("profiles.following", """
+        SELECT p.profile_id AS id, p.username
+        FROM follows f
+        JOIN profile p ON f.following_id = p.profile_id
+        WHERE f.follower_id = :pid AND f.following_id > :after
+        ORDER BY f.following_id
+        LIMIT :limit
+    """),
+    "favorite_authors": query("profiles.favorite_authors", """
+        SELECT a.author_id AS id, a.name
+        FROM has_favorite hf
+        JOIN author a ON hf.author_id = a.author_id
+        WHERE hf.profile_id = :pid AND hf.author_id > :after
+        ORDER BY hf.author_id
+        LIMIT :limit
+    """),
+    "tracked_books": query("profiles.tracked_books", """
+        SELECT b.book_id AS id, b.title, it.status
+        FROM is_tracking it
+        JOIN book b ON it.book_id = b.book_id
+        WHERE it.profile_id = :pid AND it.book_id > :after
+        ORDER BY it.book_id
+        LIMIT :limit
+    """),
+    "reviews": query("profiles.reviews", """
+        SELECT r.book_id AS id, b.title, r.rating, r.review_text
+        FROM reviews r
+        JOIN book b ON r.book_id = b.book_id
+        WHERE r.profile_id = :pid AND r.book_id > :after
+        ORDER BY r.book_id
+        LIMIT :limit
+    """),
+}
+
+# every column of a section query, under its own name
+SECTION_ITEM = RowMapper("SectionItem")
+
+
+def header_from_row(row):
+    """Shape a HEADER_SQL row into (profile, counts, is_following)."""
+    profile = {
+        "profile_id": row.profile_id,
+        "username": row.username,
+        "joined_at": row.joined_at,
+    }
+    counts = dict((name, getattr(row, name)) for name in SECTIONS)
+    return profile, counts, bool(row.is_following)
+
+
+def load_header(conn, profile_id, viewer_id=None):
+    """Return (profile, counts, is_following) or None if the profile does not exist."""
+    row = conn.execute(HEADER_SQL, {"pid": profile_id, "viewer": viewer_id}).fetchone()
+    if row is None:
+        return None
+    return header_from_row(row)
+
+
+def section_query(section, profile_id, after=0, page_size=SECTION_PAGE_SIZE):
+    """Return (statement, params) for one page of a profile section."""
+    return SECTIONS[section], {"pid": profile_id, "after": after or 0, "limit": page_size + 1}
+
+
+def section_page(rows, page_size=SECTION_PAGE_SIZE):
+    """
+    Shape the rows of a section_query() into (items, next_cursor).
+    next_cursor is the id to pass as after for the following page, or None.
+    """
+    items = SECTION_ITEM.all(rows[:page_size])
+    next_cursor = items[-1]["id"] if len(rows) > page_size else None
+    return items, next_cursor
+
+
+def load_section(conn, section, profile_id, after=0, page_size=SECTION_PAGE_SIZE):
+    """Return (items, next_cursor) for one page of a profile section."""
+    rows = conn.execute(*section_query(section, profile_id, after, page_size)).fetchall()
+    return section_page(rows, page_size)
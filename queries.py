@@ -0,0 +1,236 @@
+"""
+Registry of the named SQL statements the web app runs.
+
+Every statement a request can execute is declared once, at module level,
+through query():
+
+    TRACKING_SQL = query("catalog.tracking", '''
+        SELECT ... FROM is_tracking WHERE profile_id = :pid AND book_id = :bid
+    ''')
+
+query() returns an ordinary text() clause, tagged with its name, so call
+sites keep using conn.execute(TRACKING_SQL, params). instrument(engine)
+then hooks the engine's cursor events to
+
+  * prepare each registered statement on the server once per connection
+    (PREPARE q_... AS ... with $n parameters) and run it as EXECUTE
+    afterwards, so Postgres parses and plans it once per connection rather
+    than on every call. psycopg2 only; asyncpg already keeps a prepared
+    statement cache of its own. Streamed (server-side cursor) executions
+    and executemany are sent as they are. A statement Postgres refuses to
+    prepare (a parameter whose type it cannot infer) is logged once and
+    from then on sent unprepared; other errors while preparing (a dropped
+    connection, a timeout) are raised to the caller like any failed query;
+  * count, for every registered query, calls, errors, total time, rows and
+    the p95 of its last STATS_SAMPLE durations. Statements that were not
+    registered are pooled under UNREGISTERED, so gaps in the catalog show.
+
+Stats are per worker process, like the caches. /internal/queries shows
+them; the catalog itself:
+
+    python queries.py list
+
+    DB_PREPARE    "0" turns server-side preparation off (default on)
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import deque
+from sqlalchemy import event, text
+
+PREPARE = os.environ.get("DB_PREPARE", "1").lower() not in ("0", "false", "no")
+
+# durations kept per query for the p95
+STATS_SAMPLE = 1024
+
+UNREGISTERED = "(unregistered)"
+
+# %% is a literal percent sign in psycopg2's pyformat; %(name)s a parameter
+_PYFORMAT = re.compile(r"%%|%\((\w+)\)s")
+
+
+class QueryStats(object):
+    """Counters for one named query; updated under the registry's lock."""
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=STATS_SAMPLE)
+
+    def snapshot(self):
+        recent = sorted(self.recent)
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "errors": self.errors,
+            "rows": self.rows,
+            "rows_per_call": round(self.rows / float(self.calls), 2) if self.calls else 0.0,
+            "total_ms": round(self.total * 1000, 3),
+            "avg_ms": round(self.total / self.calls * 1000, 3) if self.calls else 0.0,
+            "p95_ms": round(p95 * 1000, 3),
+        }
+
+
+class QueryRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = {}
+        self._unregistered = QueryStats(UNREGISTERED, None)
+        # statements Postgres would not prepare; sent as plain SQL from then on
+        self.unpreparable = set()
+
+    def add(self, name, sql):
+        if name in self.queries:
+            raise ValueError("query %r is already registered" % name)
+        self.queries[name] = QueryStats(name, sql.strip())
+        return text(sql).execution_options(query_name=name)
+
+    def _stats(self, name):
+        return self.queries.get(name, self._unregistered) if name else self._unregistered
+
+    def record(self, name, elapsed, rows):
+        with self._lock:
+            stats = self._stats(name)
+            stats.calls += 1
+            stats.total += elapsed
+            if rows > 0:
+                stats.rows += rows
+            stats.recent.append(elapsed)
+
+    def record_error(self, name):
+        with self._lock:
+            self._stats(name).errors += 1
+
+    def snapshot(self):
+        """Per-query stats of the queries that have run, most total time first."""
+        with self._lock:
+            stats = [s.snapshot() for s in list(self.queries.values()) + [self._unregistered] if s.calls or s.errors]
+        stats.sort(key=lambda s: s["total_ms"], reverse=True)
+        return {"prepare": PREPARE, "unpreparable": len(self.unpreparable), "queries": stats}
+
+
+registry = QueryRegistry()
+
+
+def query(name, sql):
+    """Register a named statement and return it as a text() clause."""
+    return registry.add(name, sql)
+
+
+def prepared_form(statement):
+    """
+    The body of PREPARE for a compiled pyformat statement ($n placeholders,
+    %% unescaped) and the parameter names in $n order.
+    """
+    names = []
+
+    def placeholder(match):
+        name = match.group(1)
+        if name is None:
+            return "%"
+        if name not in names:
+            names.append(name)
+        return "$%d" % (names.index(name) + 1)
+
+    return _PYFORMAT.sub(placeholder, statement), names
+
+
+def _prepare(conn, cursor, statement):
+    """The EXECUTE form of statement on this connection, preparing it first if needed; None to send it as is."""
+    prepared = conn.info.setdefault("prepared_statements", {})
+    entry = prepared.get(statement)
+    if entry is None:
+        if statement in registry.unpreparable:
+            return None
+        body, names = prepared_form(statement)
+        name = "q_" + hashlib.md5(statement.encode("utf-8")).hexdigest()[:16]
+        # a refused PREPARE must not abort the caller's transaction
+        savepoint = not cursor.connection.autocommit
+        created = False
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT prepare_query")
+                created = True
+            cursor.execute("PREPARE %s AS %s" % (name, body))
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT prepare_query")
+        except conn.dialect.dbapi.ProgrammingError as e:
+            # the statement itself cannot be prepared (SQLSTATE class 42, e.g. a
+            # parameter of indeterminate type); anything else (a dropped connection,
+            # a timeout, an already aborted transaction) propagates and is not remembered
+            if created:
+                cursor.execute("ROLLBACK TO SAVEPOINT prepare_query")
+            print("prepare db error:", e)
+            registry.unpreparable.add(statement)
+            return None
+        args = ", ".join("%%(%s)s" % n for n in names)
+        entry = prepared[statement] = "EXECUTE %s (%s)" % (name, args) if names else "EXECUTE %s" % name
+    return entry
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    name = context.execution_options.get("query_name") if context is not None else None
+    if (name and PREPARE and conn.dialect.driver == "psycopg2" and not executemany
+            and isinstance(parameters, dict) and getattr(cursor, "name", None) is None):
+        executed = _prepare(conn, cursor, statement)
+        if executed is not None:
+            statement = executed
+    if context is not None:
+        context.query_started = time.perf_counter()
+    return statement, parameters
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "query_started", None)
+    if started is not None:
+        registry.record(context.execution_options.get("query_name"),
+                        time.perf_counter() - started, cursor.rowcount)
+
+
+def _error(exception_context):
+    context = exception_context.execution_context
+    if context is not None:
+        registry.record_error(context.execution_options.get("query_name"))
+        # report the statement as written, not the EXECUTE it was sent as
+        if exception_context.sqlalchemy_exception is not None:
+            exception_context.sqlalchemy_exception.statement = context.statement
+
+
+def instrument(engine):
+    """Attach query stats (and, on psycopg2, server-side preparation) to engine; idempotent."""
+    if not event.contains(engine, "before_cursor_execute", _before):
+        event.listen(engine, "before_cursor_execute", _before, retval=True)
+        event.listen(engine, "after_cursor_execute", _after)
+        event.listen(engine, "handle_error", _error)
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.group()
+    def cli():
+        """The app's named SQL statements."""
+
+    @cli.command('list')
+    @click.option('--sql', 'show_sql', is_flag=True, help='print each statement in full')
+    def list_cmd(show_sql):
+        """Print every registered query (importing server registers them all)."""
+        import server  # noqa: F401
+        # this file runs as __main__; the modules registered into the imported queries module
+        from queries import registry
+        for name in sorted(registry.queries):
+            sql = registry.queries[name].sql
+            if show_sql:
+                print("-- %s\n%s;\n" % (name, sql))
+            else:
+                print("%-36s %s" % (name, " ".join(sql.split())[:80]))
+
+    cli()
@@ -0,0 +1,308 @@
+"""
+Per-user reading statistics, kept in the reading_stats rollup table
+(schema.py migration 9) so the profile page reads them with one primary key
+lookup instead of aggregating the user's whole history:
+
+    books_finished         finished tracking rows
+    pages_read             page_count of finished books + current_page of the rest
+    finished_by_month      {"YYYY-MM": n} by finish_date (rows without one are not dated)
+    genres                 {genre_name: n} over finished books
+    rating_count / _sum    ratings the user has given
+    longest_streak_months  longest run of consecutive months with a finished book
+
+track_book / untrack_book call record_tracking() and post_review /
+delete_review call record_review() inside their own transaction, with the
+row as it was and as it is now. record_tracking() reads the book's page
+count and genres in that transaction rather than from the per-worker book
+cache, so each delta matches what recompute() would see at that moment; a
+count that would go negative is logged as drift. After an import changes
+page counts or genres of books people have finished, recompute.
+Backfills and repairs:
+
+    python readingstats.py recompute                  # everyone
+    python readingstats.py recompute --profile-id 42
+"""
+import json
+from decimal import Decimal
+from sqlalchemy import text
+from queries import query
+
+STATS_SQL = query("readingstats.stats", """
+    SELECT profile_id, books_finished, pages_read, rating_count, rating_sum,
+           finished_by_month, genres, longest_streak_months
+    FROM reading_stats
+    WHERE profile_id = :pid
+""")
+
+# what a finished book adds to the stats, read in the writing transaction
+BOOK_FACTS_SQL = query("readingstats.book_facts", """
+    SELECT b.page_count,
+           ARRAY(SELECT g.genre_name
+                 FROM categorized_as ca JOIN genre g ON g.genre_id = ca.genre_id
+                 WHERE ca.book_id = b.book_id) AS genres
+    FROM book b
+    WHERE b.book_id = :bid
+""")
+
+# a user's first change creates the row, so there is always one to lock
+ENSURE_SQL = query("readingstats.ensure", "INSERT INTO reading_stats (profile_id) VALUES (:pid) ON CONFLICT DO NOTHING")
+
+LOCK_SQL = query("readingstats.lock", """
+    SELECT profile_id, books_finished, pages_read, rating_count, rating_sum,
+           finished_by_month, genres, longest_streak_months
+    FROM reading_stats
+    WHERE profile_id = :pid
+    FOR UPDATE
+""")
+
+SAVE_SQL = query("readingstats.save", """
+    UPDATE reading_stats SET
+        books_finished = :books_finished,
+        pages_read = :pages_read,
+        rating_count = :rating_count,
+        rating_sum = :rating_sum,
+        finished_by_month = CAST(:finished_by_month AS jsonb),
+        genres = CAST(:genres AS jsonb),
+        longest_streak_months = :longest_streak_months,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE profile_id = :pid
+""")
+
+# Set-based rebuild from is_tracking, reviews and book; the filters restrict it to one user
+_RECOMPUTE_SQL = """
+    WITH t AS (
+        SELECT it.profile_id, it.book_id, it.status, it.current_page, it.finish_date, b.page_count
+        FROM is_tracking it
+        JOIN book b ON b.book_id = it.book_id
+        WHERE TRUE %(filter_it)s
+    ),
+    base AS (
+        SELECT profile_id,
+               COUNT(*) FILTER (WHERE status = 'finished') AS books_finished,
+               SUM(CASE WHEN status = 'finished' THEN COALESCE(page_count, 0)
+                        ELSE GREATEST(COALESCE(current_page, 0), 0) END) AS pages_read
+        FROM t GROUP BY profile_id
+    ),
+    months AS (
+        SELECT profile_id, date_trunc('month', finish_date)::date AS month, COUNT(*) AS n
+        FROM t WHERE status = 'finished' AND finish_date IS NOT NULL
+        GROUP BY 1, 2
+    ),
+    by_month AS (
+        SELECT profile_id, jsonb_object_agg(to_char(month, 'YYYY-MM'), n) AS finished_by_month
+        FROM months GROUP BY profile_id
+    ),
+    streaks AS (
+        -- consecutive months share month - (row number) months
+        SELECT profile_id, MAX(run) AS longest_streak_months FROM (
+            SELECT profile_id, COUNT(*) AS run FROM (
+                SELECT profile_id, month,
+                       month - make_interval(months => (row_number() OVER (PARTITION BY profile_id ORDER BY month))::int) AS grp
+                FROM months
+            ) m GROUP BY profile_id, grp
+        ) runs GROUP BY profile_id
+    ),
+    genres AS (
+        SELECT profile_id, jsonb_object_agg(genre_name, n) AS genres FROM (
+            SELECT t.profile_id, g.genre_name, COUNT(*) AS n
+            FROM t
+            JOIN categorized_as ca ON ca.book_id = t.book_id
+            JOIN genre g ON g.genre_id = ca.genre_id
+            WHERE t.status = 'finished'
+            GROUP BY 1, 2
+        ) x GROUP BY profile_id
+    ),
+    ratings AS (
+        SELECT profile_id, COUNT(rating) AS rating_count, COALESCE(SUM(rating), 0) AS rating_sum
+        FROM reviews WHERE TRUE %(filter_r)s
+        GROUP BY profile_id
+    ),
+    users AS (
+        SELECT profile_id FROM base UNION SELECT profile_id FROM ratings
+    )
+    INSERT INTO reading_stats (profile_id, books_finished, pages_read, rating_count, rating_sum,
+                               finished_by_month, genres, longest_streak_months, updated_at)
+    SELECT u.profile_id,
+           COALESCE(base.books_finished, 0), COALESCE(base.pages_read, 0),
+           COALESCE(ratings.rating_count, 0), COALESCE(ratings.rating_sum, 0),
+           COALESCE(by_month.finished_by_month, '{}'::jsonb), COALESCE(genres.genres, '{}'::jsonb),
+           COALESCE(streaks.longest_streak_months, 0), CURRENT_TIMESTAMP
+    FROM users u
+    LEFT JOIN base ON base.profile_id = u.profile_id
+    LEFT JOIN by_month ON by_month.profile_id = u.profile_id
+    LEFT JOIN streaks ON streaks.profile_id = u.profile_id
+    LEFT JOIN genres ON genres.profile_id = u.profile_id
+    LEFT JOIN ratings ON ratings.profile_id = u.profile_id
+    ON CONFLICT (profile_id) DO UPDATE SET
+        books_finished = EXCLUDED.books_finished,
+        pages_read = EXCLUDED.pages_read,
+        rating_count = EXCLUDED.rating_count,
+        rating_sum = EXCLUDED.rating_sum,
+        finished_by_month = EXCLUDED.finished_by_month,
+        genres = EXCLUDED.genres,
+        longest_streak_months = EXCLUDED.longest_streak_months,
+        updated_at = EXCLUDED.updated_at
+"""
+
+RECOMPUTE_ALL_SQL = [
+    query("readingstats.recompute_all_delete", "DELETE FROM reading_stats"),
+    query("readingstats.recompute_all_insert", _RECOMPUTE_SQL % {"filter_it": "", "filter_r": ""}),
+]
+
+RECOMPUTE_USER_SQL = [
+    query("readingstats.recompute_user_delete", "DELETE FROM reading_stats WHERE profile_id = :pid"),
+    query("readingstats.recompute_user_insert", _RECOMPUTE_SQL % {"filter_it": "AND it.profile_id = :pid", "filter_r": "AND profile_id = :pid"}),
+]
+
+
+def _json_dict(value):
+    # psycopg2 decodes jsonb columns; asyncpg hands them back as text
+    if isinstance(value, str):
+        value = json.loads(value)
+    return dict(value or {})
+
+
+def _bump(counts, key, n):
+    counts[key] = counts.get(key, 0) + n
+    if counts[key] < 0:
+        print("readingstats drift: %r would be %d; run `python readingstats.py recompute`" % (key, counts[key]))
+    if counts[key] <= 0:
+        del counts[key]
+
+
+def longest_streak(finished_by_month):
+    """Longest run of consecutive "YYYY-MM" keys."""
+    months = sorted(int(k[:4]) * 12 + int(k[5:7]) for k in finished_by_month)
+    best = run = 0
+    previous = None
+    for m in months:
+        run = run + 1 if previous is not None and m == previous + 1 else 1
+        best = max(best, run)
+        previous = m
+    return best
+
+
+def _empty(profile_id):
+    return {
+        "profile_id": profile_id, "books_finished": 0, "pages_read": 0,
+        "rating_count": 0, "rating_sum": 0, "finished_by_month": {}, "genres": {},
+        "longest_streak_months": 0,
+    }
+
+
+def _from_row(row):
+    return {
+        "profile_id": row.profile_id,
+        "books_finished": row.books_finished,
+        "pages_read": row.pages_read,
+        "rating_count": row.rating_count,
+        "rating_sum": row.rating_sum,
+        "finished_by_month": _json_dict(row.finished_by_month),
+        "genres": _json_dict(row.genres),
+        "longest_streak_months": row.longest_streak_months,
+    }
+
+
+def _update(conn, profile_id, change):
+    """Read the user's row under lock, let change() edit it, and write it back."""
+    conn.execute(ENSURE_SQL, {"pid": profile_id})
+    stats = _from_row(conn.execute(LOCK_SQL, {"pid": profile_id}).fetchone())
+    change(stats)
+    stats["longest_streak_months"] = longest_streak(stats["finished_by_month"])
+    params = dict(stats, pid=profile_id)
+    params["finished_by_month"] = json.dumps(stats["finished_by_month"])
+    params["genres"] = json.dumps(stats["genres"])
+    conn.execute(SAVE_SQL, params)
+
+
+def _tracking_part(stats, row, book, sign):
+    if row.status == "finished":
+        stats["books_finished"] += sign
+        stats["pages_read"] += sign * ((book.page_count or 0) if book is not None else 0)
+        if row.finish_date is not None:
+            _bump(stats["finished_by_month"], row.finish_date.strftime("%Y-%m"), sign)
+        for genre in (book.genres or []) if book is not None else []:
+            _bump(stats["genres"], genre, sign)
+    else:
+        stats["pages_read"] += sign * max(row.current_page or 0, 0)
+
+
+def record_tracking(conn, profile_id, book_id, old, new):
+    """
+    Apply the change from tracking row old to new (either may be None).
+    Rows need status, current_page and finish_date.
+    """
+    if old is None and new is None:
+        return
+    book = conn.execute(BOOK_FACTS_SQL, {"bid": book_id}).fetchone()
+
+    def change(stats):
+        if old is not None:
+            _tracking_part(stats, old, book, -1)
+        if new is not None:
+            _tracking_part(stats, new, book, +1)
+    _update(conn, profile_id, change)
+
+
+def record_review(conn, profile_id, old, new):
+    """Apply the change from review row old to new (either may be None; rows need a rating)."""
+    # rating_sum is numeric (a Decimal); convert the way bookstats.py does, whatever the rating column type
+    old_rating = Decimal(str(old.rating)) if old is not None and old.rating is not None else None
+    new_rating = Decimal(str(new.rating)) if new is not None and new.rating is not None else None
+    if old_rating is None and new_rating is None:
+        return
+
+    def change(stats):
+        if old_rating is not None:
+            stats["rating_count"] -= 1
+            stats["rating_sum"] -= old_rating
+        if new_rating is not None:
+            stats["rating_count"] += 1
+            stats["rating_sum"] += new_rating
+    _update(conn, profile_id, change)
+
+
+def stats_from_row(row):
+    """Shape a STATS_SQL row (or None) for profile.html."""
+    stats = _from_row(row) if row is not None else _empty(None)
+    by_year = {}
+    for month, n in stats["finished_by_month"].items():
+        by_year[month[:4]] = by_year.get(month[:4], 0) + n
+    stats["finished_by_year"] = sorted(by_year.items(), reverse=True)
+    stats["recent_months"] = sorted(stats["finished_by_month"].items(), reverse=True)[:12]
+    stats["top_genres"] = sorted(stats["genres"].items(), key=lambda kv: (-kv[1], kv[0]))[:5]
+    stats["avg_rating"] = (round(float(stats["rating_sum"]) / stats["rating_count"], 2)
+                           if stats["rating_count"] else None)
+    return stats
+
+
+def load_reading_stats(conn, profile_id):
+    return stats_from_row(conn.execute(STATS_SQL, {"pid": profile_id}).fetchone())
+
+
+def recompute(conn, profile_id=None):
+    """Rebuild reading_stats from is_tracking, reviews and book for one user or everyone."""
+    statements = RECOMPUTE_ALL_SQL if profile_id is None else RECOMPUTE_USER_SQL
+    for stmt in statements:
+        conn.execute(stmt, {"pid": profile_id})
+
+
+if __name__ == "__main__":
+    import click
+    from db import DATABASEURI, make_engine
+
+    @click.group()
+    def cli():
+        """Maintenance for the reading_stats rollup."""
+
+    @cli.command('recompute')
+    @click.option('--profile-id', type=int, default=None)
+    def recompute_cmd(profile_id):
+        """Rebuild reading_stats from scratch."""
+        with make_engine(DATABASEURI).connect() as conn:
+            with conn.begin():
+                recompute(conn, profile_id)
+                count = conn.execute(text("SELECT COUNT(*) FROM reading_stats")).scalar()
+        print("reading_stats recomputed: %d rows" % count)
+
+    cli()
@@ -0,0 +1,290 @@
+"""
+Item-to-item recommendations, built offline and read with one indexed query.
+
+A batch job turns shelf additions (contains_book via bookshelf), ratings
+(reviews) and finished books (is_tracking) into a sparse user x book matrix
+of interaction weights, computes cosine similarity between books with SciPy
+sparse products and writes
+
+    book_similar          top SIMILAR_K similar books per book    ("Readers also liked" on the book page)
+    user_recommendation   top RECOMMEND_N unseen books per user   ("Recommended for you" on the profile)
+
+(schema.py migration 10). The web pages only read these tables, by primary
+key prefix, and never import numpy or scipy.
+
+    python recommend.py build              # needs numpy and scipy
+    python recommend.py build -k 30 -n 50
+    python recommend.py bench --books 1000000 --users 1000000 --interactions 20000000
+
+Similarity is computed a block of books at a time (X[:, block].T @ X), so
+peak memory is the interaction matrix plus one block of products rather
+than the full book x book matrix. Users with more than MAX_USER_ITEMS
+interactions (importers, bots) are left out of the similarity step, since
+each of them adds len(items)^2 products; they still get recommendations.
+"""
+import resource
+import time
+from sqlalchemy import text
+from queries import query
+
+SIMILAR_K = 20
+RECOMMEND_N = 20
+MAX_USER_ITEMS = 1000
+BOOK_BLOCK = 20000
+USER_BLOCK = 50000
+LOAD_CHUNK_ROWS = 100000
+
+# interaction weight of a (user, book) pair: the strongest signal wins.
+# Finishing or shelving a book counts fully; a review counts by its rating
+# (an unrated review as a neutral 0.5).
+INTERACTIONS_SQL = text("""
+    SELECT profile_id, book_id, MAX(w) AS w FROM (
+        SELECT bs.profile_id, cb.book_id, 1.0 AS w
+        FROM contains_book cb
+        JOIN bookshelf bs ON bs.bookshelf_id = cb.bookshelf_id
+        UNION ALL
+        SELECT profile_id, book_id, COALESCE(rating / 5.0, 0.5)
+        FROM reviews
+        UNION ALL
+        SELECT profile_id, book_id, 1.0
+        FROM is_tracking
+        WHERE status = 'finished'
+    ) i
+    WHERE profile_id IS NOT NULL
+    GROUP BY profile_id, book_id
+""")
+
+SIMILAR_BOOKS_SQL = query("recommend.similar_books", """
+    SELECT b.book_id AS id,
+           b.title AS title,
+           b.publication_year AS published_year,
+           b.image_url AS image_url
+    FROM book_similar s
+    JOIN book b ON b.book_id = s.similar_book_id
+    WHERE s.book_id = :book_id
+    ORDER BY s.rank
+    LIMIT :limit
+""")
+
+RECOMMENDED_BOOKS_SQL = query("recommend.recommended_books", """
+    SELECT b.book_id AS id,
+           b.title AS title,
+           b.publication_year AS published_year,
+           b.image_url AS image_url
+    FROM user_recommendation r
+    JOIN book b ON b.book_id = r.book_id
+    WHERE r.profile_id = :pid
+    ORDER BY r.rank
+    LIMIT :limit
+""")
+
+# how many of each the pages show
+SHOWN = 8
+
+
+def similar_books(conn, book_id, limit=SHOWN):
+    from catalog import book_cards
+    return book_cards(conn.execute(SIMILAR_BOOKS_SQL, {"book_id": book_id, "limit": limit}))
+
+
+def recommended_books(conn, profile_id, limit=SHOWN):
+    from catalog import book_cards
+    return book_cards(conn.execute(RECOMMENDED_BOOKS_SQL, {"pid": profile_id, "limit": limit}))
+
+
+#
+# Build (numpy / scipy from here on)
+#
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Timer(object):
+    """Prints how long each phase took and the peak RSS so far."""
+
+    def __init__(self):
+        self.started = self.last = time.time()
+
+    def phase(self, name):
+        now = time.time()
+        print("%-22s %8.1fs   peak rss %7.0f MB" % (name, now - self.last, peak_rss_mb()))
+        self.last = now
+
+    def total(self):
+        return time.time() - self.started
+
+
+def load_interactions(conn):
+    """(profile_ids, book_ids, weights) arrays, streamed from INTERACTIONS_SQL."""
+    import numpy as np
+    users, books, weights = [], [], []
+    # per statement: Connection.execution_options() would leave yield_per on for the writes too
+    result = conn.execute(INTERACTIONS_SQL, execution_options={"yield_per": LOAD_CHUNK_ROWS})
+    for rows in result.partitions():
+        u, b, w = zip(*rows)
+        users.append(np.array(u, dtype=np.int64))
+        books.append(np.array(b, dtype=np.int64))
+        weights.append(np.array(w, dtype=np.float32))
+    if not users:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.float32)
+    return np.concatenate(users), np.concatenate(books), np.concatenate(weights)
+
+
+def interaction_matrix(profile_ids, book_ids, weights):
+    """CSR user x book matrix plus the ids of its rows and columns."""
+    import numpy as np
+    from scipy import sparse
+    user_ids, rows = np.unique(profile_ids, return_inverse=True)
+    item_ids, cols = np.unique(book_ids, return_inverse=True)
+    X = sparse.csr_matrix((weights, (rows, cols)), shape=(len(user_ids), len(item_ids)), dtype=np.float32)
+    X.sum_duplicates()
+    return X, user_ids, item_ids
+
+
+def top_k_per_row(M, k, exclude=None):
+    """
+    Keep the k largest positive entries of every row of CSR matrix M.
+    Returns (row, col, score, rank) arrays. exclude, if given, is the column
+    to drop from each row (a book is not similar to itself).
+    """
+    import numpy as np
+    M = M.tocsr()
+    M.eliminate_zeros()
+    counts = np.diff(M.indptr)
+    rows = np.repeat(np.arange(M.shape[0]), counts)
+    cols, data = M.indices, M.data
+    keep = data > 0
+    if exclude is not None:
+        keep &= cols != exclude[rows]
+    rows, cols, data = rows[keep], cols[keep], data[keep]
+    # by row, then score descending, then column for a stable order
+    order = np.lexsort((cols, -data, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    starts = np.searchsorted(rows, np.arange(M.shape[0]))
+    rank = np.arange(len(rows)) - starts[rows]
+    keep = rank < k
+    return rows[keep], cols[keep], data[keep], rank[keep]
+
+
+def item_similarity(X, k=SIMILAR_K, block=BOOK_BLOCK, max_user_items=MAX_USER_ITEMS):
+    """Top-k cosine neighbours of every column of X, as a CSR book x book matrix."""
+    import numpy as np
+    from scipy import sparse
+    n_items = X.shape[1]
+    per_user = np.diff(X.indptr)
+    if max_user_items:
+        X = sparse.diags((per_user <= max_user_items).astype(np.float32)) @ X
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=0)).ravel())
+    norms[norms == 0] = 1.0
+    Xn = (X @ sparse.diags(1.0 / norms).astype(np.float32)).tocsr()
+    XnT = Xn.T.tocsr()
+
+    parts = []
+    for start in range(0, n_items, block):
+        stop = min(start + block, n_items)
+        S = XnT[start:stop] @ Xn
+        rows, cols, data, _ = top_k_per_row(S, k, exclude=np.arange(start, stop))
+        parts.append((rows + start, cols, data))
+    rows = np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, np.int64)
+    cols = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, np.int64)
+    data = np.concatenate([p[2] for p in parts]) if parts else np.zeros(0, np.float32)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(n_items, n_items), dtype=np.float32)
+
+
+def user_recommendations(X, S, n=RECOMMEND_N, block=USER_BLOCK):
+    """
+    Yield (row, col, score, rank) arrays, a block of users at a time: each
+    user's interactions times the similarity matrix, minus what they have seen.
+    """
+    for start in range(0, X.shape[0], block):
+        Xb = X[start:start + block]
+        R = Xb @ S
+        seen = Xb.copy()
+        seen.data[:] = 1
+        R = R - R.multiply(seen)
+        rows, cols, data, rank = top_k_per_row(R, n)
+        yield rows + start, cols, data, rank
+
+
+def build(conn, k=SIMILAR_K, n=RECOMMEND_N, verbose=True):
+    """Recompute book_similar and user_recommendation; the caller commits."""
+    from importer import copy_rows
+    timer = Timer()
+    profile_ids, book_ids, weights = load_interactions(conn)
+    X, user_ids, item_ids = interaction_matrix(profile_ids, book_ids, weights)
+    del profile_ids, book_ids, weights
+    if verbose:
+        print("%d users x %d books, %d interactions" % (X.shape[0], X.shape[1], X.nnz))
+        timer.phase("load")
+
+    S = item_similarity(X, k)
+    if verbose:
+        timer.phase("item similarity")
+
+    # readers keep seeing the old rows until the transaction commits
+    conn.execute(text("DELETE FROM book_similar"))
+    conn.execute(text("DELETE FROM user_recommendation"))
+    rows, cols, data, rank = top_k_per_row(S, k)
+    copy_rows(conn, "book_similar", ("book_id", "rank", "similar_book_id", "score"),
+              list(zip(item_ids[rows].tolist(), rank.tolist(), item_ids[cols].tolist(), data.tolist())))
+    if verbose:
+        timer.phase("write book_similar")
+
+    for rows, cols, data, rank in user_recommendations(X, S, n):
+        copy_rows(conn, "user_recommendation", ("profile_id", "rank", "book_id", "score"),
+                  list(zip(user_ids[rows].tolist(), rank.tolist(), item_ids[cols].tolist(), data.tolist())))
+    if verbose:
+        timer.phase("user recommendations")
+        print("built in %.1fs, peak rss %.0f MB" % (timer.total(), peak_rss_mb()))
+
+
+def bench(n_books, n_users, n_interactions, k=SIMILAR_K, n=RECOMMEND_N, seed=0):
+    """Time the matrix part of build() on synthetic data with Zipf-like book popularity."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    timer = Timer()
+    users = rng.integers(0, n_users, n_interactions)
+    books = (rng.zipf(1.3, n_interactions) - 1) % n_books
+    weights = np.ones(n_interactions, dtype=np.float32)
+    X, _, _ = interaction_matrix(users, books, weights)
+    del users, books, weights
+    print("%d users x %d books, %d interactions" % (X.shape[0], X.shape[1], X.nnz))
+    timer.phase("generate")
+    S = item_similarity(X, k)
+    timer.phase("item similarity")
+    count = 0
+    for rows, _, _, _ in user_recommendations(X, S, n):
+        count += len(rows)
+    timer.phase("user recommendations")
+    print("%d similar rows, %d recommendation rows in %.1fs, peak rss %.0f MB"
+          % (S.nnz, count, timer.total(), peak_rss_mb()))
+
+
+if __name__ == "__main__":
+    import click
+    from db import DATABASEURI, make_engine
+
+    @click.group()
+    def cli():
+        """Offline recommendation tables."""
+
+    @cli.command('build')
+    @click.option('-k', 'k', type=int, default=SIMILAR_K, help='similar books kept per book')
+    @click.option('-n', 'n', type=int, default=RECOMMEND_N, help='recommendations kept per user')
+    def build_cmd(k, n):
+        """Rebuild book_similar and user_recommendation from the current data."""
+        with make_engine(DATABASEURI).connect() as conn:
+            with conn.begin():
+                build(conn, k, n)
+
+    @cli.command('bench')
+    @click.option('--books', type=int, default=1000000)
+    @click.option('--users', type=int, default=1000000)
+    @click.option('--interactions', type=int, default=20000000)
+    def bench_cmd(books, users, interactions):
+        """Time and size a build on synthetic data (no database needed)."""
+        bench(books, users, interactions)
+
+    cli()
@@ -0,0 +1,212 @@
+"""
+Row-to-record mapping, compiled once per result shape.
+
+A RowMapper names the fields a page needs and, optionally, the result
+column each one comes from. The first time it sees a result it looks the
+columns up once and builds a converter: one itemgetter over the row's
+positions feeding the generated __init__ of a __slots__ record class. Every
+further row is then a C-level tuple pick and one constructor call, with no
+per-column name lookups and no per-row dict.
+
+Records read like the dicts they replace: templates use attribute access
+(b.title), route code may still use r["likes_count"] and r.get("x"), and
+_asdict() gives a plain dict where one is needed (JSON).
+
+    BOOK_CARD = RowMapper("BookCard", ["id", "title", "published_year", "image_url"])
+    SHELF = RowMapper("Shelf", [("id", "bookshelf_id"), ("name", "shelf_name"), "is_public"])
+
+    cards = BOOK_CARD.all(conn.execute(AUTHOR_BOOKS_SQL, params))
+    shelf = SHELF.one(conn.execute(BOOKSHELF_SQL, params).fetchone())
+
+Micro-benchmark against per-column probing and attribute-built dicts:
+
+    python records.py [--rows 10000]
+"""
+import operator
+
+
+class Record(object):
+    """Base of the generated record classes."""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def _asdict(self):
+        return dict((f, getattr(self, f)) for f in self.__slots__)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._asdict() == other._asdict()
+        if isinstance(other, dict):
+            return self._asdict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__,
+                           ", ".join("%s=%r" % (f, getattr(self, f)) for f in self.__slots__))
+
+
+_record_types = {}
+
+
+def record_type(name, fields):
+    """The __slots__ record class for these fields (one class per name and field list)."""
+    fields = tuple(fields)
+    key = (name, fields)
+    cls = _record_types.get(key)
+    if cls is None:
+        for f in fields:
+            if not f.isidentifier():
+                raise ValueError("record field %r is not an identifier" % f)
+        # a generated positional __init__, as namedtuple does, is the cheapest constructor
+        source = "def __init__(self, %s):\n%s" % (
+            ", ".join(fields), "".join("    self.%s = %s\n" % (f, f) for f in fields) or "    pass\n")
+        namespace = {}
+        exec(source, namespace)
+        cls = type(name, (Record,), {"__slots__": fields, "__init__": namespace["__init__"]})
+        _record_types[key] = cls
+    return cls
+
+
+class RowMapper(object):
+    """
+    Maps result rows to records. fields is a list of names, or (name, column)
+    pairs where the record field and the result column differ; None takes
+    every column of the result under its own name.
+    """
+
+    def __init__(self, name, fields=None):
+        self.name = name
+        self.fields = None if fields is None else [f if isinstance(f, tuple) else (f, f) for f in fields]
+        self._converters = {}
+
+    def converter(self, keys):
+        """The compiled row -> record function for results with these column names."""
+        keys = tuple(keys)
+        convert = self._converters.get(keys)
+        if convert is None:
+            fields = self.fields if self.fields is not None else [(k, k) for k in keys]
+            positions = [keys.index(column) for _, column in fields]
+            cls = record_type(self.name, [name for name, _ in fields])
+            if len(positions) == 1:
+                position = positions[0]
+                convert = lambda row: cls(row[position])
+            else:
+                pick = operator.itemgetter(*positions)
+                convert = lambda row: cls(*pick(row))
+            self._converters[keys] = convert
+        return convert
+
+    def all(self, rows):
+        """Records for a list of rows or a whole result."""
+        if not isinstance(rows, list):
+            rows = rows.fetchall() if hasattr(rows, "fetchall") else list(rows)
+        if not rows:
+            return []
+        return list(map(self.converter(rows[0]._fields), rows))
+
+    def one(self, row):
+        """The record for one row, or None."""
+        if row is None:
+            return None
+        return self.converter(row._fields)(row)
+
+
+if __name__ == "__main__":
+    import gc
+    import sys
+    import time
+    import tracemalloc
+    import click
+    from sqlalchemy import create_engine, text
+
+    COLUMNS = ("profile_id", "rating", "review_text", "reviewed_at", "likes_count", "username")
+    REVIEW = RowMapper("Review", COLUMNS)
+
+    def probing(rows):
+        # the pattern the routes used before: a hasattr and a dict lookup per column per row
+        out = []
+        for r in rows:
+            rm = getattr(r, "_mapping", r)
+            out.append(dict((c, rm.get(c) if hasattr(rm, "get") else r[i]) for i, c in enumerate(COLUMNS)))
+        return out
+
+    def attribute_dicts(rows):
+        # the *_from_row helpers: attribute access into a fresh dict
+        return [{
+            "profile_id": r.profile_id,
+            "rating": r.rating,
+            "review_text": r.review_text,
+            "reviewed_at": r.reviewed_at,
+            "likes_count": r.likes_count,
+            "username": r.username,
+        } for r in rows]
+
+    def compiled(rows):
+        return REVIEW.all(rows)
+
+    def per_row_us(fn, rows, repeat):
+        best = None
+        for _ in range(repeat):
+            gc.collect()
+            started = time.perf_counter()
+            fn(rows)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best / len(rows) * 1e6
+
+    def retained_kb(fn, rows):
+        gc.collect()
+        tracemalloc.start()
+        result = fn(rows)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        return size / 1024.0
+
+    @click.command()
+    @click.option('--rows', 'count', type=int, default=10000)
+    @click.option('--repeat', type=int, default=20)
+    def bench(count, repeat):
+        """Per-row cost and memory of the three row -> object patterns (uses in-memory SQLite)."""
+        engine = create_engine("sqlite://")
+        with engine.connect() as conn:
+            conn.execute(text("CREATE TABLE r (profile_id integer, rating real, review_text text, "
+                              "reviewed_at text, likes_count integer, username text)"))
+            conn.execute(text("INSERT INTO r VALUES (:p, :r, :t, :d, :l, :u)"), [
+                {"p": i, "r": i % 5 + 0.5, "t": "review %d" % i, "d": "2026-01-01 00:00:00",
+                 "l": i % 17, "u": "user%d" % i} for i in range(count)])
+            rows = conn.execute(text("SELECT %s FROM r" % ", ".join(COLUMNS))).fetchall()
+
+        print("python %s, %d rows, best of %d" % (sys.version.split()[0], count, repeat))
+        print("%-18s %12s %18s" % ("pattern", "us / row", "KB / %d rows" % count))
+        for label, fn in (("_mapping probing", probing), ("attribute dicts", attribute_dicts),
+                          ("compiled records", compiled)):
+            print("%-18s %12.3f %18.0f" % (label, per_row_us(fn, rows, repeat), retained_kb(fn, rows)))
+
+    bench()
@@ -0,0 +1,90 @@
+"""
+Keyset-paginated reviews for the book page.
+
+Each sort mode orders by one key plus profile_id as a tie-breaker and is
+backed by an index on (book_id, key, profile_id) (schema.py migrations 4
+and 15), so fetching page N costs the same as fetching page 1: the cursor
+is the last row's (key, profile_id) and the next page starts right after it.
+Nullable keys are COALESCEd to a value below every real one (-1 for
+ratings, the epoch for reviewed_at), so NULLs sort last and a cursor
+always has a key to encode.
+"""
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from queries import query
+from records import RowMapper
+
+REVIEWS_PAGE_SIZE = 20
+
+# sort mode -> (key expression, parser for the key half of a cursor)
+REVIEW_SORTS = {
+    "newest": ("COALESCE(r.reviewed_at, 'epoch')", datetime.fromisoformat),
+    "most_liked": ("COALESCE(r.likes_count, 0)", int),
+    "highest_rated": ("COALESCE(r.rating, -1)", Decimal),
+}
+DEFAULT_SORT = "newest"
+
+_REVIEWS_SQL = '''
+    SELECT r.profile_id, r.rating, r.review_text, r.reviewed_at, COALESCE(r.likes_count, 0) AS likes_count,
+           p.username,
+           {key} AS sort_key
+    FROM reviews r
+    LEFT JOIN profile p ON r.profile_id = p.profile_id
+    WHERE r.book_id = :book_id {after}
+    ORDER BY {key} DESC, r.profile_id DESC
+    LIMIT :limit
+'''
+
+# compiled once per (sort, first page / next page)
+_STATEMENTS = {}
+for _sort, (_key, _) in REVIEW_SORTS.items():
+    _STATEMENTS[_sort, False] = query("reviews.%s_first" % _sort, _REVIEWS_SQL.format(key=_key, after=""))
+    _STATEMENTS[_sort, True] = query("reviews.%s_next" % _sort, _REVIEWS_SQL.format(
+        key=_key, after="AND (%s, r.profile_id) < (:after_key, :after_pid)" % _key))
+
+REVIEW = RowMapper("Review", ["profile_id", "rating", "review_text", "reviewed_at", "likes_count", "username"])
+
+
+def encode_cursor(sort, sort_key, profile_id):
+    if sort == "newest":
+        sort_key = sort_key.isoformat()
+    return "%s~%d" % (sort_key, profile_id)
+
+
+def decode_cursor(sort, cursor):
+    """Return (key, profile_id) or None for a missing / malformed cursor."""
+    if not cursor:
+        return None
+    try:
+        key, pid = cursor.rsplit("~", 1)
+        return REVIEW_SORTS[sort][1](key), int(pid)
+    except (ValueError, TypeError, InvalidOperation):
+        return None
+
+
+def reviews_query(book_id, sort=DEFAULT_SORT, after=None, page_size=REVIEWS_PAGE_SIZE):
+    """Return (statement, params) for one page of a book's reviews."""
+    params = {"book_id": book_id, "limit": page_size + 1}
+    position = decode_cursor(sort, after)
+    if position is not None:
+        params["after_key"], params["after_pid"] = position
+    return _STATEMENTS[sort, position is not None], params
+
+
+def reviews_page(rows, sort=DEFAULT_SORT, page_size=REVIEWS_PAGE_SIZE):
+    """Shape the rows of a reviews_query() into (reviews, next_cursor)."""
+    reviews = REVIEW.all(rows[:page_size])
+
+    next_cursor = None
+    if len(rows) > page_size:
+        last = rows[page_size - 1]
+        next_cursor = encode_cursor(sort, last.sort_key, last.profile_id)
+    return reviews, next_cursor
+
+
+def load_reviews(conn, book_id, sort=DEFAULT_SORT, after=None, page_size=REVIEWS_PAGE_SIZE):
+    """Return (reviews, next_cursor) for one page of a book's reviews."""
+    if sort not in REVIEW_SORTS:
+        sort = DEFAULT_SORT
+    rows = conn.execute(*reviews_query(book_id, sort, after, page_size)).fetchall()
+    return reviews_page(rows, sort, page_size)
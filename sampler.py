@@ -0,0 +1,133 @@
+"""
+On-demand sampling profiler for a running worker.
+
+sample_to_file() starts a daemon thread that wakes every interval seconds
+for the given time, reads the stack of every other thread of the process
+with sys._current_frames() and counts each distinct stack. Nothing is
+installed or traced between samples, so the process runs at full speed
+apart from the sampling thread itself (about 1-2% CPU at the default
+100 Hz).
+
+When the time is up the counts are written to a file in the
+collapsed-stack format that flamegraph.pl, speedscope and inferno read,
+one line per stack:
+
+    thread-name;file.py:outer:12;file.py:inner:40 17
+
+Frames are named by file, function and the function's first line, so all
+samples inside one function add up. Threads parked in a wait (idle pool
+workers, the accept loop) are left out unless include_idle is set.
+
+server.py exposes it as /debug/profile?seconds=N (internal callers only).
+The request only starts sample_to_file() and answers at once, so a sync
+worker (one request thread, the launcher's default) goes on serving
+requests while they are sampled, and a profile never holds a request open
+anywhere near the worker timeout. The result
+is written to PROFILE_DIR, which every worker on the host shares, and
+fetched with a second request that any worker can answer. One profile
+runs at a time per worker.
+
+    PROFILE_DIR   where collapsed profiles are written (default: the temp directory)
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+DEFAULT_SECONDS = 10
+# well below the launcher's default WEB_TIMEOUT of 60, in case a worker is recycled mid-profile
+MAX_SECONDS = 30
+DEFAULT_INTERVAL = 0.01
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or tempfile.gettempdir()
+
+# suffix of the marker file that exists while a profile is being taken
+RUNNING_SUFFIX = ".running"
+
+# (file, function) of the innermost Python frame of a thread blocked waiting for work
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("socket.py", "accept"),
+    ("socketserver.py", "serve_forever"),
+    ("base_events.py", "_run_once"),
+    # gunicorn's sync worker waiting for a connection
+    ("sync.py", "wait"),
+}
+
+_running = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+
+def _sample(seconds, interval, include_idle):
+    """Return a Counter of collapsed stacks sampled from every other thread for seconds."""
+    own = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            leaf = frame.f_code
+            if not include_idle and (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_FRAMES:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame))
+                frame = frame.f_back
+            frames.append(names.get(ident, "thread-%d" % ident).replace(" ", "_"))
+            stacks[";".join(reversed(frames))] += 1
+        frame = None
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks):
+    """The collapsed-stack text of _sample()'s counts, heaviest stacks first."""
+    return "".join("%s %d\n" % (stack, count) for stack, count in stacks.most_common())
+
+
+def sample_to_file(path, seconds=DEFAULT_SECONDS, include_idle=False):
+    """
+    Sample on a daemon thread and write collapsed() to path when done;
+    path + RUNNING_SUFFIX exists meanwhile. Raises ProfilerBusy at once if
+    this process is already profiling.
+    """
+    if not _running.acquire(False):
+        raise ProfilerBusy()
+
+    def _run():
+        try:
+            stacks = _sample(seconds, DEFAULT_INTERVAL, include_idle)
+            with open(path + ".tmp", "w") as f:
+                f.write(collapsed(stacks))
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print("profiler error:", e)
+        finally:
+            try:
+                os.remove(path + RUNNING_SUFFIX)
+            except OSError:
+                pass
+            _running.release()
+
+    try:
+        open(path + RUNNING_SUFFIX, "w").close()
+        t = threading.Thread(target=_run, name="profiler", daemon=True)
+        t.start()
+    except Exception:
+        _running.release()
+        raise
+    return t
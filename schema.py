@@ -0,0 +1,776 @@
+"""
+Versioned schema migrations and index checks.
+
+Migrations run once, explicitly, instead of on every import of server.py:
+
+    python schema.py migrate     apply any migrations not yet recorded
+    python schema.py status      list applied / pending migrations
+    python schema.py check       report indexes the queries in server.py need but lack
+
+Applied versions are recorded in the schema_migrations table. A Postgres
+advisory lock makes it safe for several workers or deploy hooks to call
+migrate at the same time: only one applies, the rest wait and find nothing to do.
+"""
+from sqlalchemy import text
+from db import DATABASEURI, make_engine
+
+# arbitrary constant used as the advisory lock key for migrations
+MIGRATION_LOCK_ID = 4111002
+
+#
+# Each migration is (version, description, [statements]). Append new ones at
+# the end with the next version number; never edit one that has shipped.
+#
+MIGRATIONS = [
+    (1, "indexes for the hot joins in server.py", [
+        "CREATE INDEX IF NOT EXISTS written_by_author_id_idx ON written_by (author_id)",
+        "CREATE INDEX IF NOT EXISTS categorized_as_book_id_idx ON categorized_as (book_id)",
+        "CREATE INDEX IF NOT EXISTS reviews_book_id_reviewed_at_idx ON reviews (book_id, reviewed_at)",
+        "CREATE INDEX IF NOT EXISTS follows_following_id_idx ON follows (following_id)",
+        "CREATE INDEX IF NOT EXISTS is_tracking_profile_id_idx ON is_tracking (profile_id)",
+        "CREATE INDEX IF NOT EXISTS participates_in_challenge_id_joined_at_idx ON participates_in (challenge_id, joined_at)",
+        "CREATE INDEX IF NOT EXISTS contains_book_bookshelf_id_idx ON contains_book (bookshelf_id)",
+    ]),
+    (2, "full-text search vector on book (title, author names, summary)", [
+        "ALTER TABLE book ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        """
+        CREATE OR REPLACE FUNCTION book_search_vector(p_book_id integer, p_title text, p_summary text)
+        RETURNS tsvector LANGUAGE sql STABLE AS $$
+            SELECT setweight(to_tsvector('english', coalesce(p_title, '')), 'A')
+                || setweight(to_tsvector('english', coalesce((
+                       SELECT string_agg(a.name, ' ')
+                       FROM written_by wb
+                       JOIN author a ON a.author_id = wb.author_id
+                       WHERE wb.book_id = p_book_id), '')), 'B')
+                || setweight(to_tsvector('english', coalesce(p_summary, '')), 'C')
+        $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION book_search_vector_book_trg() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.search_vector := book_search_vector(NEW.book_id, NEW.title, NEW.summary);
+            RETURN NEW;
+        END
+        $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION book_search_vector_written_by_trg() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE book SET search_vector = book_search_vector(book_id, title, summary)
+                WHERE book_id = OLD.book_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE book SET search_vector = book_search_vector(book_id, title, summary)
+                WHERE book_id = NEW.book_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION book_search_vector_author_trg() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE book SET search_vector = book_search_vector(book_id, title, summary)
+            WHERE book_id IN (SELECT book_id FROM written_by WHERE author_id = NEW.author_id);
+            RETURN NULL;
+        END
+        $$
+        """,
+        "DROP TRIGGER IF EXISTS book_search_vector_book ON book",
+        """
+        CREATE TRIGGER book_search_vector_book
+        BEFORE INSERT OR UPDATE OF title, summary ON book
+        FOR EACH ROW EXECUTE FUNCTION book_search_vector_book_trg()
+        """,
+        "DROP TRIGGER IF EXISTS book_search_vector_written_by ON written_by",
+        """
+        CREATE TRIGGER book_search_vector_written_by
+        AFTER INSERT OR UPDATE OR DELETE ON written_by
+        FOR EACH ROW EXECUTE FUNCTION book_search_vector_written_by_trg()
+        """,
+        "DROP TRIGGER IF EXISTS book_search_vector_author ON author",
+        """
+        CREATE TRIGGER book_search_vector_author
+        AFTER UPDATE OF name ON author
+        FOR EACH ROW EXECUTE FUNCTION book_search_vector_author_trg()
+        """,
+        "UPDATE book SET search_vector = book_search_vector(book_id, title, summary)",
+        "CREATE INDEX IF NOT EXISTS book_search_vector_idx ON book USING gin (search_vector)",
+    ]),
+    (3, "keyset index for paginated profile followers", [
+        "CREATE INDEX IF NOT EXISTS follows_following_id_follower_id_idx ON follows (following_id, follower_id)",
+    ]),
+    (4, "keyset indexes for the book page review sort modes", [
+        "CREATE INDEX IF NOT EXISTS reviews_book_newest_idx ON reviews (book_id, reviewed_at, profile_id)",
+        "CREATE INDEX IF NOT EXISTS reviews_book_most_liked_idx ON reviews (book_id, (COALESCE(likes_count, 0)), profile_id)",
+        "CREATE INDEX IF NOT EXISTS reviews_book_highest_rated_idx ON reviews (book_id, (COALESCE(rating, -1)), profile_id)",
+        # superseded by reviews_book_newest_idx
+        "DROP INDEX IF EXISTS reviews_book_id_reviewed_at_idx",
+    ]),
+    (5, "per-user review like set", [
+        """
+        CREATE TABLE IF NOT EXISTS review_likes (
+            profile_id integer NOT NULL,
+            book_id integer NOT NULL,
+            liker_id integer NOT NULL REFERENCES profile (profile_id) ON DELETE CASCADE,
+            liked_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (profile_id, book_id, liker_id),
+            FOREIGN KEY (profile_id, book_id) REFERENCES reviews (profile_id, book_id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (6, "block id sequences for profile and bookshelf (see ids.py)", [
+        "CREATE SEQUENCE IF NOT EXISTS profile_id_block_seq INCREMENT BY 100 MINVALUE 1",
+        "SELECT setval('profile_id_block_seq', (SELECT COALESCE(MAX(profile_id), 0) + 1 FROM profile), false)",
+        "CREATE SEQUENCE IF NOT EXISTS bookshelf_id_block_seq INCREMENT BY 100 MINVALUE 1",
+        "SELECT setval('bookshelf_id_block_seq', (SELECT COALESCE(MAX(bookshelf_id), 0) + 1 FROM bookshelf), false)",
+    ]),
+    (7, "name lookup indexes and trigger bypass for the bulk importer (see importer.py)", [
+        "CREATE INDEX IF NOT EXISTS author_name_idx ON author (name)",
+        "CREATE INDEX IF NOT EXISTS genre_genre_name_idx ON genre (genre_name)",
+        # a session that sets bookshelf.bulk_load = 'on' recomputes search
+        # vectors itself, once per book, after loading a batch
+        """
+        CREATE OR REPLACE FUNCTION book_search_vector_book_trg() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF current_setting('bookshelf.bulk_load', true) = 'on' THEN
+                RETURN NEW;
+            END IF;
+            NEW.search_vector := book_search_vector(NEW.book_id, NEW.title, NEW.summary);
+            RETURN NEW;
+        END
+        $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION book_search_vector_written_by_trg() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF current_setting('bookshelf.bulk_load', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE book SET search_vector = book_search_vector(book_id, title, summary)
+                WHERE book_id = OLD.book_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE book SET search_vector = book_search_vector(book_id, title, summary)
+                WHERE book_id = NEW.book_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        """,
+    ]),
+    (8, "per-book review and tracking aggregates (see bookstats.py)", [
+        """
+        CREATE TABLE IF NOT EXISTS book_stats (
+            book_id integer PRIMARY KEY REFERENCES book (book_id) ON DELETE CASCADE,
+            review_count integer NOT NULL DEFAULT 0,
+            rating_count integer NOT NULL DEFAULT 0,
+            rating_sum numeric NOT NULL DEFAULT 0,
+            ratings_0 integer NOT NULL DEFAULT 0,
+            ratings_1 integer NOT NULL DEFAULT 0,
+            ratings_2 integer NOT NULL DEFAULT 0,
+            ratings_3 integer NOT NULL DEFAULT 0,
+            ratings_4 integer NOT NULL DEFAULT 0,
+            ratings_5 integer NOT NULL DEFAULT 0,
+            tracker_count integer NOT NULL DEFAULT 0,
+            planning_count integer NOT NULL DEFAULT 0,
+            reading_count integer NOT NULL DEFAULT 0,
+            on_hold_count integer NOT NULL DEFAULT 0,
+            finished_count integer NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO book_stats (book_id, review_count, rating_count, rating_sum,
+                                ratings_0, ratings_1, ratings_2, ratings_3, ratings_4, ratings_5)
+        SELECT book_id, COUNT(*), COUNT(rating), COALESCE(SUM(rating), 0),
+               COUNT(rating) FILTER (WHERE LEAST(FLOOR(rating), 5) = 0),
+               COUNT(rating) FILTER (WHERE LEAST(FLOOR(rating), 5) = 1),
+               COUNT(rating) FILTER (WHERE LEAST(FLOOR(rating), 5) = 2),
+               COUNT(rating) FILTER (WHERE LEAST(FLOOR(rating), 5) = 3),
+               COUNT(rating) FILTER (WHERE LEAST(FLOOR(rating), 5) = 4),
+               COUNT(rating) FILTER (WHERE LEAST(FLOOR(rating), 5) = 5)
+        FROM reviews
+        GROUP BY book_id
+        ON CONFLICT (book_id) DO NOTHING
+        """,
+        """
+        INSERT INTO book_stats (book_id, tracker_count, planning_count, reading_count, on_hold_count, finished_count)
+        SELECT book_id, COUNT(*),
+               COUNT(*) FILTER (WHERE status = 'planning'),
+               COUNT(*) FILTER (WHERE status = 'reading'),
+               COUNT(*) FILTER (WHERE status = 'on-hold'),
+               COUNT(*) FILTER (WHERE status = 'finished')
+        FROM is_tracking
+        GROUP BY book_id
+        ON CONFLICT (book_id) DO UPDATE SET
+            tracker_count = EXCLUDED.tracker_count,
+            planning_count = EXCLUDED.planning_count,
+            reading_count = EXCLUDED.reading_count,
+            on_hold_count = EXCLUDED.on_hold_count,
+            finished_count = EXCLUDED.finished_count
+        """,
+    ]),
+    (9, "per-user reading statistics rollup (see readingstats.py)", [
+        """
+        CREATE TABLE IF NOT EXISTS reading_stats (
+            profile_id integer PRIMARY KEY REFERENCES profile (profile_id) ON DELETE CASCADE,
+            books_finished integer NOT NULL DEFAULT 0,
+            pages_read bigint NOT NULL DEFAULT 0,
+            rating_count integer NOT NULL DEFAULT 0,
+            rating_sum numeric NOT NULL DEFAULT 0,
+            finished_by_month jsonb NOT NULL DEFAULT '{}',
+            genres jsonb NOT NULL DEFAULT '{}',
+            longest_streak_months integer NOT NULL DEFAULT 0,
+            updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        WITH t AS (
+            SELECT it.profile_id, it.book_id, it.status, it.current_page, it.finish_date, b.page_count
+            FROM is_tracking it
+            JOIN book b ON b.book_id = it.book_id
+        ),
+        base AS (
+            SELECT profile_id,
+                   COUNT(*) FILTER (WHERE status = 'finished') AS books_finished,
+                   SUM(CASE WHEN status = 'finished' THEN COALESCE(page_count, 0)
+                            ELSE GREATEST(COALESCE(current_page, 0), 0) END) AS pages_read
+            FROM t GROUP BY profile_id
+        ),
+        months AS (
+            SELECT profile_id, date_trunc('month', finish_date)::date AS month, COUNT(*) AS n
+            FROM t WHERE status = 'finished' AND finish_date IS NOT NULL
+            GROUP BY 1, 2
+        ),
+        by_month AS (
+            SELECT profile_id, jsonb_object_agg(to_char(month, 'YYYY-MM'), n) AS finished_by_month
+            FROM months GROUP BY profile_id
+        ),
+        streaks AS (
+            -- consecutive months share month - (row number) months
+            SELECT profile_id, MAX(run) AS longest_streak_months FROM (
+                SELECT profile_id, COUNT(*) AS run FROM (
+                    SELECT profile_id, month,
+                           month - make_interval(months => (row_number() OVER (PARTITION BY profile_id ORDER BY month))::int) AS grp
+                    FROM months
+                ) m GROUP BY profile_id, grp
+            ) runs GROUP BY profile_id
+        ),
+        genres AS (
+            SELECT profile_id, jsonb_object_agg(genre_name, n) AS genres FROM (
+                SELECT t.profile_id, g.genre_name, COUNT(*) AS n
+                FROM t
+                JOIN categorized_as ca ON ca.book_id = t.book_id
+                JOIN genre g ON g.genre_id = ca.genre_id
+                WHERE t.status = 'finished'
+                GROUP BY 1, 2
+            ) x GROUP BY profile_id
+        ),
+        ratings AS (
+            SELECT profile_id, COUNT(rating) AS rating_count, COALESCE(SUM(rating), 0) AS rating_sum
+            FROM reviews
+            GROUP BY profile_id
+        ),
+        users AS (
+            SELECT profile_id FROM base UNION SELECT profile_id FROM ratings
+        )
+        INSERT INTO reading_stats (profile_id, books_finished, pages_read, rating_count, rating_sum,
+                                   finished_by_month, genres, longest_streak_months, updated_at)
+        SELECT u.profile_id,
+               COALESCE(base.books_finished, 0), COALESCE(base.pages_read, 0),
+               COALESCE(ratings.rating_count, 0), COALESCE(ratings.rating_sum, 0),
+               COALESCE(by_month.finished_by_month, '{}'::jsonb), COALESCE(genres.genres, '{}'::jsonb),
+               COALESCE(streaks.longest_streak_months, 0), CURRENT_TIMESTAMP
+        FROM users u
+        LEFT JOIN base ON base.profile_id = u.profile_id
+        LEFT JOIN by_month ON by_month.profile_id = u.profile_id
+        LEFT JOIN streaks ON streaks.profile_id = u.profile_id
+        LEFT JOIN genres ON genres.profile_id = u.profile_id
+        LEFT JOIN ratings ON ratings.profile_id = u.profile_id
+        ON CONFLICT (profile_id) DO UPDATE SET
+            books_finished = EXCLUDED.books_finished,
+            pages_read = EXCLUDED.pages_read,
+            rating_count = EXCLUDED.rating_count,
+            rating_sum = EXCLUDED.rating_sum,
+            finished_by_month = EXCLUDED.finished_by_month,
+            genres = EXCLUDED.genres,
+            longest_streak_months = EXCLUDED.longest_streak_months,
+            updated_at = EXCLUDED.updated_at
+        """,
+    ]),
+    (10, "precomputed recommendation tables (see recommend.py)", [
+        """
+        CREATE TABLE IF NOT EXISTS book_similar (
+            book_id integer NOT NULL REFERENCES book (book_id) ON DELETE CASCADE,
+            rank smallint NOT NULL,
+            similar_book_id integer NOT NULL REFERENCES book (book_id) ON DELETE CASCADE,
+            score real NOT NULL,
+            PRIMARY KEY (book_id, rank)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_recommendation (
+            profile_id integer NOT NULL REFERENCES profile (profile_id) ON DELETE CASCADE,
+            rank smallint NOT NULL,
+            book_id integer NOT NULL REFERENCES book (book_id) ON DELETE CASCADE,
+            score real NOT NULL,
+            PRIMARY KEY (profile_id, rank)
+        )
+        """,
+    ]),
+    (11, "finished books by user and date, for challenge progress (see challenges.py)", [
+        """
+        CREATE INDEX IF NOT EXISTS is_tracking_finished_idx ON is_tracking (profile_id, finish_date)
+        WHERE status = 'finished'
+        """,
+    ]),
+    (12, "challenge leaderboard index and progress histogram (see leaderboard.py)", [
+        "UPDATE participates_in SET current_progress = 0 WHERE current_progress IS NULL",
+        "ALTER TABLE participates_in ALTER COLUMN current_progress SET DEFAULT 0",
+        "ALTER TABLE participates_in ALTER COLUMN current_progress SET NOT NULL",
+        """
+        CREATE INDEX IF NOT EXISTS participates_in_leaderboard_idx
+        ON participates_in (challenge_id, current_progress, profile_id)
+        WHERE status IN ('active', 'completed')
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS challenge_leaderboard_counts (
+            challenge_id integer NOT NULL REFERENCES challenge (challenge_id) ON DELETE CASCADE,
+            progress integer NOT NULL,
+            participants integer NOT NULL,
+            PRIMARY KEY (challenge_id, progress)
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION challenge_leaderboard_counts_trigger() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            old_counted boolean := TG_OP <> 'INSERT' AND OLD.status IN ('active', 'completed');
+            new_counted boolean := TG_OP <> 'DELETE' AND NEW.status IN ('active', 'completed');
+        BEGIN
+            IF old_counted AND new_counted AND OLD.challenge_id = NEW.challenge_id
+               AND OLD.current_progress = NEW.current_progress THEN
+                RETURN NULL;
+            END IF;
+            IF old_counted THEN
+                UPDATE challenge_leaderboard_counts SET participants = participants - 1
+                WHERE challenge_id = OLD.challenge_id AND progress = OLD.current_progress;
+                DELETE FROM challenge_leaderboard_counts
+                WHERE challenge_id = OLD.challenge_id AND progress = OLD.current_progress AND participants <= 0;
+            END IF;
+            IF new_counted THEN
+                INSERT INTO challenge_leaderboard_counts (challenge_id, progress, participants)
+                VALUES (NEW.challenge_id, NEW.current_progress, 1)
+                ON CONFLICT (challenge_id, progress)
+                DO UPDATE SET participants = challenge_leaderboard_counts.participants + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        """,
+        "DROP TRIGGER IF EXISTS participates_in_leaderboard_counts ON participates_in",
+        """
+        CREATE TRIGGER participates_in_leaderboard_counts
+        AFTER INSERT OR UPDATE OF challenge_id, current_progress, status OR DELETE ON participates_in
+        FOR EACH ROW EXECUTE FUNCTION challenge_leaderboard_counts_trigger()
+        """,
+        """
+        INSERT INTO challenge_leaderboard_counts (challenge_id, progress, participants)
+        SELECT challenge_id, current_progress, COUNT(*)
+        FROM participates_in
+        WHERE status IN ('active', 'completed')
+        GROUP BY challenge_id, current_progress
+        ON CONFLICT (challenge_id, progress) DO UPDATE SET participants = EXCLUDED.participants
+        """,
+    ]),
+    (13, "activity feed events, timelines and pulled accounts (see feed.py)", [
+        """
+        CREATE TABLE IF NOT EXISTS activity (
+            event_id bigserial PRIMARY KEY,
+            actor_id integer NOT NULL REFERENCES profile (profile_id) ON DELETE CASCADE,
+            kind text NOT NULL,
+            book_id integer REFERENCES book (book_id) ON DELETE CASCADE,
+            detail jsonb NOT NULL DEFAULT '{}',
+            created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS activity_actor_id_event_id_idx ON activity (actor_id, event_id)",
+        """
+        CREATE TABLE IF NOT EXISTS timeline (
+            profile_id integer NOT NULL REFERENCES profile (profile_id) ON DELETE CASCADE,
+            event_id bigint NOT NULL REFERENCES activity (event_id) ON DELETE CASCADE,
+            PRIMARY KEY (profile_id, event_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS timeline_event_id_idx ON timeline (event_id)",
+        """
+        CREATE TABLE IF NOT EXISTS feed_pull_actors (
+            profile_id integer PRIMARY KEY REFERENCES profile (profile_id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (14, "leaderboard counts striped by participant, updated in key order (see leaderboard.py)", [
+        # no participation changes while the counts are rebuilt below
+        "LOCK TABLE participates_in IN SHARE MODE",
+        "ALTER TABLE challenge_leaderboard_counts ADD COLUMN IF NOT EXISTS slot smallint NOT NULL DEFAULT 0",
+        "ALTER TABLE challenge_leaderboard_counts DROP CONSTRAINT IF EXISTS challenge_leaderboard_counts_pkey",
+        "ALTER TABLE challenge_leaderboard_counts ADD PRIMARY KEY (challenge_id, progress, slot)",
+        """
+        CREATE OR REPLACE FUNCTION challenge_leaderboard_counts_add(cid integer, prog integer, s smallint, delta integer)
+        RETURNS void LANGUAGE plpgsql AS $$
+        BEGIN
+            IF delta > 0 THEN
+                INSERT INTO challenge_leaderboard_counts (challenge_id, progress, slot, participants)
+                VALUES (cid, prog, s, delta)
+                ON CONFLICT (challenge_id, progress, slot)
+                DO UPDATE SET participants = challenge_leaderboard_counts.participants + delta;
+            ELSE
+                UPDATE challenge_leaderboard_counts SET participants = participants + delta
+                WHERE challenge_id = cid AND progress = prog AND slot = s;
+                DELETE FROM challenge_leaderboard_counts
+                WHERE challenge_id = cid AND progress = prog AND slot = s AND participants <= 0;
+            END IF;
+        END
+        $$
+        """,
+        # A participant's counts always live in slot profile_id % 16, so concurrent
+        # joins (all at progress 0) of different people rarely share a counter row.
+        # The two rows a move touches are taken in (challenge, progress) order, so
+        # opposite moves (3 -> 5 and 5 -> 3) cannot lock them in opposite orders.
+        """
+        CREATE OR REPLACE FUNCTION challenge_leaderboard_counts_trigger() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            old_counted boolean := TG_OP <> 'INSERT' AND OLD.status IN ('active', 'completed');
+            new_counted boolean := TG_OP <> 'DELETE' AND NEW.status IN ('active', 'completed');
+        BEGIN
+            IF old_counted AND new_counted AND OLD.challenge_id = NEW.challenge_id
+               AND OLD.current_progress = NEW.current_progress THEN
+                RETURN NULL;
+            END IF;
+            IF old_counted AND (NOT new_counted
+                                OR (OLD.challenge_id, OLD.current_progress) < (NEW.challenge_id, NEW.current_progress)) THEN
+                PERFORM challenge_leaderboard_counts_add(OLD.challenge_id, OLD.current_progress,
+                                                         (OLD.profile_id % 16)::smallint, -1);
+                IF new_counted THEN
+                    PERFORM challenge_leaderboard_counts_add(NEW.challenge_id, NEW.current_progress,
+                                                             (NEW.profile_id % 16)::smallint, 1);
+                END IF;
+            ELSE
+                IF new_counted THEN
+                    PERFORM challenge_leaderboard_counts_add(NEW.challenge_id, NEW.current_progress,
+                                                             (NEW.profile_id % 16)::smallint, 1);
+                END IF;
+                IF old_counted THEN
+                    PERFORM challenge_leaderboard_counts_add(OLD.challenge_id, OLD.current_progress,
+                                                             (OLD.profile_id % 16)::smallint, -1);
+                END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        """,
+        "DELETE FROM challenge_leaderboard_counts",
+        """
+        INSERT INTO challenge_leaderboard_counts (challenge_id, progress, slot, participants)
+        SELECT challenge_id, current_progress, profile_id % 16, COUNT(*)
+        FROM participates_in
+        WHERE status IN ('active', 'completed')
+        GROUP BY 1, 2, 3
+        """,
+    ]),
+    (15, "newest review sort keyed on COALESCE(reviewed_at, 'epoch') (see reviews.py)", [
+        "CREATE INDEX IF NOT EXISTS reviews_book_newest_key_idx ON reviews "
+        "(book_id, (COALESCE(reviewed_at, 'epoch'::timestamp)), profile_id)",
+        # superseded by reviews_book_newest_key_idx
+        "DROP INDEX IF EXISTS reviews_book_newest_idx",
+    ]),
+    (16, "leaderboard distinct progress values and striped participant totals (see leaderboard.py)", [
+        # no participation changes while the new tables are filled below
+        "LOCK TABLE participates_in IN SHARE MODE",
+        # one row per counted progress value; slots = how many counts rows (slots) hold it
+        """
+        CREATE TABLE IF NOT EXISTS challenge_leaderboard_values (
+            challenge_id integer NOT NULL,
+            progress integer NOT NULL,
+            slots integer NOT NULL,
+            PRIMARY KEY (challenge_id, progress)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS challenge_leaderboard_totals (
+            challenge_id integer NOT NULL,
+            slot smallint NOT NULL,
+            participants integer NOT NULL,
+            PRIMARY KEY (challenge_id, slot)
+        )
+        """,
+        # A values row is only written when a counts row appears or empties, which
+        # for a busy progress value (everyone at 0) is rare: joins queue on their
+        # own slot, not on the value.
+        """
+        CREATE OR REPLACE FUNCTION challenge_leaderboard_counts_add(cid integer, prog integer, s smallint, delta integer)
+        RETURNS void LANGUAGE plpgsql AS $$
+        DECLARE
+            n integer;
+        BEGIN
+            IF delta > 0 THEN
+                INSERT INTO challenge_leaderboard_counts (challenge_id, progress, slot, participants)
+                VALUES (cid, prog, s, delta)
+                ON CONFLICT (challenge_id, progress, slot)
+                DO UPDATE SET participants = challenge_leaderboard_counts.participants + delta
+                RETURNING participants INTO n;
+                -- stored rows are always positive, so n = delta only for a new row
+                IF n = delta THEN
+                    INSERT INTO challenge_leaderboard_values (challenge_id, progress, slots)
+                    VALUES (cid, prog, 1)
+                    ON CONFLICT (challenge_id, progress)
+                    DO UPDATE SET slots = challenge_leaderboard_values.slots + 1;
+                END IF;
+            ELSE
+                UPDATE challenge_leaderboard_counts SET participants = participants + delta
+                WHERE challenge_id = cid AND progress = prog AND slot = s
+                RETURNING participants INTO n;
+                IF n <= 0 THEN
+                    DELETE FROM challenge_leaderboard_counts
+                    WHERE challenge_id = cid AND progress = prog AND slot = s;
+                    UPDATE challenge_leaderboard_values SET slots = slots - 1
+                    WHERE challenge_id = cid AND progress = prog
+                    RETURNING slots INTO n;
+                    IF n <= 0 THEN
+                        DELETE FROM challenge_leaderboard_values WHERE challenge_id = cid AND progress = prog;
+                    END IF;
+                END IF;
+            END IF;
+        END
+        $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION challenge_leaderboard_totals_add(cid integer, s smallint, delta integer)
+        RETURNS void LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO challenge_leaderboard_totals (challenge_id, slot, participants)
+            VALUES (cid, s, delta)
+            ON CONFLICT (challenge_id, slot)
+            DO UPDATE SET participants = challenge_leaderboard_totals.participants + delta;
+        END
+        $$
+        """,
+        # as in migration 14, plus the totals: those only move when a participation
+        # starts or stops being counted, after the counts rows, lower challenge first
+        """
+        CREATE OR REPLACE FUNCTION challenge_leaderboard_counts_trigger() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            old_counted boolean := TG_OP <> 'INSERT' AND OLD.status IN ('active', 'completed');
+            new_counted boolean := TG_OP <> 'DELETE' AND NEW.status IN ('active', 'completed');
+        BEGIN
+            IF old_counted AND new_counted AND OLD.challenge_id = NEW.challenge_id
+               AND OLD.current_progress = NEW.current_progress THEN
+                RETURN NULL;
+            END IF;
+            IF old_counted AND (NOT new_counted
+                                OR (OLD.challenge_id, OLD.current_progress) < (NEW.challenge_id, NEW.current_progress)) THEN
+                PERFORM challenge_leaderboard_counts_add(OLD.challenge_id, OLD.current_progress,
+                                                         (OLD.profile_id % 16)::smallint, -1);
+                IF new_counted THEN
+                    PERFORM challenge_leaderboard_counts_add(NEW.challenge_id, NEW.current_progress,
+                                                             (NEW.profile_id % 16)::smallint, 1);
+                END IF;
+            ELSE
+                IF new_counted THEN
+                    PERFORM challenge_leaderboard_counts_add(NEW.challenge_id, NEW.current_progress,
+                                                             (NEW.profile_id % 16)::smallint, 1);
+                END IF;
+                IF old_counted THEN
+                    PERFORM challenge_leaderboard_counts_add(OLD.challenge_id, OLD.current_progress,
+                                                             (OLD.profile_id % 16)::smallint, -1);
+                END IF;
+            END IF;
+            IF old_counted AND new_counted AND OLD.challenge_id = NEW.challenge_id THEN
+                RETURN NULL;
+            END IF;
+            IF old_counted AND (NOT new_counted OR OLD.challenge_id < NEW.challenge_id) THEN
+                PERFORM challenge_leaderboard_totals_add(OLD.challenge_id, (OLD.profile_id % 16)::smallint, -1);
+                IF new_counted THEN
+                    PERFORM challenge_leaderboard_totals_add(NEW.challenge_id, (NEW.profile_id % 16)::smallint, 1);
+                END IF;
+            ELSE
+                IF new_counted THEN
+                    PERFORM challenge_leaderboard_totals_add(NEW.challenge_id, (NEW.profile_id % 16)::smallint, 1);
+                END IF;
+                IF old_counted THEN
+                    PERFORM challenge_leaderboard_totals_add(OLD.challenge_id, (OLD.profile_id % 16)::smallint, -1);
+                END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        """,
+        "DELETE FROM challenge_leaderboard_values",
+        """
+        INSERT INTO challenge_leaderboard_values (challenge_id, progress, slots)
+        SELECT challenge_id, progress, COUNT(*)
+        FROM challenge_leaderboard_counts
+        GROUP BY 1, 2
+        """,
+        "DELETE FROM challenge_leaderboard_totals",
+        """
+        INSERT INTO challenge_leaderboard_totals (challenge_id, slot, participants)
+        SELECT challenge_id, slot, SUM(participants)
+        FROM challenge_leaderboard_counts
+        GROUP BY 1, 2
+        """,
+    ]),
+]
+
+#
+# Leading index columns the queries in server.py rely on, and which route
+# runs them. An index satisfies a requirement when its columns start with
+# the listed ones (so a composite primary key can cover its first column).
+# Expression columns are written the way Postgres prints them back.
+#
+REQUIRED_INDEXES = [
+    ("book", ("search_vector",), "search"),
+    ("written_by", ("book_id",), "search, book"),
+    ("written_by", ("author_id",), "author"),
+    ("categorized_as", ("book_id",), "book"),
+    ("reviews", ("book_id", "COALESCE(reviewed_at, '1970-01-01 00:00:00'::timestamp without time zone)", "profile_id"),
+     "book"),
+    ("reviews", ("book_id", "COALESCE(likes_count, 0)", "profile_id"), "book"),
+    ("reviews", ("book_id", "COALESCE(rating, '-1'::integer::numeric)", "profile_id"), "book"),
+    ("reviews", ("profile_id", "book_id"), "profile"),
+    ("follows", ("follower_id", "following_id"), "profile, feed"),
+    ("follows", ("following_id", "follower_id"), "profile"),
+    ("has_favorite", ("profile_id", "author_id"), "profile, author"),
+    ("is_tracking", ("profile_id", "book_id"), "profile, book"),
+    ("bookshelf", ("profile_id",), "profile"),
+    ("contains_book", ("bookshelf_id",), "view_bookshelf"),
+    ("participates_in", ("profile_id",), "challenges, view_challenge"),
+    ("participates_in", ("challenge_id", "current_progress", "profile_id"), "view_challenge"),
+    ("challenge_leaderboard_values", ("challenge_id", "progress"), "view_challenge"),
+    ("challenge_leaderboard_totals", ("challenge_id",), "view_challenge"),
+    ("profile", ("username",), "login, signup"),
+    ("book_similar", ("book_id", "rank"), "book"),
+    ("user_recommendation", ("profile_id", "rank"), "profile"),
+    ("timeline", ("profile_id", "event_id"), "feed"),
+    ("activity", ("actor_id", "event_id"), "feed"),
+]
+
+
+def ensure_migrations_table(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version integer PRIMARY KEY,
+            description text NOT NULL,
+            applied_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+
+def applied_versions(conn):
+    ensure_migrations_table(conn)
+    return set(r[0] for r in conn.execute(text("SELECT version FROM schema_migrations")))
+
+
+def migrate(engine, verbose=True):
+    """Apply pending migrations in order, each in its own transaction. Returns the versions applied."""
+    done = []
+    with engine.connect() as conn:
+        with conn.begin():
+            conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": MIGRATION_LOCK_ID})
+        try:
+            with conn.begin():
+                applied = applied_versions(conn)
+            for version, description, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                with conn.begin():
+                    for stmt in statements:
+                        conn.execute(text(stmt))
+                    conn.execute(
+                        text("INSERT INTO schema_migrations (version, description) VALUES (:v, :d)"),
+                        {"v": version, "d": description}
+                    )
+                if verbose:
+                    print("applied migration %d: %s" % (version, description))
+                done.append(version)
+        finally:
+            with conn.begin():
+                conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_ID})
+    return done
+
+
+def existing_indexes(conn):
+    """
+    Return {table: [tuple of column names, ...]} for every index in the
+    current schema. Expression columns appear as Postgres prints them.
+    """
+    rows = conn.execute(text("""
+        SELECT t.relname AS table_name,
+               array_agg(COALESCE(a.attname::text, pg_get_indexdef(i.indexrelid, k.ord::int, true))
+                         ORDER BY k.ord) AS columns
+        FROM pg_index i
+        JOIN pg_class t ON t.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+        LEFT JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum AND k.attnum <> 0
+        WHERE n.nspname = current_schema()
+        GROUP BY i.indexrelid, t.relname
+    """))
+    indexes = {}
+    for r in rows:
+        indexes.setdefault(r.table_name, []).append(tuple(r.columns))
+    return indexes
+
+
+def missing_indexes(conn):
+    """Return the REQUIRED_INDEXES entries that no existing index covers."""
+    indexes = existing_indexes(conn)
+    missing = []
+    for table, cols, used_by in REQUIRED_INDEXES:
+        covered = any(idx[:len(cols)] == cols for idx in indexes.get(table, []))
+        if not covered:
+            missing.append((table, cols, used_by))
+    return missing
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.group()
+    def cli():
+        """Schema migrations and index checks for the bookshelf database."""
+
+    @cli.command('migrate')
+    def migrate_cmd():
+        """Apply pending migrations."""
+        done = migrate(make_engine(DATABASEURI))
+        if not done:
+            print("schema is up to date")
+
+    @cli.command('status')
+    def status_cmd():
+        """List applied and pending migrations."""
+        with make_engine(DATABASEURI).connect() as conn:
+            applied = applied_versions(conn)
+            conn.commit()
+        for version, description, _ in MIGRATIONS:
+            state = "applied" if version in applied else "pending"
+            print("%4d  %-8s %s" % (version, state, description))
+
+    @cli.command('check')
+    def check_cmd():
+        """Report indexes the queries in server.py need but the database lacks."""
+        with make_engine(DATABASEURI).connect() as conn:
+            missing = missing_indexes(conn)
+        if not missing:
+            print("all %d required indexes present" % len(REQUIRED_INDEXES))
+            return
+        for table, cols, used_by in missing:
+            print("missing index on %s (%s)  -- used by %s" % (table, ", ".join(cols), used_by))
+        raise SystemExit(1)
+
+    cli()
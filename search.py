@@ -0,0 +1,189 @@
+"""
+Ranked full-text book search.
+
+Books carry a search_vector column (title weighted A, author names B,
+summary C) kept current by triggers installed in schema.py migration 2 and
+covered by a GIN index. Results are ordered by ts_rank_cd and paged with a
+keyset cursor on (rank, book_id), so later pages never OFFSET past earlier ones.
+"""
+import re
+from queries import query
+
+SEARCH_PAGE_SIZE = 50
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+_RANKED_SQL = '''
+    WITH query AS (SELECT to_tsquery('english', :tsq) AS q),
+    page AS (
+        SELECT id, title, published_year, image_url, rank FROM (
+            SELECT b.book_id AS id,
+                   b.title AS title,
+                   b.publication_year AS published_year,
+                   b.image_url AS image_url,
+                   ts_rank_cd(b.search_vector, query.q)::float8 AS rank
+            FROM book b, query
+            WHERE b.search_vector @@ query.q
+        ) ranked
+        %s
+        ORDER BY rank DESC, id DESC
+        LIMIT :limit
+    )
+    SELECT page.id, page.title, page.published_year, page.image_url, page.rank,
+           bs.rating_sum / NULLIF(bs.rating_count, 0) AS avg_rating,
+           COALESCE(bs.review_count, 0) AS review_count,
+           COALESCE((
+               SELECT string_agg(a.name, ', ')
+               FROM written_by wb
+               JOIN author a ON wb.author_id = a.author_id
+               WHERE wb.book_id = page.id
+           ), '') AS authors
+    FROM page
+    LEFT JOIN book_stats bs ON bs.book_id = page.id
+    ORDER BY page.rank DESC, page.id DESC
+'''
+
+FIRST_PAGE_SQL = query("search.first_page", _RANKED_SQL % "")
+NEXT_PAGE_SQL = query("search.next_page", _RANKED_SQL % "WHERE (rank, id) < (CAST(:after_rank AS float8), CAST(:after_id AS integer))")
+
+
+def to_tsquery_text(q):
+    """
+    Turn free text into a to_tsquery() expression: every word must match and
+    the last one is a prefix, so partially typed words still find results.
+    Only \\w+ runs are kept, so user input can never inject tsquery operators.
+    """
+    words = _WORD_RE.findall(q)
+    if not words:
+        return None
+    return " & ".join(words[:-1] + [words[-1] + ":*"])
+
+
+def encode_cursor(rank, book_id):
+    return "%r,%d" % (rank, book_id)
+
+
+def decode_cursor(cursor):
+    """Return (rank, book_id) or None for a missing / malformed cursor."""
+    if not cursor:
+        return None
+    try:
+        rank, book_id = cursor.split(",", 1)
+        return float(rank), int(book_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def book_search_query(q, after=None, page_size=SEARCH_PAGE_SIZE):
+    """Return (statement, params) for one page of books matching q, or None if q has no words."""
+    tsq = to_tsquery_text(q)
+    if tsq is None:
+        return None
+    params = {"tsq": tsq, "limit": page_size + 1}
+    position = decode_cursor(after)
+    if position is None:
+        return FIRST_PAGE_SQL, params
+    params["after_rank"], params["after_id"] = position
+    return NEXT_PAGE_SQL, params
+
+
+def book_results(rows, page_size=SEARCH_PAGE_SIZE):
+    """Shape the rows of a book_search_query() into (results, next_cursor)."""
+    results = []
+    for row in rows[:page_size]:
+        results.append({
+            "id": row.id,
+            "title": row.title,
+            "authors": row.authors,
+            "published_year": row.published_year,
+            "image_url": row.image_url,
+            "avg_rating": round(float(row.avg_rating), 2) if row.avg_rating is not None else None,
+            "review_count": row.review_count,
+            "type": "book"
+        })
+
+    # the extra row fetched past page_size only tells us another page exists
+    next_cursor = None
+    if len(rows) > page_size:
+        last = rows[page_size - 1]
+        next_cursor = encode_cursor(last.rank, last.id)
+    return results, next_cursor
+
+
+def search_books(conn, q, after=None, page_size=SEARCH_PAGE_SIZE):
+    """
+    Return (results, next_cursor) for one page of books matching q.
+
+    results are the same dicts search() has always rendered; next_cursor is
+    None on the last page.
+    """
+    query = book_search_query(q, after, page_size)
+    if query is None:
+        return [], None
+    rows = conn.execute(*query).fetchall()
+    return book_results(rows, page_size)
+
+
+#
+# The other search modes match a substring of one or two short columns.
+#
+SEARCH_SQL = {
+    "author": query("search.author", '''
+        SELECT author_id AS id, name, birthday, nationality
+        FROM author
+        WHERE name ILIKE :p
+        ORDER BY name
+        LIMIT 50
+    '''),
+    "profile": query("search.profile", '''
+        SELECT profile_id AS id, username, joined_at
+        FROM profile
+        WHERE username ILIKE :p
+        ORDER BY joined_at DESC
+        LIMIT 50
+    '''),
+    "bookshelf": query("search.bookshelf", '''
+        SELECT bs.bookshelf_id AS id, bs.shelf_name, bs.description, p.username
+        FROM bookshelf bs
+        JOIN profile p ON bs.profile_id = p.profile_id
+        WHERE bs.shelf_name ILIKE :p OR bs.description ILIKE :p
+        ORDER BY bs.created_at DESC
+        LIMIT 50
+    '''),
+}
+
+
+def search_params(q):
+    return {"p": f"%{q}%"}
+
+
+def result_from_row(mode, row, avatar_url=None):
+    """Shape a SEARCH_SQL row into the result dict index.html renders."""
+    if mode == "author":
+        return {
+            "id": row.id,
+            "title": row.name,
+            "authors": None,
+            "published_year": row.birthday,
+            "image_url": None,
+            "extra": row.nationality,
+            "type": "author"
+        }
+    if mode == "profile":
+        return {
+            "id": row.id,
+            "title": row.username,
+            "authors": None,
+            "published_year": row.joined_at,
+            "image_url": avatar_url,
+            "type": "profile"
+        }
+    return {
+        "id": row.id,
+        "title": row.shelf_name,
+        "authors": row.username,   # owner
+        "published_year": None,
+        "image_url": None,
+        "extra": row.description,
+        "type": "bookshelf"
+    }
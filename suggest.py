@@ -0,0 +1,235 @@
+"""
+In-process prefix index behind /search/suggest.
+
+Covers the same four entities search() handles: book titles, author names,
+usernames and public bookshelf names. Keys are kept in sorted lists and
+looked up with bisect, so a suggestion is a binary search plus a short scan
+and never touches Postgres. Each label is indexed from the start of each of
+its first few words, so "hung" finds "The Hunger Games".
+
+Each kind has its own sorted key list, so a lookup restricted to one kind
+(say bookshelves under "a") never walks the keys of the others, and an
+unrestricted lookup reads at most limit entries per kind.
+
+The index is built per worker on a background thread (start_background_load)
+and rebuilt every SUGGEST_REFRESH_SECONDS (default 300, 0 turns it off).
+add() / remove() calls from the routes that write these rows keep the
+worker that served the write current at once; the periodic rebuild brings
+the other pre-fork workers up to date. Writes that land while a rebuild is
+reading the database are replayed onto the new index before it is swapped in.
+"""
+import os
+import sys
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, bisect_right
+from sqlalchemy import text
+
+KINDS = ("book", "author", "profile", "bookshelf")
+
+# how many word starts of a label get their own key
+MAX_WORD_KEYS = 4
+
+SUGGEST_REFRESH_SECONDS = float(os.environ.get("SUGGEST_REFRESH_SECONDS", 300))
+
+SOURCES = {
+    "book": "SELECT book_id, title FROM book WHERE title IS NOT NULL",
+    "author": "SELECT author_id, name FROM author WHERE name IS NOT NULL",
+    "profile": "SELECT profile_id, username FROM profile WHERE username IS NOT NULL",
+    "bookshelf": "SELECT bookshelf_id, shelf_name FROM bookshelf WHERE is_public = TRUE AND shelf_name IS NOT NULL",
+}
+
+
+def normalize(s):
+    """Casefold, strip accents and collapse whitespace."""
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    return " ".join(s.casefold().split())
+
+
+def label_keys(label):
+    norm = normalize(label)
+    words = norm.split(" ")
+    keys = []
+    pos = 0
+    for w in words[:MAX_WORD_KEYS]:
+        keys.append(norm[pos:])
+        pos += len(w) + 1
+    return keys
+
+
+class PrefixIndex(object):
+    """Sorted-array prefix index of (kind, id, label) entries, one array per kind."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = dict((kind, []) for kind in KINDS)
+        self._refs = dict((kind, []) for kind in KINDS)
+        self._labels = {}
+        # add/remove calls made while load() reads the database, replayed before its swap
+        self._pending = None
+        self.loaded = False
+        # sized in load(), before the swap, so stats() never walks the index under the lock
+        self.memory_bytes = None
+        self.rebuild_seconds = None
+        self.rebuilt_at = None
+
+    def _insert(self, keys, refs, labels, ref):
+        kind, id, label = ref
+        keys, refs = keys[kind], refs[kind]
+        for key in label_keys(label):
+            pos = bisect_right(keys, key)
+            keys.insert(pos, key)
+            refs.insert(pos, ref)
+        labels[(kind, id)] = label
+
+    def _remove(self, keys, refs, labels, kind, id):
+        label = labels.pop((kind, id), None)
+        if label is None:
+            return
+        keys, refs = keys[kind], refs[kind]
+        for key in label_keys(label):
+            pos = bisect_left(keys, key)
+            while pos < len(keys) and keys[pos] == key:
+                if refs[pos][1] == id:
+                    del keys[pos]
+                    del refs[pos]
+                    break
+                pos += 1
+
+    def add(self, kind, id, label):
+        """Add or replace one entry; called after a row is written."""
+        if not label:
+            return
+        with self._lock:
+            self._remove(self._keys, self._refs, self._labels, kind, id)
+            self._insert(self._keys, self._refs, self._labels, (kind, id, label))
+            if self._pending is not None:
+                self._pending.append((kind, id, label))
+
+    def remove(self, kind, id):
+        with self._lock:
+            self._remove(self._keys, self._refs, self._labels, kind, id)
+            if self._pending is not None:
+                self._pending.append((kind, id, None))
+
+    def load(self, conn):
+        """Rebuild the whole index from the database and swap it in."""
+        started = time.perf_counter()
+        with self._lock:
+            self._pending = []
+        try:
+            keys = {}
+            refs = {}
+            labels = {}
+            for kind in KINDS:
+                pairs = []
+                rows = conn.execution_options(stream_results=True).execute(text(SOURCES[kind]))
+                for id, label in rows:
+                    ref = (kind, id, label)
+                    labels[(kind, id)] = label
+                    for key in label_keys(label):
+                        pairs.append((key, ref))
+                pairs.sort(key=lambda p: p[0])
+                keys[kind] = [p[0] for p in pairs]
+                refs[kind] = [p[1] for p in pairs]
+            memory_bytes = footprint(keys, refs, labels)
+            with self._lock:
+                for kind, id, label in self._pending:
+                    self._remove(keys, refs, labels, kind, id)
+                    if label is not None:
+                        self._insert(keys, refs, labels, (kind, id, label))
+                self._keys, self._refs, self._labels = keys, refs, labels
+                self.loaded = True
+                self.memory_bytes = memory_bytes
+                self.rebuild_seconds = time.perf_counter() - started
+                self.rebuilt_at = time.time()
+        finally:
+            with self._lock:
+                self._pending = None
+        print("suggest index: %d keys for %d entries built in %.2fs"
+              % (sum(len(k) for k in keys.values()), len(labels), self.rebuild_seconds))
+
+    def _scan(self, kind, prefix, limit):
+        # at most limit distinct entries of one kind, as (key, ref) in key order; caller holds the lock
+        keys, refs = self._keys[kind], self._refs[kind]
+        out = []
+        seen = set()
+        i = bisect_left(keys, prefix)
+        n = len(keys)
+        while i < n and len(seen) < limit and keys[i].startswith(prefix):
+            ref = refs[i]
+            if ref[1] not in seen:
+                seen.add(ref[1])
+                out.append((keys[i], ref))
+            i += 1
+        return out
+
+    def lookup(self, prefix, kind=None, limit=10):
+        """Return up to limit distinct (kind, id, label) entries whose key starts with prefix."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            if kind is not None:
+                return [ref for _, ref in self._scan(kind, prefix, limit)] if kind in self._keys else []
+            found = []
+            for k in KINDS:
+                found.extend(self._scan(k, prefix, limit))
+        found.sort(key=lambda p: p[0])
+        return [ref for _, ref in found[:limit]]
+
+    def stats(self):
+        """
+        Entry counts, approximate memory footprint and last rebuild time.
+        The footprint is the one measured at the last rebuild; add() and
+        remove() since then move it by a few entries at most.
+        """
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "entries": len(self._labels),
+                "keys": sum(len(self._keys[kind]) for kind in KINDS),
+                "memory_bytes": self.memory_bytes,
+                "rebuild_seconds": self.rebuild_seconds,
+                "rebuilt_at": self.rebuilt_at,
+                "refresh_seconds": SUGGEST_REFRESH_SECONDS,
+            }
+
+
+def footprint(keys, refs, labels):
+    """Approximate bytes held by per-kind key and ref lists and the label map."""
+    key_bytes = sum(sys.getsizeof(keys[kind]) + sum(sys.getsizeof(k) for k in keys[kind]) for kind in keys)
+    # every key of an entry points at the same ref tuple, so count each once
+    unique_refs = dict((id(r), r) for kind in refs for r in refs[kind])
+    ref_bytes = sum(sys.getsizeof(refs[kind]) for kind in refs) + sum(sys.getsizeof(r) for r in unique_refs.values())
+    label_bytes = sys.getsizeof(labels) + sum(sys.getsizeof(v) for v in labels.values())
+    return key_bytes + ref_bytes + label_bytes
+
+
+suggest_index = PrefixIndex()
+
+
+def start_background_load(engine, refresh=SUGGEST_REFRESH_SECONDS):
+    """
+    Build suggest_index on a daemon thread so worker start does not wait on
+    it, then rebuild it every refresh seconds (if > 0).
+    """
+    # an Event wait rather than time.sleep, so the profiler (sampler.py) sees the thread as idle
+    wait = threading.Event().wait
+
+    def _load():
+        while True:
+            try:
+                with engine.connect() as conn:
+                    suggest_index.load(conn)
+            except Exception as e:
+                print("suggest index load error:", e)
+            if refresh <= 0:
+                return
+            wait(refresh)
+
+    t = threading.Thread(target=_load, name="suggest-index-load", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,60 @@
+"""
+readingstats.record_review() against a stand-in connection: the rollup row
+comes back with a numeric (Decimal) rating_sum while review rows may carry
+float ratings (a real/double column), as bookstats.py allows.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+import readingstats
+
+Review = namedtuple("Review", ["rating"])
+StatsRow = namedtuple("StatsRow", ["profile_id", "books_finished", "pages_read", "rating_count", "rating_sum",
+                                   "finished_by_month", "genres", "longest_streak_months"])
+
+
+class FakeResult(object):
+
+    def __init__(self, row):
+        self.row = row
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeConnection(object):
+    """Holds one reading_stats row; answers LOCK_SQL with it and applies SAVE_SQL."""
+
+    def __init__(self, rating_count=0, rating_sum=Decimal("0")):
+        self.row = StatsRow(7, 0, 0, rating_count, rating_sum, {}, {}, 0)
+
+    def execute(self, statement, params=None):
+        if statement is readingstats.LOCK_SQL:
+            return FakeResult(self.row)
+        if statement is readingstats.SAVE_SQL:
+            self.row = self.row._replace(rating_count=params["rating_count"], rating_sum=params["rating_sum"])
+        return FakeResult(None)
+
+
+def test_float_ratings_add_to_decimal_sum():
+    conn = FakeConnection(rating_count=1, rating_sum=Decimal("4.0"))
+    readingstats.record_review(conn, 7, None, Review(3.5))
+    assert conn.row.rating_count == 2
+    assert conn.row.rating_sum == Decimal("7.5")
+
+
+def test_float_rating_change_and_delete():
+    conn = FakeConnection(rating_count=1, rating_sum=Decimal("4.5"))
+    readingstats.record_review(conn, 7, Review(4.5), Review(2.1))
+    assert conn.row.rating_count == 1
+    assert conn.row.rating_sum == Decimal("2.1")
+    readingstats.record_review(conn, 7, Review(2.1), None)
+    assert conn.row.rating_count == 0
+    assert conn.row.rating_sum == Decimal("0.0")
+
+
+def test_unrated_reviews_leave_stats_alone():
+    conn = FakeConnection()
+    readingstats.record_review(conn, 7, Review(None), Review(None))
+    assert conn.row.rating_count == 0
+    assert conn.row.rating_sum == Decimal("0")